@@ -0,0 +1,353 @@
+# ノード・ウォレットの処理速度のベンチマーク
+# 各項目のスループット（回/秒）とレイテンシ（ミリ秒）を計測し、JSONに保存する
+# 以前の結果を--baselineに渡すと、遅くなった項目を表示して終了コード1で終わる（性能劣化の検知用）
+#   python benchmark.py --output results.json
+#   python benchmark.py --only signature wallet --baseline results.json
+#
+# proof_hasher: valid_header_proof（ナンスごとにヘッダーを作り直す）とProofHasher（固定部分を事前計算）の比較
+#   ヘッダーはマークルルートだけを含むので、トランザクション数はマークルルートの計算にしか影響しない
+import json
+import logging
+import math
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import blockchain
+import models
+import wallet
+
+BENCHMARK_DIFFICULTIES = (1, 2, 3, 4)  # proof_of_workを計測する難易度
+BENCHMARK_CHAIN_LENGTHS = (10, 100, 1000)  # calculate_total_amountを計測するチェーンの長さ
+BENCHMARK_REPEAT = 200  # 1項目あたりの試行回数（proof_of_work以外）
+BENCHMARK_POW_TRIALS = 5  # 難易度ごとにマイニングするブロック数
+BENCHMARK_TOLERANCE = 0.2  # --baselineと比べてこの割合以上遅くなったら劣化とみなす
+
+
+def make_transactions(count):
+    # マークルルートとProof of Workの計測にだけ使う（署名も残高もないので、チェーンには入れない）
+    return [
+        models.Transaction(f"sender_{i}", f"recipient_{i}", float(i + 1))
+        for i in range(count)
+    ]
+
+
+def summarize(latencies, operations=None):
+    # latencies: 1回ごとの所要時間（秒）のリスト
+    # operations: 全体の処理数（省略時は試行回数）
+    total = sum(latencies)
+    ordered = sorted(latencies)
+    operations = len(latencies) if operations is None else operations
+    return {
+        "runs": len(latencies),
+        "ops_per_sec": operations / total if total else None,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+    }
+
+
+def measure(func, args_list):
+    # args_listの要素ごとにfunc(*args)を呼び、1回ごとの時間を計る
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def signed_transactions(sender, recipient_blockchain_address, count):
+    # (署名前のトランザクション, 16進数の署名)のリスト（ナンスは0から順に振る）
+    transactions = []
+    for i in range(count):
+        value = 0.001 * (i + 1)
+        signature = wallet.Transaction(
+            sender.private_key, sender.public_key, sender.blockchain_address,
+            recipient_blockchain_address, value, i,
+        ).generate_signature()
+        transactions.append((
+            blockchain.BlockChain.build_transaction(
+                sender.blockchain_address, recipient_blockchain_address, value, i
+            ),
+            signature,
+        ))
+    return transactions
+
+
+def fund(block_chain, blockchain_address, value=blockchain.MINING_REWARD):
+    # Proof of Workを省略して、報酬だけのブロックをvalue以上になるまで積んで残高を用意する
+    # （報酬は1ブロックに1つで、額はMINING_REWARDに決まっている）
+    for _ in range(math.ceil(value / blockchain.MINING_REWARD)):
+        reward = models.Transaction(
+            blockchain.MINING_SENDER, blockchain_address, blockchain.MINING_REWARD,
+            nonce=len(block_chain.chain),
+        )
+        block_chain.create_block(0, block_chain.block_hashes[-1], [reward])
+
+
+def bench_valid_proof(transactions, previous_hash, nonces):
+    start = time.perf_counter()
+    merkle_root = blockchain.BlockChain.merkle_root(transactions)
+    for nonce in range(nonces):
+        blockchain.BlockChain.valid_header_proof(merkle_root, previous_hash, nonce)
+    return nonces / (time.perf_counter() - start)
+
+
+def bench_proof_hasher(transactions, previous_hash, nonces):
+    start = time.perf_counter()
+    merkle_root = blockchain.BlockChain.merkle_root(transactions)
+    hasher = blockchain.ProofHasher(merkle_root, previous_hash)
+    for nonce in range(nonces):
+        hasher.is_valid(nonce)
+    return nonces / (time.perf_counter() - start)
+
+
+def check_same_hash(transactions, previous_hash, nonces=100):
+    # ProofHasherがBlockChain.proof_hashと同じハッシュ値を返すことを確認する
+    merkle_root = blockchain.BlockChain.merkle_root(transactions)
+    hasher = blockchain.ProofHasher(merkle_root, previous_hash)
+    for nonce in range(nonces):
+        assert hasher.hexdigest(nonce) == blockchain.BlockChain.proof_hash(
+            merkle_root, previous_hash, nonce, blockchain.MINING_DIFFICULTY
+        )
+        assert hasher.is_valid(nonce) == blockchain.BlockChain.valid_proof(
+            transactions, previous_hash, nonce
+        )
+
+
+def run_proof_hasher(args):
+    transactions = make_transactions(args.transactions)
+    previous_hash = blockchain.BlockChain.hash({})
+    check_same_hash(transactions, previous_hash)
+    before = bench_valid_proof(transactions, previous_hash, args.nonces)
+    after = bench_proof_hasher(transactions, previous_hash, args.nonces)
+    return {
+        "proof_hasher": {
+            "transactions": args.transactions,
+            "valid_header_proof_hashes_per_sec": before,
+            "ops_per_sec": after,
+            "speedup": after / before,
+        }
+    }
+
+
+def run_proof_of_work(args):
+    # 難易度ごとにブロックをtrials個マイニングする
+    # 所要時間はナンスの運に左右されるので、比較にはハッシュレート(ops_per_sec)を使う
+    # make_transactionsはチェーンに入れられないので、ブロックは作らずに前ブロックのハッシュ値を毎回変える
+    results = {}
+    transactions = make_transactions(args.transactions)
+    block_chain = blockchain.BlockChain("benchmark")
+    for difficulty in args.difficulties:
+        latencies = []
+        attempts = 0
+        for trial in range(args.pow_trials):
+            previous_hash = blockchain.BlockChain.hash({"difficulty": difficulty, "trial": trial})
+            start = time.perf_counter()
+            nonce = block_chain.proof_of_work(
+                transactions, difficulty=difficulty, previous_hash=previous_hash
+            )
+            latencies.append(time.perf_counter() - start)
+            attempts += nonce + 1
+        result = summarize(latencies, operations=attempts)
+        result["blocks_per_sec"] = len(latencies) / sum(latencies)
+        results[f"proof_of_work[difficulty={difficulty}]"] = result
+    return results
+
+
+def run_signature(args):
+    sender, recipient = wallet.Wallet(), wallet.Wallet()
+    transactions = signed_transactions(sender, recipient.blockchain_address, args.repeat)
+    block_chain = blockchain.BlockChain("benchmark")
+    verified = []
+
+    def verify(transaction, signature):
+        verified.append(block_chain.verify_transaction_signature(
+            sender.public_key, signature, transaction
+        ))
+
+    latencies = measure(verify, transactions)
+    assert all(verified)
+
+    signers = [
+        (wallet.Transaction(
+            sender.private_key, sender.public_key, sender.blockchain_address,
+            recipient.blockchain_address, t.value, t.nonce,
+        ),)
+        for t, _ in transactions
+    ]
+    return {
+        "verify_transaction_signature": summarize(latencies),
+        "generate_signature": summarize(measure(lambda t: t.generate_signature(), signers)),
+    }
+
+
+def run_wallet(args):
+    return {"wallet": summarize(measure(wallet.Wallet, [()] * args.repeat))}
+
+
+def run_total_amount(args):
+    # チェーンの長さごとに、全アドレスの残高を問い合わせる
+    results = {}
+    for length in args.chain_lengths:
+        block_chain = blockchain.BlockChain("benchmark")
+        addresses = [f"address_{i}" for i in range(min(length, 100))]
+        for i in range(length - 1):
+            fund(block_chain, addresses[i % len(addresses)])
+        lookups = [(addresses[i % len(addresses)],) for i in range(args.repeat)]
+        results[f"calculate_total_amount[chain={length}]"] = summarize(
+            measure(block_chain.calculate_total_amount, lookups)
+        )
+    return results
+
+
+def run_post_transactions(args):
+    # Flaskのテストクライアントで POST /transactions をリクエストからレスポンスまで計測する
+    # 署名の作成は計測に含めない
+    import blockchain_server
+
+    sender, recipient = wallet.Wallet(), wallet.Wallet()
+    block_chain = blockchain.BlockChain("benchmark")
+    fund(block_chain, sender.blockchain_address, value=float(args.repeat))
+    blockchain_server.cache["blockchain"] = block_chain
+    client = blockchain_server.app.test_client()
+    bodies = [
+        {
+            "sender_blockchain_address": sender.blockchain_address,
+            "recipient_blockchain_address": recipient.blockchain_address,
+            "value": transaction.value,
+            "nonce": transaction.nonce,
+            "sender_public_key": sender.public_key,
+            "signature": signature,
+        }
+        for transaction, signature in signed_transactions(
+            sender, recipient.blockchain_address, args.repeat
+        )
+    ]
+    status_codes = []
+
+    def post(body):
+        status_codes.append(client.post("/transactions", json=body).status_code)
+
+    latencies = measure(post, [(body,) for body in bodies])
+    block_chain.gossip.stop()
+    blockchain_server.cache.clear()
+    assert all(code == 201 for code in status_codes), status_codes
+    return {"post_transactions": summarize(latencies)}
+
+
+BENCHMARKS = {
+    "proof_hasher": run_proof_hasher,
+    "proof_of_work": run_proof_of_work,
+    "signature": run_signature,
+    "wallet": run_wallet,
+    "total_amount": run_total_amount,
+    "post_transactions": run_post_transactions,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance=BENCHMARK_TOLERANCE):
+    # baselineよりops_per_secがtolerance以上下がった項目の名前を返す
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name, {}).get("ops_per_sec")
+        after = result.get("ops_per_sec")
+        if not before or not after:
+            continue
+        ratio = after / before
+        marker = "  REGRESSION" if ratio < 1 - tolerance else ""
+        print(f"{name:44}{ratio:6.2f}x{marker}")
+        if marker:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--only", nargs="+", choices=sorted(BENCHMARKS), default=list(BENCHMARKS),
+        help="benchmarks to run (default: all)"
+    )
+    parser.add_argument(
+        "-t", "--transactions", default=10, type=int, help="transactions per block"
+    )
+    parser.add_argument(
+        "-n", "--nonces", default=20000, type=int, help="nonces to hash per run"
+    )
+    parser.add_argument(
+        "-r", "--repeat", default=BENCHMARK_REPEAT, type=int, help="runs per benchmark"
+    )
+    parser.add_argument(
+        "--difficulties", nargs="+", default=BENCHMARK_DIFFICULTIES, type=int,
+        help="difficulties for proof_of_work"
+    )
+    parser.add_argument(
+        "--pow-trials", default=BENCHMARK_POW_TRIALS, type=int,
+        help="blocks to mine per difficulty"
+    )
+    parser.add_argument(
+        "--chain-lengths", nargs="+", default=BENCHMARK_CHAIN_LENGTHS, type=int,
+        help="chain lengths for calculate_total_amount"
+    )
+    parser.add_argument("-o", "--output", default=None, help="save results as JSON")
+    parser.add_argument(
+        "-b", "--baseline", default=None, help="compare with a previous JSON result"
+    )
+    parser.add_argument(
+        "--tolerance", default=BENCHMARK_TOLERANCE, type=float,
+        help="allowed slowdown against the baseline (0.2 = 20%%)"
+    )
+    args = parser.parse_args()
+
+    # マイニングなどのINFOログは計測の邪魔になるので出さない
+    logging.disable(logging.INFO)
+
+    results = {}
+    for name in args.only:
+        results.update(BENCHMARKS[name](args))
+
+    for name, result in results.items():
+        line = f"{name:44}{result['ops_per_sec']:>14,.1f} ops/sec"
+        if "p50_ms" in result:
+            line += f"  p50 {result['p50_ms']:.3f} ms  p95 {result['p95_ms']:.3f} ms"
+        if "speedup" in result:
+            line += f"  ({result['speedup']:.1f}x valid_header_proof)"
+        print(line)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "transactions": args.transactions,
+            "nonces": args.nonces,
+            "repeat": args.repeat,
+            "pow_trials": args.pow_trials,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
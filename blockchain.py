@@ -1,51 +1,290 @@
 # Python標準ライブラリ
+import atexit
+import collections
+import concurrent.futures
 import contextlib
+import functools
 import hashlib
+import itertools
 import json
 import enum
 import logging
+import math
+import multiprocessing
+import os
+import statistics
 import sys
 import time
 import threading
 
-# 外部ライブラリ
-from ecdsa import NIST256p
-from ecdsa import VerifyingKey
+# 外部ライブラリ（requestsとecdsaは読み込みに時間がかかるので、使う関数の中でimportする）
 
 # 自作ライブラリ
+import gossip
+import mempool
+import merkle
+import metrics
+import miner
+import models
+import state
+import txindex
 import utils
 
-MINING_DIFFICULTY = 3  # 何桁目までをゼロにするか
-MINING_SENDER = "THE BLOCKCHAIN"  # マイニング報酬の贈り元アドレス
-MINING_REWARD = 1.0  # マイニング報酬
+MINING_DIFFICULTY = 3  # 何桁目までをゼロにするか（初期値。以降はブロックの生成間隔から調整する）
+MIN_MINING_DIFFICULTY = 1
+MAX_MINING_DIFFICULTY = 8
+DIFFICULTY_ADJUSTMENT_INTERVAL = 10  # 難易度を調整するブロック数の間隔
+TARGET_BLOCK_TIME_SEC = 20  # 目標とするブロックの生成間隔
+MEDIAN_TIME_BLOCKS = 11  # タイムスタンプの下限（これらのタイムスタンプの中央値）を決める直前のブロック数
+MAX_FUTURE_BLOCK_TIME_SEC = 120  # タイムスタンプが現在時刻より先に進んでいてよい最大の秒数
+# ヘッダーの検証（難易度とタイムスタンプ）に使う直前のブロック数
+RECENT_BLOCKS = max(DIFFICULTY_ADJUSTMENT_INTERVAL + 1, MEDIAN_TIME_BLOCKS)
+MINING_SENDER = state.MINING_SENDER  # マイニング報酬の贈り元アドレス
+MINING_REWARD = state.MINING_REWARD  # マイニング報酬
 MINING_TIMER_SEC = 20
+MINING_HISTORY_SIZE = 100  # ハッシュレートなどの計算に使う直近のマイニングの記録数
+MAX_TRANSACTIONS_PER_BLOCK = 1000  # 1ブロックに含めるトランザクションの最大数
+MINING_WORKERS = os.cpu_count() or 1  # 並列マイニングのワーカープロセス数
+MINING_NONCE_CHUNK = 10000  # 1ワーカーが一度に探索するナンスの範囲
+
+VERIFY_WORKERS = os.cpu_count() or 1  # 署名検証のワーカープロセス数
+VERIFY_CHUNK_SIZE = 16  # ワーカーに一度に渡すトランザクション数（これ未満はその場で検証）
+VERIFYING_KEY_CACHE_SIZE = 4096  # パース済みの公開鍵を保持する最大数
+SIGNATURE_SIZE = 64  # NIST256pの署名(r, s)のバイト数
 
 BLOCKCHAIN_PORT_RANGE = (5100, 5103)
 NEIGHBOURS_IP_RANGE_NUM = (0, 1)
 BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC = 20
+CONSENSUS_TIMEOUT_SEC = 3  # 他ノードへのリクエストのタイムアウト
+CONSENSUS_PAGE_SIZE = 500  # 他ノードからブロックを取得する際の1リクエストあたりのブロック数
+HEADERS_PAGE_SIZE = 10000  # ヘッダーだけを取得する場合の1リクエストあたりのブロック数
+
+SNAPSHOT_INTERVAL = 100  # 状態のスナップショットを作るブロック数の間隔
+PRUNE_KEEP_BLOCKS = 200  # プルーニングする場合に、トランザクションを残しておく直近のブロック数
+FAST_SYNC_MIN_BLOCKS = SNAPSHOT_INTERVAL  # これ以上遅れている場合はスナップショットから同期する
+FAST_SYNC_MIN_PEERS = 2  # スナップショットを使うのに必要な、同じスナップショット（ハッシュ値）を返したノードの数
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
+# /metricsで出力する計測値
+PROOF_OF_WORK_SECONDS = metrics.Histogram(
+    "blockchain_proof_of_work_seconds", "Time spent in BlockChain.proof_of_work."
+)
+PROOF_OF_WORK_HASHES = metrics.Counter(
+    "blockchain_proof_of_work_hashes_total", "Nonces tried by successful proof of work."
+)
+VERIFY_SIGNATURE_SECONDS = metrics.Histogram(
+    "blockchain_verify_signature_seconds",
+    "Time spent verifying signatures (mode=single per transaction, mode=batch per batch).",
+)
+SIGNATURES_VERIFIED = metrics.Counter(
+    "blockchain_signatures_verified_total", "Verified transaction signatures by result."
+)
+CREATE_BLOCK_SECONDS = metrics.Histogram(
+    "blockchain_create_block_seconds", "Time spent in BlockChain.create_block."
+)
+FIND_NEIGHBOURS_SECONDS = metrics.Histogram(
+    "blockchain_find_neighbours_seconds", "Time spent scanning for neighbour nodes."
+)
+
+# 並列マイニングのワーカープロセスで共有する「発見済み」フラグ
+_found_event = None
+
+
+def _init_mining_worker(found_event):
+    global _found_event
+    _found_event = found_event
+
+
+def _search_nonce(args):
+    # ナンス空間をチャンクに分割し、worker_index番目から workers個おきのチャンクを探索する
+    # 例) workers=2の場合、ワーカー0は[0, chunk), [2*chunk, 3*chunk)...を担当
+    merkle_root, previous_hash, difficulty, worker_index, workers, chunk_size = args
+    hasher = ProofHasher(merkle_root, previous_hash, difficulty)
+    chunk_start = worker_index * chunk_size
+    while not _found_event.is_set():
+        nonce = hasher.search(chunk_start, chunk_start + chunk_size)
+        if nonce is not None:
+            # 他のワーカーに探索をやめさせる
+            _found_event.set()
+            return nonce
+        chunk_start += workers * chunk_size
+    return None
+
+
+@functools.lru_cache(maxsize=VERIFYING_KEY_CACHE_SIZE)
+def get_verifying_key(sender_public_key):
+    # 同じ送信者の公開鍵（bytes）を毎回パースしないようにキャッシュする
+    from ecdsa import NIST256p
+    from ecdsa import VerifyingKey
+
+    return VerifyingKey.from_string(sender_public_key, curve=NIST256p)
+
+
+def verify_signature(transaction):
+    # 署名済みのmodels.Transactionを、送信者の公開鍵を使って検証する
+    # 署名の対象は公開鍵と署名を除いたバイナリ形式のダイジェスト
+    from ecdsa import BadSignatureError
+    from ecdsa import NIST256p
+    from ecdsa.errors import MalformedPointError
+
+    message = hashlib.sha256(transaction.signing_bytes()).digest()
+    # 署名は(r, s)の64バイトで、sは位数の半分以下（low-S）のものだけを受け付ける
+    # (r, n - s)も同じメッセージの有効な署名になるため、そのままだとトランザクションIDを変えて再送できてしまう
+    signature = transaction.signature
+    if (
+        not isinstance(signature, bytes)
+        or len(signature) != SIGNATURE_SIZE
+        or int.from_bytes(signature[SIGNATURE_SIZE // 2:], "big") > NIST256p.order // 2
+    ):
+        logger.error({"action": "verify_signature", "error": "non_canonical_signature"})
+        return False
+    try:
+        return get_verifying_key(transaction.sender_public_key).verify(
+            transaction.signature, message
+        )
+    except (BadSignatureError, MalformedPointError, TypeError, ValueError) as ex:
+        logger.error({"action": "verify_signature", "ex": ex})
+        return False
+
+
+_verify_executor = None
+
+
+def verify_signatures_in_pool(transactions, workers=VERIFY_WORKERS):
+    # プロセスプールで検証する（計測値は記録しないので、呼び出し側で記録する）
+    global _verify_executor
+    if _verify_executor is None:
+        _verify_executor = concurrent.futures.ProcessPoolExecutor(max(workers, 1))
+        # インタープリター終了時にワーカープロセスを止める
+        atexit.register(_verify_executor.shutdown)
+    return list(_verify_executor.map(
+        verify_signature, transactions, chunksize=VERIFY_CHUNK_SIZE
+    ))
+
+
+def verify_signatures(transactions, workers=VERIFY_WORKERS, offload=False):
+    # 件数が多い場合はプロセスプールに分散して検証し、transactionsと同じ順で結果を返す
+    # offload=Trueの場合は件数によらずプロセスプールで検証する
+    # （ecdsaの検証はpure PythonでGILを握るので、リクエストを処理するスレッドを止めないようにする）
+    with VERIFY_SIGNATURE_SECONDS.time(mode="batch"):
+        if not offload and (workers <= 1 or len(transactions) < VERIFY_CHUNK_SIZE):
+            results = [verify_signature(t) for t in transactions]
+        else:
+            results = verify_signatures_in_pool(transactions, workers)
+    valid = sum(1 for result in results if result)
+    SIGNATURES_VERIFIED.inc(valid, result="valid")
+    SIGNATURES_VERIFIED.inc(len(results) - valid, result="invalid")
+    return results
+
+
+class ProofHasher(object):
+    # Proof of Workの内側のループ専用のハッシュ計算
+    # ヘッダーはナンスが末尾の固定長のバイナリ（models.Block.proof_prefix + 8バイトのナンス）なので、
+    # ナンスより前の部分のsha256状態を保持し、ナンスごとにcopy()してナンスだけを流し込む
+    def __init__(self, merkle_root, previous_hash, difficulty=MINING_DIFFICULTY):
+        self._prefix = hashlib.sha256(
+            models.Block.proof_prefix(previous_hash, merkle_root, difficulty)
+        )
+        # 16進数で先頭difficulty桁が0 ⇔ ダイジェストが 2**(256 - 4*difficulty) - 1 以下
+        # 同じ長さのbytes同士の比較は数値の大小比較と一致する
+        self._target = ((1 << (256 - 4 * difficulty)) - 1).to_bytes(32, "big")
+
+    def digest(self, nonce):
+        sha256 = self._prefix.copy()
+        sha256.update(models.NONCE.pack(nonce))
+        return sha256.digest()
+
+    def hexdigest(self, nonce):
+        # BlockChain.proof_hash(...)と同じ値になる
+        return self.digest(nonce).hex()
+
+    def is_valid(self, nonce):
+        return self.digest(nonce) <= self._target
+
+    def search(self, start, stop):
+        # [start, stop)の範囲でプルーフが成功する最初のナンスを返す（見つからなければNone）
+        prefix, pack, target = self._prefix, models.NONCE.pack, self._target
+        for nonce in range(start, stop):
+            sha256 = prefix.copy()
+            sha256.update(pack(nonce))
+            if sha256.digest() <= target:
+                return nonce
+        return None
+
 
 class BlockChain(object):
-    def __init__(self, blockchain_address=None, port=None):
-        self.transaction_pool = []
+    def __init__(
+        self, blockchain_address=None, port=None, store=None, offload=False, prune=False,
+        peers=None, host=None, trusted_snapshot=None,
+    ):
+        # チェーン・トランザクションプール・残高インデックスを書き換える処理はこのロックの中で行う
+        # Proof of Work、署名の検証、他ノードとの通信はロックの外で行い、他のリクエストを待たせない
+        self.lock = threading.RLock()
+        # offload=Trueの場合、署名の検証とマイニングを常にワーカープロセスで行う（本番サーバー用）
+        self.offload = offload
+        self.transaction_pool = mempool.TransactionPool()
+        # models.Blockのリスト
         self.chain = []
-        self.create_block(0, self.hash({}))
+        # 高さ→ハッシュ値、ハッシュ値→高さのインデックス
+        self.block_hashes = []
+        self.block_heights = {}
+        # 高さ→そのブロックまでの累積の仕事量（block_workの合計）。チェーンの比較に使う
+        self.chain_work = []
+        # 残高とナンスの状態（ブロックを追加するたびに更新する）
+        self.state = state.State()
+        # トランザクションID・アドレス→(高さ, 位置)のインデックス（ヘッダーだけのブロックは含まない）
+        self.tx_index = txindex.TransactionIndex()
+        # SNAPSHOT_INTERVALごとの高さでの状態（最新のものだけ）
+        self.snapshot = None
+        # スナップショットを作っているスレッド（最後に始めたもの）
+        self.snapshot_thread = None
+        # prune=Trueの場合、スナップショットを作るたびにPRUNE_KEEP_BLOCKSより古いブロックをヘッダーだけにする
+        self.prune = prune
+        # [0, pruned_height)のブロックはヘッダーだけ（トランザクションを持たない）
+        # これより前を巻き戻すチェーンの置き換えはできない
+        self.pruned_height = 0
+        # 運用者が確認したスナップショットのハッシュ値（state.Snapshot.hash()）
+        # 一致するスナップショットは、FAST_SYNC_MIN_PEERSに満たない数のノードからでも使う
+        self.trusted_snapshot = trusted_snapshot
+        # ブロックの永続化先（storage.BlockStore）。Noneの場合はメモリ上のみ
+        self.store = store
+        if self.store is not None and len(self.store):
+            self.load_chain()
+        else:
+            self.create_block(0, self.hash({}), difficulty=MINING_DIFFICULTY)
         self.blockchain_address = blockchain_address
         self.port = port
-        # Semaphore：並列処理を1つ実行させる
+        # 他のノードに知らせる自分のホスト（省略時はLANのIPアドレス）
+        self.host = host or utils.get_host()
+        # peers: 隣のノード（host:port）のリスト。指定した場合はLANを探索せずにこれを使う
+        # （1台のマシンで複数のノードを動かす場合など）
+        self.peers = list(peers) if peers is not None else None
+        # Semaphore：並列処理を1つ実行させる（/mineとマイニングスケジューラーが同時にマイニングしない）
         self.mining_semaphore = threading.Semaphore(1)
+        self.mining_scheduler = None
+        # 直近のマイニングの記録（難易度、試行回数、かかった時間）
+        self.mining_history = collections.deque(maxlen=MINING_HISTORY_SIZE)
         self.neighbours = []
         self.sync_neighbours_semaphore = threading.Semaphore(1)
+        self.resolve_conflicts_semaphore = threading.Semaphore(1)
+        # 新しいトランザクション・ブロックを隣のノードへ送る
+        self.gossip = gossip.Gossip(
+            lambda: self.neighbours,
+            source=f"{self.host}:{port}" if port else None,
+        )
 
+    @metrics.timed(FIND_NEIGHBOURS_SECONDS)
     def set_neighbours(self):
-        self.neighbours = utils.find_neighbours(
-            utils.get_host(), self.port,
-            NEIGHBOURS_IP_RANGE_NUM[0], NEIGHBOURS_IP_RANGE_NUM[1],
-            BLOCKCHAIN_PORT_RANGE[0], BLOCKCHAIN_PORT_RANGE[1]
-        )
+        if self.peers is not None:
+            self.neighbours = list(self.peers)
+        else:
+            self.neighbours = utils.find_neighbours_concurrent(
+                utils.get_host(), self.port,
+                NEIGHBOURS_IP_RANGE_NUM[0], NEIGHBOURS_IP_RANGE_NUM[1],
+                BLOCKCHAIN_PORT_RANGE[0], BLOCKCHAIN_PORT_RANGE[1]
+            )
         logger.info({'action': 'self_neighbours', 'neighbours': self.neighbours})
 
     def sync_neighbours(self):
@@ -53,31 +292,234 @@ class BlockChain(object):
         if is_acquire:
             with contextlib.ExitStack() as stack:
                 stack.callback(self.sync_neighbours_semaphore.release)
-                self.set_neighbours()
-                loop = threading.Timer(BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC, self.sync_neighbours)
-                loop.start()
+                try:
+                    self.set_neighbours()
+                    self.fast_sync()
+                    self.resolve_conflicts()
+                except Exception as ex:
+                    # 1回の同期に失敗しても、次の同期は予定どおり行う（スレッドが止まると以降は同期しなくなる）
+                    logger.exception({"action": "sync_neighbours", "ex": ex})
+                finally:
+                    loop = threading.Timer(
+                        BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC, self.sync_neighbours
+                    )
+                    loop.start()
+
+    def sync_neighbours_in_background(self, then=None):
+        # 隣のノードの探索と同期を別スレッドで行い、サーバーの起動（リクエストの受け付け）を待たせない
+        # then: 同期が終わってから（失敗した場合も）呼ぶ関数（同期してからマイニングを始める場合など）
+        def run():
+            try:
+                self.sync_neighbours()
+            finally:
+                if then is not None:
+                    then()
+
+        thread = threading.Thread(target=run, name="sync_neighbours", daemon=True)
+        thread.start()
+        return thread
 
-    def create_block(self, nonce, previous_hash):
+    def load_chain(self):
+        # 保存済みのブロックを1つずつ読み込んでチェーンと残高の状態を復元する
+        # スナップショットがあれば、その高さまではブロックを適用せずに状態をスナップショットから復元する
+        snapshot = self.store.load_snapshot()
+        if snapshot is not None:
+            self.snapshot = snapshot
+            self.state = snapshot.state.copy()
+        for height, (block_hash, block) in enumerate(self.store.iter_blocks()):
+            # ヘッダーだけのブロックは状態に反映できないので、スナップショットより前にしか置けない
+            # （途中で失敗したインポートなど）
+            if block.pruned and (snapshot is None or height > snapshot.height):
+                raise ValueError(f"block {height} is pruned but no snapshot covers it")
+            self.index_block(block, block_hash, apply=snapshot is None or height > snapshot.height)
+            self.chain.append(block)
+            if block.pruned:
+                self.pruned_height = height + 1
+        if snapshot is not None and self.block_hashes[snapshot.height] != snapshot.block_hash:
+            raise ValueError(f"snapshot at {snapshot.height} does not match the stored chain")
+        logger.info({"action": "load_chain", "height": len(self.chain),
+                     "snapshot_height": snapshot.height if snapshot else None})
+
+    def verify_chain(self):
+        # 保持しているハッシュ値を使わずに全ブロックのハッシュ値とマークルルートを計算し直し、
+        # メモリ上・保存先のブロックが改ざんされていないか確認する
+        # 戻り値: 最初に不一致が見つかった高さ（問題がなければNone）
+        # チェーンのコピーだけをロックの中で取り、計算はロックの外で行う
+        with self.lock:
+            blocks = list(self.chain)
+            block_hashes = list(self.block_hashes)
+            snapshot = self.snapshot
+        previous_hash = blocks[0].previous_hash
+        for height, (block, block_hash) in enumerate(zip(blocks, block_hashes)):
+            if block.previous_hash != previous_hash or block.compute_hash() != block_hash:
+                return height
+            if not block.pruned and block.merkle_root != merkle.merkle_root(
+                [t.compute_hash() for t in block.transactions]
+            ):
+                return height
+            previous_hash = block_hash
+        if snapshot is not None and block_hashes[snapshot.height] != snapshot.block_hash:
+            return snapshot.height
+        return None
+
+    @metrics.timed(CREATE_BLOCK_SECONDS)
+    def create_block(
+        self, nonce, previous_hash, transactions=(), merkle_root=None, difficulty=None
+    ):
         # 引数をまとめてブロックを作成
-        block = utils.sorted_dict_by_key(
-            {
-                "timestamp": time.time(),
-                "transactions": self.transaction_pool,
-                "nonce": nonce,
-                "previous_hash": previous_hash,
-            }
-        )
-        # ブロックをチェーンに追加
-        self.chain.append(block)
-        # トランザクションプールを初期化
-        self.transaction_pool = []
+        transactions = list(transactions)
+        if merkle_root is None:
+            merkle_root = self.merkle_root(transactions)
+        with self.lock:
+            if difficulty is None:
+                difficulty = self.next_difficulty()
+            # 時計が戻った場合も、他のノードが受け付けるタイムスタンプ（直前のブロックの中央値より後）にする
+            timestamp = time.time()
+            if self.chain:
+                timestamp = max(
+                    timestamp,
+                    math.nextafter(self.median_time(self.chain[-MEDIAN_TIME_BLOCKS:]), math.inf),
+                )
+            block = models.Block(
+                previous_hash, merkle_root, difficulty, nonce, timestamp, transactions
+            )
+            # ブロックをチェーンに追加
+            block_hash = block.hash()
+            self.index_block(block, block_hash)
+            self.chain.append(block)
+            height = len(self.chain) - 1
+            if self.store is not None:
+                self.store.append(height, block_hash, block)
+            if self.snapshot_due(height):
+                self.schedule_snapshot(height, block_hash)
         return block
 
-    def hash(self, block):
-        # ブロックからハッシュ値を生成
+    def index_block(self, block, block_hash, apply=True):
+        # チェーンの末尾に追加されたブロックを各インデックスに反映する
+        # apply=Falseの場合は状態に反映しない（スナップショットに含まれているブロック）
+        if apply and not self.state.apply_block(block, len(self.block_hashes)):
+            raise ValueError(f"block {block_hash} spends more than the balance or is a replay")
+        self.tx_index.add_block(len(self.block_hashes), block)
+        self.block_heights[block_hash] = len(self.block_hashes)
+        self.block_hashes.append(block_hash)
+        self.chain_work.append(self.total_work() + self.block_work(block))
+
+    @staticmethod
+    def block_work(block):
+        # ブロックを作るのに必要なハッシュ計算の期待値（難易度が1桁上がると16倍）
+        return 16 ** block.difficulty
+
+    def total_work(self, height=None):
+        # height番目のブロックまでの累積の仕事量（省略時はチェーン全体、height=-1は0）
+        if height is None:
+            height = len(self.chain_work) - 1
+        return self.chain_work[height] if height >= 0 else 0
+
+    @staticmethod
+    def snapshot_due(height):
+        return height > 0 and height % SNAPSHOT_INTERVAL == 0
+
+    def schedule_snapshot(self, height, block_hash, base=None):
+        # height番目のブロックまでの状態のスナップショットを別スレッドで作る（ロックの中で呼ぶ）
+        # 状態のコピーとシリアライズはアカウント数に比例するので、ロックの中では行わない
+        # 代わりに、ロックの中では前のスナップショット(base)とそれ以降のブロックの参照だけを取り、
+        # ロックの外でbaseの状態にブロックを適用し直す（ブロックは作成後に書き換えないので、参照だけでよい）
+        if base is None:
+            base = self.snapshot
+        if base is not None and (
+            base.height >= len(self.block_hashes)
+            or self.block_hashes[base.height] != base.block_hash
+        ):
+            base = None
+        start = 0 if base is None else base.height + 1
+        blocks = self.chain[start:height + 1]
+        if any(block.pruned for block in blocks):
+            logger.error({"action": "schedule_snapshot", "error": "pruned", "height": height})
+            return
+        self.snapshot_thread = threading.Thread(
+            target=self.build_snapshot, args=(base, blocks, height, block_hash),
+            name="snapshot", daemon=True,
+        )
+        self.snapshot_thread.start()
+
+    def build_snapshot(self, base, blocks, height, block_hash):
+        built = state.State() if base is None else base.state.copy()
+        for block_height, block in enumerate(blocks, height + 1 - len(blocks)):
+            built.apply_block(block, block_height)
+        snapshot = state.Snapshot(height, block_hash, built)
+        # シリアライズした結果はSnapshotが保持するので、保存（save_snapshot）ではシリアライズし直さない
+        snapshot.to_bytes()
+        with self.lock:
+            # 作っている間にチェーンが置き換えられた場合や、より新しいものがすでにある場合は捨てる
+            if height >= len(self.block_hashes) or self.block_hashes[height] != block_hash:
+                return
+            if self.snapshot is not None and self.snapshot.height >= height:
+                return
+            self.save_snapshot(snapshot)
+
+    def save_snapshot(self, snapshot):
+        # 最新のスナップショットとして保持・保存し、プルーニングする場合は古いブロックをヘッダーだけにする
+        self.snapshot = snapshot
+        if self.store is not None:
+            self.store.save_snapshot(snapshot)
+        logger.info({"action": "save_snapshot", "height": snapshot.height,
+                     "addresses": len(snapshot.state.balances)})
+        if self.prune:
+            self.prune_blocks(snapshot.height + 1 - PRUNE_KEEP_BLOCKS)
+
+    def prune_blocks(self, height):
+        # height未満のブロックのトランザクションを削除し、ヘッダーだけを残す
+        # （それより前の状態はスナップショットに含まれているので、ブロックの適用にも検証にも使わない）
+        if height <= self.pruned_height:
+            return
+        pruned = []
+        for h in range(self.pruned_height, height):
+            self.tx_index.remove_block(h, self.chain[h])
+            self.chain[h] = self.chain[h].header()
+            pruned.append((h, self.chain[h]))
+        if self.store is not None:
+            self.store.prune(pruned)
+        self.pruned_height = height
+        logger.info({"action": "prune_blocks", "pruned_height": height})
+
+    def get_block(self, height=None, block_hash=None):
+        # 高さまたはハッシュ値からブロックを取得する（見つからなければNone）
+        if block_hash is not None:
+            height = self.block_heights.get(block_hash)
+        if height is None or not 0 <= height < len(self.chain):
+            return None
+        return self.chain[height]
+
+    @staticmethod
+    def hash(block):
+        # 辞書からハッシュ値を生成（ジェネシスブロックの前ブロックのハッシュ値にだけ使う）
         sorted_block = json.dumps(block, sort_keys=True)
         return hashlib.sha256(sorted_block.encode()).hexdigest()
 
+    @staticmethod
+    def merkle_root(transactions):
+        return merkle.merkle_root([t.hash() for t in transactions])
+
+    @staticmethod
+    def proof_hash(merkle_root, previous_hash, nonce, difficulty=MINING_DIFFICULTY):
+        # Proof of Workの対象となるヘッダー（models.Blockのヘッダーのナンスまで）のハッシュ値
+        # トランザクションはマークルルートとしてだけ含めるので、件数によらず大きさが一定になる
+        header = models.Block.proof_prefix(previous_hash, merkle_root, difficulty)
+        return hashlib.sha256(header + models.NONCE.pack(nonce)).hexdigest()
+
+    def transaction_proof(self, height, index):
+        # height番目のブロックのindex番目のトランザクションについてマークル証明を返す
+        block = self.get_block(height=height)
+        if block is None or block.pruned or not 0 <= index < len(block.transactions):
+            return None
+        tx_hashes = [t.hash() for t in block.transactions]
+        return {
+            "transaction": block.transactions[index].to_dict(),
+            "transaction_hash": tx_hashes[index],
+            "merkle_root": block.merkle_root,
+            "proof": merkle.merkle_proof(tx_hashes, index),
+        }
+
     def add_transaction(
         self,
         sender_blockchain_address,
@@ -85,32 +527,91 @@ class BlockChain(object):
         value,
         sender_public_key=None,
         signature=None,
+        nonce=0,
     ):
+        # 報酬はマイニング（_mining）でブロックを作るときにだけ入れる。外から送られてきたものは受け付けない
+        if sender_blockchain_address == MINING_SENDER:
+            logger.error({'action': 'add_transaction', 'error': 'reward'})
+            return False
+        if not models.Transaction.valid_nonce(nonce):
+            logger.error({'action': 'add_transaction', 'error': 'invalid_nonce'})
+            return False
+        if not models.Transaction.valid_fields(
+            sender_blockchain_address, recipient_blockchain_address, value
+        ):
+            logger.error({'action': 'add_transaction', 'error': 'invalid_field'})
+            return False
+
         # 引数をまとめてトランザクションを作成
-        transaction = utils.sorted_dict_by_key(
-            {
-                "sender_blockchain_address": sender_blockchain_address,
-                "recipient_blockchain_address": recipient_blockchain_address,
-                "value": float(value),
-            }
+        transaction = self.build_transaction(
+            sender_blockchain_address, recipient_blockchain_address, value, nonce
         )
 
-        # 送信元がブロックチェーンの場合はトランザクションプールに格納
-        if sender_blockchain_address == MINING_SENDER:
-            self.transaction_pool.append(transaction)
-            return True
-
         # トランザクション署名が検証できた場合はトランザクションプールに格納
         if self.verify_transaction_signature(sender_public_key, signature, transaction):
+            return self.append_transaction(
+                self.signed_transaction(transaction, sender_public_key, signature)
+            )
+        return False
 
-            # # 送信者のアドレスに十分なBTCがない場合はエラー
-            # if self.calculate_total_amount(sender_blockchain_address) < float(value):
-            #     logger.error({'action': 'add_transaction', 'error': 'no_value'})
-            #     return False
+    def add_transactions(self, transactions, source=None):
+        # 複数のトランザクションの署名をまとめて（並列に）検証してからプールに格納する
+        # transactions: add_transactionの引数名をキーに持つ辞書のリスト
+        # source: 送ってきたノード（そのノードには送り返さない）
+        # 戻り値: transactionsと同じ順の結果（True/False）のリスト
+        built = []
+        for t in transactions:
+            try:
+                built.append(models.Transaction.from_dict(t))
+            except (KeyError, TypeError, ValueError):
+                # 公開鍵・署名が16進数でないものなどは検証せずに失敗とする
+                built.append(None)
+        signed = [t for t in built if t is not None]
+        verified = iter(verify_signatures(signed, offload=self.offload))
+        if source is not None:
+            self.gossip.mark_seen(source, [t.hash() for t in signed])
+        return [
+            transaction is not None
+            and next(verified)
+            and self.append_transaction(transaction)
+            for transaction in built
+        ]
 
-            self.transaction_pool.append(transaction)
-            return True
-        return False
+    @staticmethod
+    def build_transaction(
+        sender_blockchain_address, recipient_blockchain_address, value, nonce=0
+    ):
+        return models.Transaction(
+            sender_blockchain_address, recipient_blockchain_address, value, nonce=nonce
+        )
+
+    @staticmethod
+    def signed_transaction(transaction, sender_public_key, signature):
+        # ブロックには公開鍵と署名も含め、他のノードが署名を検証し直せるようにする
+        # sender_public_key, signature: 16進数の文字列
+        return transaction.with_signature(
+            bytes().fromhex(sender_public_key), bytes().fromhex(signature)
+        )
+
+    def append_transaction(self, transaction):
+        with self.lock:
+            # 送金額が正でない、確定済みのナンスの再使用（二重使用）、
+            # 送信者のアドレスに（プールにある送金を差し引いて）十分なBTCがない場合はエラー
+            error = self.state.check_transaction(
+                transaction,
+                self.transaction_pool.spending(transaction.sender_blockchain_address),
+            )
+            if error is not None:
+                logger.error({'action': 'add_transaction', 'error': error})
+                return False
+
+            # 重複やプールの上限超過の場合は格納しない
+            tx_hash = self.transaction_pool.add(transaction)
+            if tx_hash is None:
+                return False
+        # 新しく受け付けたトランザクションだけを隣のノードへ送る
+        self.gossip.broadcast_transaction(tx_hash, transaction)
+        return True
 
     def create_transaction(
         self,
@@ -119,46 +620,45 @@ class BlockChain(object):
         value,
         sender_public_key,
         signature,
+        nonce=0,
     ):
+        # 受け付けたトランザクションはappend_transactionから隣のノードへ送られる
         is_transacted = self.add_transaction(
             sender_blockchain_address,
             recipient_blockchain_address,
             value,
             sender_public_key,
             signature,
+            nonce,
         )
-
-        # TODO
-        # Sync 127.0.0.1:5001
-
         return is_transacted
 
     def verify_transaction_signature(self, sender_public_key, signature, transaction):
-        # トランザクションをダイジェスト
-        sha256 = hashlib.sha256()
-        sha256.update(str(transaction).encode("utf-8"))
-        message = sha256.digest()
-        # 署名を16進数からバイト形式に変換
-        signature_bytes = bytes().fromhex(signature)
-        # 送信者の公開鍵を使って検証する
-        verifying_key = VerifyingKey.from_string(
-            bytes().fromhex(sender_public_key), curve=NIST256p
-        )
-        verified_key = verifying_key.verify(signature_bytes, message)
-        return verified_key
-
-    def valid_proof(
-        self, transactions, previous_hash, nonce, difficulty=MINING_DIFFICULTY
-    ):
-        # ブロックを生成してハッシュ値を作成
-        guess_block = utils.sorted_dict_by_key(
-            {
-                "transactions": transactions,
-                "nonce": nonce,
-                "previous_hash": previous_hash,
-            }
+        # sender_public_key, signature: 16進数の文字列、transaction: 署名前のmodels.Transaction
+        with VERIFY_SIGNATURE_SECONDS.time(mode="single"):
+            try:
+                transaction = self.signed_transaction(transaction, sender_public_key, signature)
+                # offloadの場合もverify_signaturesは使わない（mode="batch"の計測と件数が二重に記録されるため）
+                if self.offload:
+                    is_verified = verify_signatures_in_pool([transaction])[0]
+                else:
+                    is_verified = verify_signature(transaction)
+            except (TypeError, ValueError) as ex:
+                logger.error({"action": "verify_signature", "ex": ex})
+                is_verified = False
+        SIGNATURES_VERIFIED.inc(result="valid" if is_verified else "invalid")
+        return is_verified
+
+    @staticmethod
+    def valid_proof(transactions, previous_hash, nonce, difficulty=MINING_DIFFICULTY):
+        return BlockChain.valid_header_proof(
+            BlockChain.merkle_root(transactions), previous_hash, nonce, difficulty
         )
-        guess_hash = self.hash(guess_block)
+
+    @staticmethod
+    def valid_header_proof(merkle_root, previous_hash, nonce, difficulty=MINING_DIFFICULTY):
+        # ヘッダーを生成してハッシュ値を作成
+        guess_hash = BlockChain.proof_hash(merkle_root, previous_hash, nonce, difficulty)
         return guess_hash[:difficulty] == "0" * difficulty
         # # ハッシュ値の冒頭の0がdifficulty個連続しているか確認
         # is_proved = guess_hash[:difficulty] == "0" * difficulty
@@ -166,61 +666,636 @@ class BlockChain(object):
         #     print("proved_hash:", guess_hash)
         # return is_proved
 
-    def proof_of_work(self):
+    def select_transactions(self):
+        # 次のブロックに含めるトランザクションを優先度順に選ぶ
+        # チェーンの付け替えで残高が足りなくなったものなどはプールから取り除く
+        tx_hashes = self.transaction_pool.select(MAX_TRANSACTIONS_PER_BLOCK)
+        transactions, invalid = self.state.select(
+            [self.transaction_pool.get(h) for h in tx_hashes]
+        )
+        if invalid:
+            self.transaction_pool.remove(t.hash() for t in invalid)
+            logger.info({"action": "select_transactions", "dropped": len(invalid)})
+        return [t.hash() for t in transactions], transactions
+
+    @staticmethod
+    def expected_difficulty(height, recent_blocks):
+        # height番目のブロックの難易度を、直前のブロック（recent_blocksの末尾）までの生成間隔から決める
+        # DIFFICULTY_ADJUSTMENT_INTERVALブロックごとに、平均の生成間隔が目標の1/4未満なら1桁上げ、
+        # 4倍を超えたら1桁下げる（1桁で16倍変わるため）
+        # recent_blocks: 直前のDIFFICULTY_ADJUSTMENT_INTERVAL + 1個以上のブロック
+        difficulty = recent_blocks[-1].difficulty
+        if height % DIFFICULTY_ADJUSTMENT_INTERVAL or height <= DIFFICULTY_ADJUSTMENT_INTERVAL:
+            return difficulty
+        window = recent_blocks[-(DIFFICULTY_ADJUSTMENT_INTERVAL + 1):]
+        average = (window[-1].timestamp - window[0].timestamp) / DIFFICULTY_ADJUSTMENT_INTERVAL
+        if average < TARGET_BLOCK_TIME_SEC / 4:
+            difficulty += 1
+        elif average > TARGET_BLOCK_TIME_SEC * 4:
+            difficulty -= 1
+        return max(MIN_MINING_DIFFICULTY, min(MAX_MINING_DIFFICULTY, difficulty))
+
+    @staticmethod
+    def median_time(recent_blocks):
+        return statistics.median(block.timestamp for block in recent_blocks[-MEDIAN_TIME_BLOCKS:])
+
+    @staticmethod
+    def valid_timestamp(timestamp, recent_blocks, now):
+        # タイムスタンプは直前MEDIAN_TIME_BLOCKS個のブロックの中央値より後で、現在時刻+MAX_FUTURE_BLOCK_TIME_SEC未満
+        # 難易度はタイムスタンプの間隔から決まるので、タイムスタンプをずらして難易度を下げられないようにする
+        # recent_blocks: 直前のブロック（末尾が1つ前）
+        return BlockChain.median_time(recent_blocks) < timestamp < now + MAX_FUTURE_BLOCK_TIME_SEC
+
+    def next_difficulty(self):
+        # 次に追加するブロックの難易度
+        if not self.chain:
+            return MINING_DIFFICULTY
+        return self.expected_difficulty(
+            len(self.chain), self.chain[-(DIFFICULTY_ADJUSTMENT_INTERVAL + 1):]
+        )
+
+    @metrics.timed(PROOF_OF_WORK_SECONDS)
+    def proof_of_work(
+        self, transactions=None, parallel=False, workers=MINING_WORKERS,
+        difficulty=None, cancel_event=None, previous_hash=None
+    ):
         # トランザクションと前ブロックのハッシュ値を取得
-        transactions = self.transaction_pool.copy()
-        previous_hash = self.hash(self.chain[-1])
-        nonce = 0
-        is_proved = False
-        # プルーフが成功するまでの回数をナンスとする
-        while is_proved is False:
-            is_proved = self.valid_proof(transactions, previous_hash, nonce)
-            nonce += 1
+        # cancel_eventがセットされた場合は探索をやめてNoneを返す
+        # parallel=Trueの場合はワーカープロセスで探索する（1プロセスでもこのプロセスのGILを使わない）
+        if transactions is None:
+            _, transactions = self.select_transactions()
+        if difficulty is None:
+            difficulty = self.next_difficulty()
+        merkle_root = self.merkle_root(transactions)
+        if previous_hash is None:
+            previous_hash = self.block_hashes[-1]
+        if parallel:
+            return self.parallel_proof_of_work(
+                merkle_root, previous_hash, workers, difficulty, cancel_event=cancel_event
+            )
+        hasher = ProofHasher(merkle_root, previous_hash, difficulty)
+        start = 0
+        # プルーフが成功したナンスを返す
+        while cancel_event is None or not cancel_event.is_set():
+            nonce = hasher.search(start, start + MINING_NONCE_CHUNK)
+            if nonce is not None:
+                return nonce
+            start += MINING_NONCE_CHUNK
+        return None
+
+    def parallel_proof_of_work(
+        self, merkle_root, previous_hash, workers=MINING_WORKERS,
+        difficulty=MINING_DIFFICULTY, chunk_size=MINING_NONCE_CHUNK, cancel_event=None
+    ):
+        # ナンス空間をワーカープロセスで分担し、最初に見つかったナンスを採用する
+        # ワーカーに渡すのは固定長のヘッダー部分だけで、トランザクションは渡さない
+        found_event = multiprocessing.Event()
+        tasks = [
+            (merkle_root, previous_hash, difficulty, i, workers, chunk_size)
+            for i in range(workers)
+        ]
+        nonce = None
+        with multiprocessing.Pool(
+            workers, initializer=_init_mining_worker, initargs=(found_event,)
+        ) as pool:
+            results = pool.imap_unordered(_search_nonce, tasks)
+            for _ in range(workers):
+                # キャンセルされていないか確認しながら結果を待つ
+                while nonce is None:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return None
+                    try:
+                        nonce = results.next(timeout=0.1)
+                        break
+                    except multiprocessing.TimeoutError:
+                        continue
+                if nonce is not None:
+                    break
+            # withを抜けるとterminate()され、残りのワーカーも停止する
         return nonce
 
-    def mining(self):
+    def mining(self, parallel=False, allow_empty=False, cancel_event=None):
+        # 同時に実行しない（実行中なら何もしない）
+        is_acquire = self.mining_semaphore.acquire(blocking=False)
+        if not is_acquire:
+            return False
+        with contextlib.ExitStack() as stack:
+            stack.callback(self.mining_semaphore.release)
+            return self._mining(parallel or self.offload, allow_empty, cancel_event)
+
+    def _mining(self, parallel, allow_empty, cancel_event):
         # ビットコインではトランザクションがなくてもマイニングが実行される（実際はトランザクションがないということがない）
         # 今回はマイニングAPIの動きを確認するため、トランザクションがないとマイニングが実行されないとしておく
-        if not self.transaction_pool:
+        # （マイニングスケジューラーが一定時間ごとに実行する場合はallow_empty=Trueで報酬だけのブロックも作る）
+        if not self.transaction_pool and not allow_empty:
             return False
 
-        # トランザクションの生成
-        self.add_transaction(
-            sender_blockchain_address=MINING_SENDER,
-            recipient_blockchain_address=self.blockchain_address,
-            value=MINING_REWARD,
-        )
-        # ナンスの生成（Proof of Workの結果）
-        nonce = self.proof_of_work()
-        # 前ブロックのハッシュ値を取得
-        previous_hash = self.hash(self.chain[-1])
-        # ブロックを生成
-        self.create_block(nonce, previous_hash)
+        # 次のブロックに含めるトランザクションと、つなげる先（現在の先端）を決める
+        with self.lock:
+            tx_hashes, transactions = self.select_transactions()
+            difficulty = self.next_difficulty()
+            previous_hash = self.block_hashes[-1]
+            height = len(self.chain)
+        # 報酬のトランザクションはプールを通さず、ブロックの先頭に入れる（ナンスはブロックの高さ）
+        reward = models.Transaction(
+            MINING_SENDER, self.blockchain_address, MINING_REWARD, nonce=height
+        )
+        transactions = [reward] + transactions
+        # ナンスの生成（Proof of Workの結果）。ロックの外で行い、その間もトランザクションを受け付ける
+        started = time.perf_counter()
+        nonce = self.proof_of_work(
+            transactions, parallel=parallel, difficulty=difficulty,
+            cancel_event=cancel_event, previous_hash=previous_hash,
+        )
+        if nonce is None:
+            return False
+        PROOF_OF_WORK_HASHES.inc(nonce + 1)
+        # ハッシュレートの計測用に記録する（並列の場合、試行回数はナンスからの概算）
+        self.mining_history.append(
+            {
+                "height": height,
+                "difficulty": difficulty,
+                "attempts": nonce + 1,
+                "seconds": time.perf_counter() - started,
+            }
+        )
+        with self.lock:
+            # マイニング中に他のノードのブロックを取り込んで先端が変わった場合は、このブロックは捨てる
+            if self.block_hashes[-1] != previous_hash:
+                logger.info({"action": "mining", "status": "stale"})
+                return False
+            # ブロックを生成し、含めたトランザクションをプールから取り除く
+            block = self.create_block(
+                nonce, previous_hash, transactions, difficulty=difficulty
+            )
+            self.transaction_pool.remove(tx_hashes)
+        # 隣のノードへ新しいブロックを送る
+        self.gossip.broadcast_block(self.block_hashes[-1], block)
         # マイニングの結果をログ出力
         logger.info({"action": "mining", "status": "success"})
         return True
 
-    def start_mining(self):
-        # 待ち状態（＝blockingされる状態）にならずに取得する
-        is_acquire = self.mining_semaphore.acquire(blocking=False)
-        if is_acquire:
-            with contextlib.ExitStack() as stack:
-                # 詳細はpython入門講座で解説↓
-                stack.callback(self.mining_semaphore.release)
-                self.mining() # ブロックチェーンだと約10minで設定されているが、今回は20秒
-                loop = threading.Timer(MINING_TIMER_SEC, self.start_mining)
+    def start_mining(self, parallel=False, max_wait_sec=None):
+        # バックグラウンドでマイニングを続ける（すでに実行中ならFalse）
+        # 以前はthreading.Timerをstart()しておらず1回しかマイニングされなかった
+        # max_wait_sec: プールが少なくても（空でも）マイニングするまでの最大待ち時間
+        if self.mining_scheduler is None:
+            self.mining_scheduler = miner.MiningScheduler(self)
+        self.mining_scheduler.parallel = parallel
+        if max_wait_sec is not None:
+            self.mining_scheduler.max_wait_sec = max_wait_sec
+        return self.mining_scheduler.start()
+
+    def stop_mining(self):
+        if self.mining_scheduler is None:
+            return False
+        return self.mining_scheduler.stop()
+
+    def request_peer(self, neighbour, path, raw=False, **params):
+        # raw=Trueの場合はJSONとして解釈せずにバイト列を返す
+        import requests
+
+        response = requests.get(
+            f"http://{neighbour}{path}", params=params, timeout=CONSENSUS_TIMEOUT_SEC
+        )
+        response.raise_for_status()
+        if raw:
+            return response.content
+        return response.json(object_pairs_hook=collections.OrderedDict)
+
+    def peer_block_hash(self, neighbour, height):
+        block_hashes = self.request_peer(
+            neighbour, "/chain/hashes", from_height=height, limit=1
+        )["hashes"]
+        return block_hashes[0] if block_hashes else None
+
+    def find_common_ancestor(self, neighbour, peer_height):
+        # 他ノードのチェーンと共通する最後のブロックの高さを返す（共通部分がなければ-1）
+        # ハッシュ値は前のブロックすべてに依存するので、ある高さで一致すればそれ以前もすべて一致する
+        # → 二分探索で、ハッシュ値を1つずつO(log n)回だけ問い合わせる
+        high = min(len(self.chain), peer_height) - 1
+        # よくあるケース（相手が自分のチェーンを延長しているだけ）は1回で判定する
+        if self.peer_block_hash(neighbour, high) == self.block_hashes[high]:
+            return high
+        low, high = 0, high - 1
+        ancestor = -1
+        while low <= high:
+            middle = (low + high) // 2
+            if self.peer_block_hash(neighbour, middle) == self.block_hashes[middle]:
+                ancestor = middle
+                low = middle + 1
+            else:
+                high = middle - 1
+        return ancestor
+
+    def fetch_blocks(self, neighbour, from_height, to_height, headers=False):
+        # [from_height, to_height)のブロックをページ単位で（バイナリ形式で）取得する
+        # headers=Trueの場合はヘッダーだけのブロックを取得する
+        params = {"headers": 1} if headers else {}
+        blocks = []
+        while from_height + len(blocks) < to_height:
+            page = models.decode_blocks(self.request_peer(
+                neighbour, "/chain", raw=True, format="binary",
+                from_height=from_height + len(blocks),
+                limit=min(
+                    HEADERS_PAGE_SIZE if headers else CONSENSUS_PAGE_SIZE,
+                    to_height - from_height - len(blocks),
+                ),
+                **params,
+            ))
+            if not page:
+                break
+            blocks.extend(page)
+        return blocks
+
+    def recent_blocks_at(self, ancestor):
+        # ancestorまでの直前のブロック（難易度とタイムスタンプの検証に使う。ロックの中で呼ぶ）
+        if ancestor < 0:
+            return []
+        return self.chain[max(0, ancestor + 1 - RECENT_BLOCKS):ancestor + 1]
+
+    def valid_headers(self, ancestor, blocks, recent_blocks=None):
+        # 共通のブロック(ancestor)より後ろのblocksのヘッダーだけを検証する
+        # （前のブロックとのつながり、難易度、タイムスタンプ、Proof of Work。ヘッダーだけのブロックでもよい）
+        # recent_blocks: ロックの中で取ったrecent_blocks_at(ancestor)。指定すればロックの外で呼べる
+        # 戻り値: 各ブロックのハッシュ値のリスト（検証に失敗した場合はNone）
+        if not blocks:
+            return None
+        if recent_blocks is None:
+            recent_blocks = self.recent_blocks_at(ancestor)
+        recent_blocks = collections.deque(recent_blocks, maxlen=RECENT_BLOCKS)
+        if ancestor >= 0:
+            previous_hash = recent_blocks[-1].hash()
+        else:
+            # ジェネシスブロックから異なる場合（自分のジェネシスブロックと同じ内容でなければならない）
+            genesis = blocks[0]
+            if (
+                genesis.previous_hash != self.chain[0].previous_hash
+                or genesis.merkle_root != self.chain[0].merkle_root
+                or genesis.transactions
+                or genesis.difficulty != MINING_DIFFICULTY
+            ):
+                return None
+            previous_hash = genesis.hash()
+            recent_blocks.append(genesis)
+            blocks = blocks[1:]
+        height = ancestor + 1 if ancestor >= 0 else 1
+
+        block_hashes = [] if ancestor >= 0 else [previous_hash]
+        now = time.time()
+        for block in blocks:
+            if block.previous_hash != previous_hash:
+                return None
+            # 難易度は直前のブロックの生成間隔から決まる値でなければならない
+            if block.difficulty != self.expected_difficulty(height, list(recent_blocks)):
+                return None
+            if not self.valid_timestamp(block.timestamp, list(recent_blocks), now):
+                return None
+            if not self.valid_header_proof(
+                block.merkle_root, block.previous_hash, block.nonce, block.difficulty
+            ):
+                return None
+            previous_hash = block.hash()
+            block_hashes.append(previous_hash)
+            recent_blocks.append(block)
+            height += 1
+        return block_hashes
+
+    def valid_chain_suffix(self, ancestor, blocks, recent_blocks=None):
+        # 共通のブロック(ancestor)より後ろのblocksを、トランザクションまで含めて検証する
+        # 報酬の数と額、残高、二重使用はreplace_chainでState.apply_blockが確認する
+        # recent_blocksを渡せばロックの外で検証できる（署名の検証の間、他のリクエストを待たせない）
+        # 戻り値: (検証結果, 各ブロックのハッシュ値)
+        block_hashes = self.valid_headers(ancestor, blocks, recent_blocks)
+        if block_hashes is None:
+            return False, None
+        signed = []
+        for block in blocks:
+            # ヘッダーだけのブロック（プルーニングしたノードから取得したもの）は検証できない
+            if block.pruned:
+                return False, None
+            transactions = block.transactions
+            if block.merkle_root != self.merkle_root(transactions):
+                return False, None
+            for transaction in transactions:
+                if transaction.sender_blockchain_address != MINING_SENDER:
+                    signed.append(transaction)
+
+        # 署名の検証は最も重いので、最後にまとめてワーカープロセスに分散する
+        if not all(verify_signatures(signed, offload=self.offload)):
+            return False, None
+        return True, block_hashes
+
+    def replace_chain(self, ancestor, blocks, block_hashes):
+        # ancestorより後ろを相手のブロックに置き換える
+        # 残高の状態は、自分のブロックを新しい順に取り消してから相手のブロックを適用する
+        # 途中で残高不足や二重使用が見つかった場合は元に戻してFalseを返す（チェーンは変えない）
+        if ancestor + 1 < self.pruned_height:
+            logger.error({"action": "replace_chain", "error": "pruned",
+                          "ancestor": ancestor, "pruned_height": self.pruned_height})
+            return False
+        orphaned = self.chain[ancestor + 1:]
+        for block in reversed(orphaned):
+            self.state.rollback_block(block)
+        # スナップショットが取り消すブロックにある場合は、共通のブロックの時点の状態をスナップショットにする
+        # （付け替えがスナップショットより前に及ぶ場合だけなので、ここではロックの中でコピーする）
+        # ジェネシスブロックから置き換える場合（ancestor=-1）は共通のブロックがないので、スナップショットを捨てる
+        base = None
+        drop_snapshot = False
+        if self.snapshot is not None and self.snapshot.height > ancestor:
+            if ancestor < 0:
+                drop_snapshot = True
+            else:
+                base = state.Snapshot(ancestor, self.block_hashes[ancestor], self.state.copy())
+        applied = []
+        snapshot_height = None
+        for height, (block, block_hash) in enumerate(zip(blocks, block_hashes), ancestor + 1):
+            if not self.state.apply_block(block, height):
+                for applied_block in reversed(applied):
+                    self.state.rollback_block(applied_block)
+                for orphaned_height, orphaned_block in enumerate(orphaned, ancestor + 1):
+                    self.state.apply_block(orphaned_block, orphaned_height)
+                return False
+            applied.append(block)
+            # 置き換える範囲にスナップショットの高さがあれば、新しいチェーンの状態で作り直す
+            if self.snapshot_due(height):
+                snapshot_height = height
+
+        for height in reversed(range(ancestor + 1, len(self.chain))):
+            self.tx_index.remove_block(height, self.chain[height])
+        del self.chain[ancestor + 1:]
+        for block_hash in self.block_hashes[ancestor + 1:]:
+            del self.block_heights[block_hash]
+        del self.block_hashes[ancestor + 1:]
+        del self.chain_work[ancestor + 1:]
+        if self.store is not None:
+            self.store.truncate(ancestor + 1)
+
+        confirmed = set()
+        for block, block_hash in zip(blocks, block_hashes):
+            self.tx_index.add_block(len(self.chain), block)
+            self.chain.append(block)
+            self.block_heights[block_hash] = len(self.block_hashes)
+            self.block_hashes.append(block_hash)
+            self.chain_work.append(self.total_work() + self.block_work(block))
+            if self.store is not None:
+                self.store.append(len(self.chain) - 1, block_hash, block)
+            confirmed.update(t.hash() for t in block.transactions)
+        # 取り込まれたトランザクションはプールから取り除く
+        self.transaction_pool.remove(confirmed)
+        if base is not None:
+            self.save_snapshot(base)
+        elif drop_snapshot:
+            self.snapshot = None
+            if self.store is not None:
+                self.store.delete_snapshot()
+        if snapshot_height is not None:
+            self.schedule_snapshot(snapshot_height, self.block_hashes[snapshot_height], base)
+        self.requeue_transactions(orphaned)
+        return True
+
+    def requeue_transactions(self, orphaned):
+        # 取り消されたブロックのトランザクションはプールに戻す（新しいチェーンでナンスが使われておらず、残高が足りるものだけ）
+        for block in orphaned:
+            if block.pruned:
+                continue
+            for transaction in block.transactions:
+                if transaction.sender_blockchain_address == MINING_SENDER:
+                    continue
+                if not self.state.is_confirmed(transaction):
+                    self.append_transaction(transaction)
+
+    def fast_sync(self):
+        # FAST_SYNC_MIN_BLOCKS以上先に進んでいるノードがあれば、そのノードの最新のスナップショットと
+        # そこまでのヘッダーだけを取得して同期する（それより後のブロックはresolve_conflictsで取得して検証する）
+        # 状態そのものはトランザクションがないと検証できず、ヘッダーで確認できるのはブロックのハッシュ値だけなので、
+        # FAST_SYNC_MIN_PEERS以上のノードが同じスナップショットを返した場合か、
+        # 運用者が指定したハッシュ値（trusted_snapshot）と一致する場合だけ使う（1つのノードが残高を偽れないようにする）
+        import requests
+
+        # スナップショットのハッシュ値→(スナップショット, 返したノードのリスト)
+        candidates = {}
+        for neighbour in self.neighbours or []:
+            try:
+                tip = self.request_peer(neighbour, "/chain/tip")
+                if tip["height"] - len(self.chain) < FAST_SYNC_MIN_BLOCKS:
+                    continue
+                snapshot = state.Snapshot.from_bytes(
+                    self.request_peer(neighbour, "/snapshot", raw=True)
+                )
+            except (requests.RequestException, KeyError, ValueError) as ex:
+                logger.error({"action": "fast_sync", "neighbour": neighbour, "ex": ex})
+                continue
+            if snapshot.height < len(self.chain):
+                continue
+            candidates.setdefault(snapshot.hash(), (snapshot, []))[1].append(neighbour)
+
+        # 高いスナップショットから順に試す
+        for snapshot_hash, (snapshot, neighbours) in sorted(
+            candidates.items(), key=lambda item: item[1][0].height, reverse=True
+        ):
+            if snapshot_hash != self.trusted_snapshot and len(neighbours) < FAST_SYNC_MIN_PEERS:
+                logger.error({"action": "fast_sync", "neighbours": neighbours,
+                              "error": "untrusted_snapshot", "snapshot": snapshot_hash})
+                continue
+            for neighbour in neighbours:
+                try:
+                    headers = self.fetch_blocks(neighbour, 0, snapshot.height + 1, headers=True)
+                except (requests.RequestException, KeyError, ValueError) as ex:
+                    logger.error({"action": "fast_sync", "neighbour": neighbour, "ex": ex})
+                    continue
+                with self.lock:
+                    if self.install_snapshot(snapshot, headers):
+                        logger.info({"action": "fast_sync", "neighbours": neighbours,
+                                     "height": len(self.chain)})
+                        return True
+                logger.error({"action": "fast_sync", "neighbour": neighbour,
+                              "error": "invalid_snapshot"})
+        return False
+
+    def install_snapshot(self, snapshot, headers):
+        # チェーンをスナップショットの高さまでのヘッダーで置き換え、状態をスナップショットから復元する
+        # 自分のチェーンの方が長い場合や、ヘッダーの検証に失敗した場合はFalse（何も変えない）
+        if len(headers) != snapshot.height + 1 or snapshot.height < len(self.chain):
+            return False
+        block_hashes = self.valid_headers(-1, headers)
+        if block_hashes is None or block_hashes[-1] != snapshot.block_hash:
+            return False
+
+        orphaned = self.chain[1:]
+        self.chain[:] = [block.header() for block in headers]
+        self.block_hashes[:] = block_hashes
+        self.chain_work[:] = itertools.accumulate(self.block_work(block) for block in headers)
+        self.block_heights.clear()
+        self.block_heights.update((block_hash, h) for h, block_hash in enumerate(block_hashes))
+        self.state = snapshot.state.copy()
+        self.tx_index.clear()
+        # スナップショットより前のトランザクションは持たないので、prune=Falseでもこれより前はヘッダーだけになる
+        self.pruned_height = len(self.chain)
+        if self.store is not None:
+            self.store.truncate(0)
+            self.store.extend(0, block_hashes, self.chain)
+        self.save_snapshot(snapshot)
+
+        # プールのうち、スナップショットの時点ですでに確定していたものは取り除く
+        self.transaction_pool.remove(
+            [t.hash() for t in self.transaction_pool if self.state.is_confirmed(t)]
+        )
+        self.requeue_transactions(orphaned)
+        return True
+
+    def receive_blocks(self, blocks, source=None):
+        # 他のノードから送られてきたブロックを、自分のチェーンの末尾につながるものだけ取り込む
+        # 戻り値: 取り込んだブロックのハッシュ値のリスト
+        accepted = []
+        for block in blocks:
+            block_hash = block.hash()
+            if source is not None:
+                self.gossip.mark_seen(source, [block_hash])
+            with self.lock:
+                if block_hash in self.block_heights:
+                    continue
+                if block.previous_hash != self.block_hashes[-1]:
+                    # 知らないブロックにつながっている場合は、相手のチェーンの方が長い可能性があるので同期する
+                    threading.Thread(target=self.resolve_conflicts, daemon=True).start()
+                    break
+                ancestor = len(self.chain) - 1
+                recent_blocks = self.recent_blocks_at(ancestor)
+            # 署名の検証はロックの外で行い、その間もトランザクションやチェーンの取得を受け付ける
+            is_valid, block_hashes = self.valid_chain_suffix(ancestor, [block], recent_blocks)
+            with self.lock:
+                if block_hash in self.block_heights:
+                    continue
+                # 検証している間に先端が進んだ場合（同じ高さの別のブロックを先に取り込んだ場合など）は取り込まない
+                if self.block_hashes[-1] != block.previous_hash:
+                    logger.info({"action": "receive_blocks", "status": "stale"})
+                    break
+                if not (is_valid and self.replace_chain(ancestor, [block], block_hashes)):
+                    logger.error({"action": "receive_blocks", "error": "invalid_block"})
+                    break
+            self.gossip.broadcast_block(block_hash, block)
+            accepted.append(block_hash)
+        return accepted
+
+    def resolve_conflicts(self):
+        # 同時に実行しない（実行中なら何もしない）
+        is_acquire = self.resolve_conflicts_semaphore.acquire(blocking=False)
+        if not is_acquire:
+            return False
+        with contextlib.ExitStack() as stack:
+            stack.callback(self.resolve_conflicts_semaphore.release)
+            return self._resolve_conflicts()
+
+    def _resolve_conflicts(self):
+        # 他ノードのうち、検証に成功した累積の仕事量が最も大きいチェーンを採用する
+        # （難易度が下がったあとに安く伸ばした長いチェーンに置き換えられないよう、長さではなく仕事量で比べる）
+        # 通信と検証はロックの外で行い、置き換えだけをロックの中で行う
+        # （検証している間に共通のブロックより前が変わった場合は、そのチェーンは置き換えに使わない）
+        import requests
+
+        candidates = []
+        for neighbour in self.neighbours or []:
+            try:
+                tip = self.request_peer(neighbour, "/chain/tip")
+                # 相手が申告する仕事量で取得するかを決め、比較には取得したブロックから計算し直したものを使う
+                if tip["work"] <= self.total_work():
+                    continue
+                ancestor = self.find_common_ancestor(neighbour, tip["height"])
+                blocks = self.fetch_blocks(neighbour, ancestor + 1, tip["height"])
+            except (requests.RequestException, KeyError, TypeError, ValueError) as ex:
+                logger.error({"action": "resolve_conflicts", "neighbour": neighbour, "ex": ex})
+                continue
+            work = self.total_work(ancestor) + sum(self.block_work(block) for block in blocks)
+            candidates.append((work, neighbour, ancestor, blocks))
+
+        # 仕事量の大きい順に検証し、最初に検証に成功したものを採用する
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        for work, neighbour, ancestor, blocks in candidates:
+            with self.lock:
+                if work <= self.total_work():
+                    break
+                if ancestor >= len(self.chain):
+                    continue
+                ancestor_hash = self.block_hashes[ancestor] if ancestor >= 0 else None
+                recent_blocks = self.recent_blocks_at(ancestor)
+            is_valid, block_hashes = self.valid_chain_suffix(ancestor, blocks, recent_blocks)
+            with self.lock:
+                if work <= self.total_work():
+                    break
+                if ancestor >= len(self.chain) or (
+                    ancestor >= 0 and self.block_hashes[ancestor] != ancestor_hash
+                ):
+                    logger.info({"action": "resolve_conflicts", "neighbour": neighbour,
+                                 "status": "stale"})
+                    continue
+                if not (is_valid and self.replace_chain(ancestor, blocks, block_hashes)):
+                    logger.error({"action": "resolve_conflicts", "neighbour": neighbour,
+                                  "error": "invalid_chain"})
+                    continue
+                # 新しい先端のブロックを隣のノードへ知らせる
+                self.gossip.broadcast_block(self.block_hashes[-1], self.chain[-1])
+                logger.info({"action": "resolve_conflicts", "status": "replaced",
+                             "height": len(self.chain)})
+                return True
+        return False
+
+    def next_nonce(self, blockchain_address):
+        # 次に送るトランザクションに使うナンス（確定済みの分とプールに続けて入っている分の次）
+        with self.lock:
+            return self.transaction_pool.next_nonce(
+                blockchain_address, self.state.nonce(blockchain_address)
+            )
 
     def calculate_total_amount(self, blockchain_address):
-        # あるアドレスのBTC総量を計算
-        total_amount = 0.0
-        for block in self.chain:
-            for transaction in block["transactions"]:
-                value = float(transaction["value"])
-                if blockchain_address == transaction["recipient_blockchain_address"]:
-                    total_amount += value
-                if blockchain_address == transaction["sender_blockchain_address"]:
-                    total_amount -= value
-        return total_amount
+        # あるアドレスのBTC総量（確定済みの残高）を状態から取得（チェーンを走査しない）
+        return self.state.balance(blockchain_address)
+
+    def locate(self, location):
+        # (高さ, 位置)をAPIで返す形にする
+        height, position = location
+        transaction = self.chain[height].transactions[position]
+        return {
+            "transaction_id": transaction.hash(),
+            "block_hash": self.block_hashes[height],
+            "height": height,
+            "position": position,
+            "confirmations": len(self.chain) - height,
+            "transaction": transaction.to_dict(),
+        }
+
+    def get_transaction(self, tx_hash):
+        # トランザクションIDから、取り込まれたブロックと位置を返す（インデックスを引くだけでチェーンを走査しない）
+        # チェーンになくプールにある場合はpending、どちらにもなければNone
+        with self.lock:
+            location = self.tx_index.location(tx_hash)
+            if location is not None:
+                return dict(self.locate(location), status="confirmed")
+            transaction = self.transaction_pool.get(tx_hash)
+        if transaction is None:
+            return None
+        return {
+            "transaction_id": tx_hash,
+            "status": "pending",
+            "transaction": transaction.to_dict(),
+        }
+
+    def address_history(self, blockchain_address, offset=0, limit=None):
+        # アドレスが送信者・受信者のトランザクションを新しい順に返す
+        with self.lock:
+            locations, total = self.tx_index.history(blockchain_address, offset, limit)
+            transactions = [self.locate(location) for location in locations]
+            balance = self.state.balance(blockchain_address)
+            nonce = self.transaction_pool.next_nonce(
+                blockchain_address, self.state.nonce(blockchain_address)
+            )
+        return {
+            "address": blockchain_address,
+            "balance": balance,
+            "next_nonce": nonce,
+            "total": total,
+            "offset": offset,
+            "transactions": transactions,
+        }
 
 
 # if __name__ == "__main__":
@@ -1,44 +1,367 @@
+import collections
+import json
+import threading
+import time
+
 from flask import Flask
+from flask import Response
+from flask import g
 from flask import jsonify
 from flask import request
 
 import blockchain
-import wallet
+import metrics
+import miner
+import models
+import storage
+import utils
+
+BLOCK_CACHE_SIZE = 10000  # シリアライズ済みブロックを保持する最大数
+HISTORY_PAGE_SIZE = 100  # /address/<address>/historyで1ページに返すトランザクション数（既定値）
+HISTORY_MAX_PAGE_SIZE = 1000
 
 app = Flask(__name__)
 
+HTTP_REQUEST_SECONDS = metrics.Histogram(
+    "http_request_seconds", "Time spent handling requests by route and method."
+)
+HTTP_REQUESTS = metrics.Counter(
+    "http_requests_total", "Handled requests by route, method and status code."
+)
+CHAIN_HEIGHT = metrics.Gauge("blockchain_height", "Number of blocks in the chain.")
+MEMPOOL_SIZE = metrics.Gauge("blockchain_mempool_size", "Transactions waiting in the pool.")
+MINING_DIFFICULTY = metrics.Gauge("blockchain_mining_difficulty", "Difficulty of the next block.")
+HASHRATE = metrics.Gauge(
+    "blockchain_hashrate", "Hashes per second over the recent mining history."
+)
+PEERS = metrics.Gauge("blockchain_peers", "Number of known neighbour nodes.")
+GOSSIP_PENDING = metrics.Gauge("blockchain_gossip_pending", "Items waiting to be gossiped.")
+STARTUP_SECONDS = metrics.Gauge(
+    "blockchain_startup_seconds", "Seconds from process start until each startup stage finished."
+)
+
 cache = {}
+cache_lock = threading.Lock()
+
+# (ブロックのハッシュ値, バイナリ形式か, ヘッダーだけか)→シリアライズ済みのbytesのLRUキャッシュ
+# チェーンに入ったブロックは変わらないので、一度シリアライズすれば使い回せる
+# （スナップショットも(ブロックのハッシュ値, "snapshot")をキーにして同じキャッシュに入れる）
+block_cache = collections.OrderedDict()
+block_cache_lock = threading.Lock()
+
+# 起動の段階→プロセスの起動からその段階が終わるまでの秒数
+#   imported: モジュールの読み込み、loaded: チェーンの読み込み、listening: ポートでの待ち受け開始、
+#   synced: 隣のノードの探索と最初の同期（バックグラウンド）
+startup = collections.OrderedDict()
+
+
+def read_miner_address(path):
+    # wallet.load_or_create_wallet が鍵ファイルの2行目に書いたアドレスを読む（なければNone）
+    # アドレスがあれば秘密鍵から計算し直さないので、起動時にwallet（ecdsa、base58）を読み込まずに済む
+    try:
+        with open(path) as f:
+            lines = f.read().split()
+    except FileNotFoundError:
+        return None
+    return lines[1] if len(lines) > 1 else None
 
 
 def get_blockchain():
     cached_blockchain = cache.get("blockchain")
-    if not cached_blockchain:
-        miners_wallet = wallet.Wallet()
-        cache["blockchain"] = blockchain.BlockChain(
-            blockchain_address=miners_wallet.blockchain_address, port=app.config["port"]
-        )
-        app.logger.warning(
-            {
-                "private_key": miners_wallet.private_key,
+    if cached_blockchain:
+        return cached_blockchain
+    # 最初のリクエストが同時に来てもブロックチェーンを1つだけ作る
+    with cache_lock:
+        if cache.get("blockchain"):
+            return cache["blockchain"]
+        # --miner-keyが指定されていれば、そのファイルの秘密鍵（16進数）のアドレスに報酬を受け取る
+        # ファイルがなければ生成して保存し、次の起動からはそれを使う
+        miner_key = app.config.get("miner_key")
+        miner_address = read_miner_address(miner_key) if miner_key else None
+        if miner_address is not None:
+            miner_info = {
+                "blockchain_address": miner_address, "miner_key": miner_key, "created": False
+            }
+        else:
+            # walletはecdsaとbase58を読み込むので、鍵を生成する（アドレスを計算する）場合だけimportする
+            import wallet
+
+            if miner_key:
+                miners_wallet, created = wallet.load_or_create_wallet(miner_key)
+            else:
+                miners_wallet, created = wallet.Wallet(), True
+            miner_address = miners_wallet.blockchain_address
+            miner_info = {
                 "public_key": miners_wallet.public_key,
-                "blockchain_address": miners_wallet.blockchain_address,
+                "blockchain_address": miner_address,
+                "miner_key": miner_key,
+                "created": created,
             }
+            # ファイルに保存していない鍵は、ログに残さないと報酬を使えなくなる
+            if not miner_key:
+                miner_info["private_key"] = miners_wallet.private_key
+        # --dbが指定されていればブロックをSQLiteに保存し、再起動時に読み込む
+        store = storage.BlockStore(app.config["db"]) if app.config.get("db") else None
+        cache["blockchain"] = blockchain.BlockChain(
+            blockchain_address=miner_address,
+            port=app.config["port"],
+            store=store,
+            offload=app.config.get("production", False),
+            prune=app.config.get("prune", False),
+            peers=app.config.get("peers"),
+            host=app.config.get("host"),
+            trusted_snapshot=app.config.get("trusted_snapshot"),
         )
+        app.logger.warning(miner_info)
     return cache["blockchain"]
 
 
+def record_startup(stage, report=False):
+    # report=Trueの場合は、ここまでの段階をまとめてログに出す
+    startup[stage] = utils.process_uptime()
+    STARTUP_SECONDS.set(startup[stage], stage=stage)
+    if report:
+        app.logger.warning(
+            {"action": "startup", **{k: round(v, 3) for k, v in startup.items()}}
+        )
+
+
+def serialize_block(block_hash, block, binary=False):
+    # binary=Trueの場合はmodels.Blockのバイナリ形式、それ以外はAPI用のJSON
+    return cached_bytes(
+        (block_hash, binary, block.pruned),
+        lambda: block.to_bytes() if binary else json.dumps(block.to_dict()).encode(),
+    )
+
+
+def cached_bytes(key, serialize):
+    with block_cache_lock:
+        data = block_cache.get(key)
+        if data is not None:
+            block_cache.move_to_end(key)
+            return data
+    data = serialize()
+    with block_cache_lock:
+        block_cache[key] = data
+        if len(block_cache) > BLOCK_CACHE_SIZE:
+            block_cache.popitem(last=False)
+    return data
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # ストリーミングするレスポンス（/chain）は本文を送り終えるまでではなく、レスポンスを返すまでの時間
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started, route=route, method=request.method
+        )
+        HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+
+def not_modified(etag):
+    # If-None-MatchのETagが一致すれば本文を作らずに304を返す
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
 @app.route("/chain", methods=["GET"])
 def get_chain():
+    # /chain?from_height=10&limit=100 で範囲を指定して取得する
+    # /chain?format=ndjson（またはAccept: application/x-ndjson）で1行1ブロックのNDJSONを返す
+    # /chain?format=binary（またはAccept: application/octet-stream）で(4バイト長+バイナリ)の連続を返す
+    # （ノード間の同期はbinaryを使う）
+    # /chain?headers=1 でトランザクションを除いたヘッダーだけのブロックを返す（スナップショットからの同期用）
+    block_chain = get_blockchain()
+    from_height = max(request.args.get("from_height", 0, type=int), 0)
+    limit = request.args.get("limit", None, type=int)
+    headers = request.args.get("headers", "0").lower() in ("1", "true")
+    # チェーンの置き換えの途中を読まないように、ハッシュ値とブロックはロックの中でまとめてコピーする
+    with block_chain.lock:
+        height = len(block_chain.chain)
+        to_height = height if limit is None else min(height, from_height + max(limit, 0))
+        block_hashes = block_chain.block_hashes[from_height:to_height]
+        blocks = block_chain.chain[from_height:to_height]
+        pruned = max(0, min(block_chain.pruned_height, to_height) - from_height)
+    if headers:
+        blocks = [block if block.pruned else block.header() for block in blocks]
+    chain_format = request.args.get("format") or {
+        "application/x-ndjson": "ndjson",
+        "application/octet-stream": "binary",
+    }.get(request.accept_mimetypes.best, "json")
+
+    # 範囲の最後のブロックのハッシュ値は、それ以前のブロック全てに依存する
+    # ただし、プルーニングでヘッダーだけになったブロックの数と、JSONの"length"（チェーン全体の長さ）は
+    # ハッシュ値が変わらなくても変わるので、それぞれ含める
+    last_hash = block_hashes[-1] if block_hashes else ""
+    etag = f"{chain_format}-{int(headers)}-{from_height}-{len(blocks)}-{last_hash}"
+    if not headers:
+        etag += f"-{pruned}"
+    if chain_format == "json":
+        etag += f"-{height}"
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    if chain_format == "binary":
+        def generate():
+            for block_hash, block in zip(block_hashes, blocks):
+                yield models.encode_frames([serialize_block(block_hash, block, binary=True)])
+
+        response = Response(generate(), mimetype="application/octet-stream")
+    elif chain_format == "ndjson":
+        def generate():
+            for block_hash, block in zip(block_hashes, blocks):
+                yield serialize_block(block_hash, block) + b"\n"
+
+        response = Response(generate(), mimetype="application/x-ndjson")
+    else:
+        def generate():
+            yield b'{"chain": ['
+            for i, (block_hash, block) in enumerate(zip(block_hashes, blocks)):
+                if i:
+                    yield b","
+                yield serialize_block(block_hash, block)
+            yield f'], "from_height": {from_height}, "length": {height}}}'.encode()
+
+        response = Response(generate(), mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
+@app.route("/chain/tip", methods=["GET"])
+def get_chain_tip():
     block_chain = get_blockchain()
-    response = {"chain": block_chain.chain}
-    return jsonify(response), 200
+    with block_chain.lock:
+        tip = {
+            "height": len(block_chain.chain),
+            "hash": block_chain.block_hashes[-1],
+            "work": block_chain.total_work(),
+        }
+    return jsonify(tip), 200
+
+
+@app.route("/chain/verify", methods=["GET"])
+def verify_chain():
+    # 保持しているハッシュ値を使わずに全ブロックを計算し直し、改ざんがないか確認する（チェーンの長さに比例して重い）
+    tampered_height = get_blockchain().verify_chain()
+    return jsonify({"valid": tampered_height is None, "height": tampered_height}), 200
+
+
+@app.route("/snapshot", methods=["GET"])
+def get_snapshot():
+    # 最新のスナップショット（state.Snapshotのバイナリ形式）。新しいノードはこれとヘッダーだけで同期する
+    block_chain = get_blockchain()
+    with block_chain.lock:
+        snapshot = block_chain.snapshot
+    if snapshot is None:
+        return jsonify({"message": "not found"}), 404
+    response = not_modified(snapshot.block_hash)
+    if response is not None:
+        return response
+    data = cached_bytes((snapshot.block_hash, "snapshot"), snapshot.to_bytes)
+    response = Response(data, mimetype="application/octet-stream")
+    response.headers["X-Snapshot-Height"] = str(snapshot.height)
+    # 他のノードの運用者が--trusted-snapshotに指定する値
+    response.headers["X-Snapshot-Hash"] = snapshot.hash()
+    response.set_etag(snapshot.block_hash)
+    return response
+
+
+@app.route("/chain/hashes", methods=["GET"])
+def get_chain_hashes():
+    # 他ノードとの共通部分を探すための、ブロックのハッシュ値だけのリスト
+    block_chain = get_blockchain()
+    from_height = max(request.args.get("from_height", 0, type=int), 0)
+    limit = request.args.get("limit", blockchain.CONSENSUS_PAGE_SIZE, type=int)
+    block_hashes = block_chain.block_hashes[from_height:from_height + max(limit, 0)]
+    return jsonify({"hashes": block_hashes, "from_height": from_height}), 200
+
+
+@app.route("/consensus", methods=["PUT"])
+def consensus():
+    # 他ノードのチェーンと比較し、より長い正しいチェーンがあれば置き換える
+    is_replaced = get_blockchain().resolve_conflicts()
+    return jsonify({"replaced": is_replaced}), 200
+
+
+def block_response(block_hash, block):
+    if block is None:
+        return jsonify({"message": "not found"}), 404
+    response = not_modified(block_hash)
+    if response is not None:
+        return response
+    response = Response(serialize_block(block_hash, block), mimetype="application/json")
+    response.set_etag(block_hash)
+    return response
+
+
+@app.route("/block/<int:height>", methods=["GET"])
+def get_block_by_height(height):
+    block_chain = get_blockchain()
+    with block_chain.lock:
+        block = block_chain.get_block(height=height)
+        block_hash = block_chain.block_hashes[height] if block is not None else None
+    return block_response(block_hash, block)
+
+
+@app.route("/block/<block_hash>", methods=["GET"])
+def get_block_by_hash(block_hash):
+    # ハッシュ値→高さのインデックスを引くだけで、チェーンを走査しない
+    block_chain = get_blockchain()
+    with block_chain.lock:
+        block = block_chain.get_block(block_hash=block_hash)
+    return block_response(block_hash, block)
+
+
+@app.route("/block/<int:height>/proof/<int:index>", methods=["GET"])
+def get_transaction_proof(height, index):
+    # ブロック全体を取得せずにトランザクションを検証するためのマークル証明
+    proof = get_blockchain().transaction_proof(height, index)
+    if proof is None:
+        return jsonify({"message": "not found"}), 404
+    return jsonify(proof), 200
+
+
+@app.route("/transaction/<tx_hash>", methods=["GET"])
+def get_transaction(tx_hash):
+    # トランザクションID（ハッシュ値）から、取り込まれたブロックと位置を返す（プールにあればpending）
+    found = get_blockchain().get_transaction(tx_hash)
+    if found is None:
+        return jsonify({"message": "not found"}), 404
+    return jsonify(found), 200
+
+
+@app.route("/address/<blockchain_address>/history", methods=["GET"])
+def get_address_history(blockchain_address):
+    # /address/<address>/history?offset=0&limit=100 アドレスのトランザクションを新しい順に返す
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(
+        max(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 0), HISTORY_MAX_PAGE_SIZE
+    )
+    history = get_blockchain().address_history(blockchain_address, offset, limit)
+    history["limit"] = limit
+    return jsonify(history), 200
 
 
 @app.route("/transactions", methods=["GET", "POST"])
 def transaction():
     block_chain = get_blockchain()  # キャッシュのブロックチェーンを読み込む
     if request.method == "GET":
-        transactions = block_chain.transaction_pool  # トランザクションをプールから取得
+        # トランザクションをプールから取得（プールのdictが途中で変わらないようにロックの中で）
+        with block_chain.lock:
+            transactions = list(block_chain.transaction_pool)
+        transactions = [t.to_dict() for t in transactions]
         response = {"transactions": transactions, "length": len(transactions)}
         return jsonify(response), 200
 
@@ -48,6 +371,7 @@ def transaction():
             "sender_blockchain_address",
             "recipient_blockchain_address",
             "value",
+            "nonce",
             "sender_public_key",
             "signature",
         )
@@ -62,25 +386,130 @@ def transaction():
             request_json["value"],
             request_json["sender_public_key"],
             request_json["signature"],
+            request_json["nonce"],
         )
 
         if not is_created:
             return jsonify({"message": "fail"}), 400
         return jsonify({"message": "success"}), 201
 
+@app.route("/transactions/batch", methods=["POST"])
+def transactions_batch():
+    # {"transactions": [{...}, ...]} を受け取り、署名をまとめて検証してプールに格納する
+    block_chain = get_blockchain()
+    request_json = request.json
+    if not request_json or not isinstance(request_json.get("transactions"), list):
+        return jsonify({"message": "missing values"}), 400
+    transactions = request_json["transactions"]
+
+    required = (
+        "sender_blockchain_address",
+        "recipient_blockchain_address",
+        "value",
+        "nonce",
+        "sender_public_key",
+        "signature",
+    )
+    results = ["missing values"] * len(transactions)
+    complete = [
+        i for i, t in enumerate(transactions)
+        if isinstance(t, dict) and all(k in t for k in required)
+    ]
+    is_added = block_chain.add_transactions(
+        [transactions[i] for i in complete], source=request_json.get("source")
+    )
+    for i, added in zip(complete, is_added):
+        results[i] = "success" if added else "fail"
+
+    accepted = results.count("success")
+    response = {
+        "results": [{"index": i, "message": m} for i, m in enumerate(results)],
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+    }
+    return jsonify(response), 201 if accepted == len(results) else 200
+
+
+@app.route("/blocks", methods=["POST"])
+def receive_blocks():
+    # 他のノードからゴシップで送られてきたブロックを取り込む
+    # ノード間はバイナリ形式（application/octet-stream、送信元は?source=）で送られてくる
+    # JSONの場合は {"blocks": [{...}, ...], "source": ...}
+    try:
+        if request.mimetype == "application/octet-stream":
+            blocks = models.decode_blocks(request.get_data())
+            source = request.args.get("source")
+        else:
+            request_json = request.get_json(silent=True)
+            if not request_json or not isinstance(request_json.get("blocks"), list):
+                return jsonify({"message": "missing values"}), 400
+            blocks = [models.Block.from_dict(b) for b in request_json["blocks"]]
+            source = request_json.get("source")
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"message": "invalid blocks"}), 400
+    accepted = get_blockchain().receive_blocks(blocks, source=source)
+    return jsonify({"accepted": accepted}), 200
+
+
 @app.route('/mine', methods=['GET'])
 def mine():
     block_chain = get_blockchain()
-    is_mined = block_chain.mining()
+    # /mine?parallel=1 で全コアを使った並列マイニングを行う
+    parallel = request.args.get("parallel", "0").lower() in ("1", "true")
+    if app.config.get("production"):
+        # 本番モードではProof of Workをリクエストの処理中に行わず、バックグラウンドで行う
+        # （すでにマイニング中なら、そのスレッドはすぐに終わる）
+        threading.Thread(
+            target=block_chain.mining, kwargs={"parallel": parallel}, daemon=True
+        ).start()
+        return jsonify({'message': 'accepted'}), 202
+    is_mined = block_chain.mining(parallel=parallel)
     if is_mined:
         return jsonify({'message': 'success(mining success)'}), 200
     return jsonify({'message': 'fail'}), 400
 
 @app.route('/mine/start', methods=['GET'])
 def start_mine():
-    get_blockchain().start_mining()
+    # /mine/start?max_wait=5 でプールが少なくても5秒ごとにマイニングする
+    parallel = request.args.get("parallel", "0").lower() in ("1", "true")
+    max_wait_sec = request.args.get("max_wait", None, type=float)
+    if not get_blockchain().start_mining(parallel=parallel, max_wait_sec=max_wait_sec):
+        return jsonify({'message': 'already running'}), 200
     return jsonify({'message': 'success(mining started)'}), 200
 
+
+@app.route('/mine/stop', methods=['GET'])
+def stop_mine():
+    if not get_blockchain().stop_mining():
+        return jsonify({'message': 'not running'}), 200
+    return jsonify({'message': 'success(mining stopped)'}), 200
+
+
+@app.route('/mine/status', methods=['GET'])
+def mine_status():
+    # ハッシュレート、ブロックあたりの時間、現在の難易度など
+    block_chain = get_blockchain()
+    if block_chain.mining_scheduler is None:
+        block_chain.mining_scheduler = miner.MiningScheduler(block_chain)
+    return jsonify(block_chain.mining_scheduler.metrics()), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheusのテキスト形式で、各処理の回数・時間とノードの状態を返す
+    block_chain = get_blockchain()
+    if block_chain.mining_scheduler is None:
+        block_chain.mining_scheduler = miner.MiningScheduler(block_chain)
+    mining = block_chain.mining_scheduler.metrics()
+    CHAIN_HEIGHT.set(mining["height"])
+    MEMPOOL_SIZE.set(mining["pool_size"])
+    MINING_DIFFICULTY.set(mining["difficulty"])
+    HASHRATE.set(mining["hashrate"] or 0)
+    PEERS.set(len(block_chain.neighbours or []))
+    GOSSIP_PENDING.set(block_chain.gossip.pending())
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+record_startup("imported")
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
 
@@ -88,11 +517,60 @@ if __name__ == "__main__":
     parser.add_argument(
         "-p", "--port", default=5100, type=int, help="port to listen on"
     )
+    parser.add_argument(
+        "-d", "--db", default=None, type=str,
+        help="block store path (default: blockchain_<port>.db, '' for memory only)"
+    )
+    parser.add_argument(
+        "--prune", action="store_true",
+        help="drop transactions of blocks behind the latest snapshot, keeping headers"
+    )
+    parser.add_argument(
+        "--verify", action="store_true",
+        help="recompute all block hashes after loading and refuse to start if any differ"
+    )
+    parser.add_argument(
+        "--peers", default=None, type=str,
+        help="comma-separated host:port list of neighbours (skips the LAN scan)"
+    )
+    parser.add_argument(
+        "--host", default=None, type=str, help="host advertised to neighbours"
+    )
+    parser.add_argument(
+        "--miner-key", default=None, type=str,
+        help="file holding the hex private key and address that receive mining rewards, "
+             "created if missing (default: miner_<port>.key, '' to use a new key every start)"
+    )
+    parser.add_argument(
+        "--trusted-snapshot", default=None, type=str,
+        help="snapshot hash (X-Snapshot-Hash of /snapshot) to fast sync from a single peer"
+    )
     args = parser.parse_args()
     port = args.port
 
     app.config["port"] = port
+    app.config["db"] = f"blockchain_{port}.db" if args.db is None else args.db
+    app.config["prune"] = args.prune
+    app.config["peers"] = args.peers.split(",") if args.peers else None
+    app.config["host"] = args.host
+    app.config["trusted_snapshot"] = args.trusted_snapshot
+    app.config["miner_key"] = f"miner_{port}.key" if args.miner_key is None else args.miner_key
+
+    block_chain = get_blockchain()
+    record_startup("loaded", report=True)
+    if args.verify:
+        tampered_height = block_chain.verify_chain()
+        if tampered_height is not None:
+            raise SystemExit(f"block {tampered_height} does not match its stored hash")
 
-    get_blockchain().sync_neighbours()
+    # 隣のノードの探索と同期はバックグラウンドで行い、サーバーの起動を待たせない
+    block_chain.sync_neighbours_in_background(
+        then=lambda: record_startup("synced", report=True)
+    )
 
-    app.run(host="0.0.0.0", port=port, threaded=True, debug=True)
+    # debug=Trueのリローダーは親プロセスを残し、親も（すでに作った）BlockChainで同期を続けるので、
+    # 保存先を使う場合は同じファイルを2つのプロセスが書き換えないようにリローダーを使わない
+    app.run(
+        host="0.0.0.0", port=port, threaded=True, debug=True,
+        use_reloader=not app.config["db"],
+    )
@@ -0,0 +1,79 @@
+import pytest
+
+import blockchain
+import blockchain_server
+import models
+
+
+@pytest.fixture
+def node(monkeypatch):
+    block_chain = blockchain.BlockChain("miner", host="127.0.0.1", peers=[])
+    monkeypatch.setitem(blockchain_server.cache, "blockchain", block_chain)
+    return block_chain, blockchain_server.app.test_client()
+
+
+def add_block(block_chain):
+    # Proof of Workを行わずに報酬だけのブロックを追加する（APIの応答だけを確認する）
+    reward = models.Transaction(
+        blockchain.MINING_SENDER, "miner", blockchain.MINING_REWARD, nonce=len(block_chain.chain)
+    )
+    block_chain.create_block(0, block_chain.block_hashes[-1], [reward], difficulty=1)
+
+
+def test_ranged_json_is_revalidated_when_the_chain_grows(node):
+    block_chain, client = node
+    for _ in range(3):
+        add_block(block_chain)
+    response = client.get("/chain?limit=2")
+    assert response.json["length"] == 4
+    etag = response.headers["ETag"]
+    assert client.get("/chain?limit=2", headers={"If-None-Match": etag}).status_code == 304
+
+    add_block(block_chain)
+    response = client.get("/chain?limit=2", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json["length"] == 5
+
+
+def test_ranged_binary_stays_cached_when_the_chain_grows(node):
+    block_chain, client = node
+    for _ in range(3):
+        add_block(block_chain)
+    etag = client.get("/chain?limit=2&format=binary").headers["ETag"]
+    add_block(block_chain)
+    response = client.get("/chain?limit=2&format=binary", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_pruned_blocks_change_the_etag(node):
+    block_chain, client = node
+    for _ in range(3):
+        add_block(block_chain)
+    etag = client.get("/chain?limit=3&format=binary").headers["ETag"]
+    with block_chain.lock:
+        block_chain.prune_blocks(2)
+    response = client.get("/chain?limit=3&format=binary", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    blocks = models.decode_blocks(response.data)
+    assert [block.pruned for block in blocks] == [True, True, False]
+
+
+@pytest.mark.parametrize("field, value", [
+    ("sender_blockchain_address", 1),
+    ("recipient_blockchain_address", ["b"]),
+    ("value", "abc"),
+])
+def test_transactions_with_invalid_fields_fail(node, field, value):
+    _, client = node
+    transaction = dict({
+        "sender_blockchain_address": "a",
+        "recipient_blockchain_address": "b",
+        "value": 1.0,
+        "nonce": 0,
+        "sender_public_key": "00",
+        "signature": "00",
+    }, **{field: value})
+    assert client.post("/transactions", json=transaction).status_code == 400
+    response = client.post("/transactions/batch", json={"transactions": [transaction]})
+    assert response.status_code == 200
+    assert response.json["results"] == [{"index": 0, "message": "fail"}]
@@ -0,0 +1,252 @@
+import threading
+
+import blockchain
+import models
+import state
+import storage
+
+ALICE = "alice"
+BOB = "bob"
+CAROL = "carol"
+
+
+def reward(recipient, height):
+    return models.Transaction(
+        blockchain.MINING_SENDER, recipient, blockchain.MINING_REWARD, nonce=height
+    )
+
+
+def make_blocks(previous_hash, transactions_list):
+    # replace_chainはヘッダーの検証（Proof of Work）を呼び出し側で済ませている前提なので、ナンスは何でもよい
+    blocks = []
+    for transactions in transactions_list:
+        block = models.Block(
+            previous_hash, blockchain.BlockChain.merkle_root(transactions),
+            blockchain.MINING_DIFFICULTY, 0, 0.0, transactions,
+        )
+        blocks.append(block)
+        previous_hash = block.hash()
+    return blocks, [b.hash() for b in blocks]
+
+
+def chain_with_transfer():
+    block_chain = blockchain.BlockChain("miner", host="127.0.0.1", peers=[])
+    blocks, block_hashes = make_blocks(block_chain.block_hashes[0], [
+        [reward(ALICE, 1)],
+        [reward(ALICE, 2), models.Transaction(ALICE, BOB, 0.25, nonce=0)],
+    ])
+    assert block_chain.replace_chain(0, blocks, block_hashes)
+    return block_chain
+
+
+def test_replace_chain_restores_state_after_failed_apply():
+    block_chain = chain_with_transfer()
+    before = block_chain.state.to_bytes()
+    block_hashes = list(block_chain.block_hashes)
+    chain_work = list(block_chain.chain_work)
+    # 相手のチェーンではALICEに残高がないので、2つ目のブロックの適用に失敗する
+    blocks, new_hashes = make_blocks(block_chain.block_hashes[0], [
+        [reward(CAROL, 1)],
+        [reward(CAROL, 2), models.Transaction(ALICE, BOB, 0.25, nonce=0)],
+        [reward(CAROL, 3)],
+    ])
+    assert not block_chain.replace_chain(0, blocks, new_hashes)
+    assert block_chain.state.to_bytes() == before
+    assert block_chain.block_hashes == block_hashes
+    assert block_chain.chain_work == chain_work
+    assert block_chain.get_transaction(block_chain.chain[2].transactions[1].hash())
+
+
+def test_replace_chain_rolls_back_orphaned_blocks():
+    block_chain = chain_with_transfer()
+    orphaned = block_chain.chain[2].transactions[1]
+    ancestor_hash = block_chain.block_hashes[1]
+    blocks, new_hashes = make_blocks(ancestor_hash, [
+        [reward(CAROL, 2)],
+        [reward(CAROL, 3), models.Transaction(ALICE, CAROL, 0.5, nonce=0)],
+    ])
+    assert block_chain.replace_chain(1, blocks, new_hashes)
+    assert block_chain.block_hashes[1:] == [ancestor_hash] + new_hashes
+    assert block_chain.state.balance(ALICE) == 0.5
+    assert block_chain.state.balance(BOB) == 0.0
+    assert block_chain.state.balance(CAROL) == 2.5
+    # ALICEのナンス0は新しいチェーンで使われたので、取り消したトランザクションはプールに戻さない
+    assert block_chain.state.nonce(ALICE) == 1
+    assert orphaned.hash() not in block_chain.transaction_pool
+
+
+def test_replace_chain_from_another_genesis_drops_snapshot(monkeypatch, tmp_path):
+    monkeypatch.setattr(blockchain, "SNAPSHOT_INTERVAL", 2)
+    store = storage.BlockStore(str(tmp_path / "chain.db"))
+    block_chain = blockchain.BlockChain("miner", store=store, host="127.0.0.1", peers=[])
+    blocks, block_hashes = make_blocks(block_chain.block_hashes[0], [
+        [reward(ALICE, 1)],
+        [reward(ALICE, 2)],
+        [reward(ALICE, 3), models.Transaction(ALICE, BOB, 0.25, nonce=0)],
+    ])
+    assert block_chain.replace_chain(0, blocks, block_hashes)
+    block_chain.snapshot_thread.join()
+    assert block_chain.snapshot.height == 2
+    orphaned = block_chain.chain[3].transactions[1]
+    # 別々に起動したノードはジェネシスブロックのタイムスタンプが違うので、共通のブロックがない
+    genesis = models.Block(
+        blockchain.BlockChain.hash({}), blockchain.BlockChain.merkle_root([]),
+        blockchain.MINING_DIFFICULTY, 0, 1.0, [],
+    )
+    blocks, new_hashes = make_blocks(genesis.hash(), [
+        [reward(ALICE if height == 1 else CAROL, height)] for height in range(1, 6)
+    ])
+    assert block_chain.replace_chain(-1, [genesis] + blocks, [genesis.hash()] + new_hashes)
+    assert block_chain.block_hashes == [genesis.hash()] + new_hashes
+    block_chain.snapshot_thread.join()
+    assert block_chain.snapshot.height == 4
+    assert block_chain.snapshot.block_hash == new_hashes[3]
+    assert store.load_snapshot().block_hash == new_hashes[3]
+    # 新しいチェーンでもALICEのナンス0は使われていないので、取り消したトランザクションはプールに戻る
+    assert orphaned.hash() in block_chain.transaction_pool
+    restarted = blockchain.BlockChain("miner", store=store, host="127.0.0.1", peers=[])
+    assert restarted.state.to_bytes() == block_chain.state.to_bytes()
+
+
+def test_sync_neighbours_keeps_running_after_an_error(monkeypatch):
+    block_chain = blockchain.BlockChain("miner", host="127.0.0.1", peers=[])
+    timers = []
+
+    class Timer(object):
+        def __init__(self, interval, function):
+            timers.append(function)
+
+        def start(self):
+            pass
+
+    def fail():
+        raise ValueError("broken peer")
+
+    monkeypatch.setattr(blockchain.threading, "Timer", Timer)
+    monkeypatch.setattr(block_chain, "fast_sync", fail)
+    block_chain.sync_neighbours()
+    assert timers == [block_chain.sync_neighbours]
+    # セマフォも解放されている
+    assert block_chain.sync_neighbours_semaphore.acquire(blocking=False)
+
+
+def mined_chain(monkeypatch, blocks):
+    monkeypatch.setattr(blockchain, "MINING_DIFFICULTY", 1)
+    monkeypatch.setattr(blockchain, "TARGET_BLOCK_TIME_SEC", 1e-6)
+    monkeypatch.setattr(blockchain, "SNAPSHOT_INTERVAL", 2)
+    monkeypatch.setattr(blockchain, "FAST_SYNC_MIN_BLOCKS", 2)
+    block_chain = blockchain.BlockChain(ALICE, host="127.0.0.1", peers=[])
+    for _ in range(blocks):
+        assert block_chain.mining(allow_empty=True)
+    if block_chain.snapshot_thread is not None:
+        block_chain.snapshot_thread.join()
+    return block_chain
+
+
+def serve_snapshots(monkeypatch, block_chain, source, snapshots):
+    # snapshots: 隣のノード→そのノードが返すスナップショット
+    def request_peer(neighbour, path, raw=False, **params):
+        if path == "/chain/tip":
+            return {"height": len(source.chain)}
+        return snapshots[neighbour].to_bytes()
+
+    def fetch_blocks(neighbour, from_height, to_height, headers=False):
+        return [block.header() for block in source.chain[from_height:to_height]]
+
+    monkeypatch.setattr(block_chain, "request_peer", request_peer)
+    monkeypatch.setattr(block_chain, "fetch_blocks", fetch_blocks)
+    block_chain.neighbours = list(snapshots)
+
+
+def forged(snapshot):
+    forged_state = snapshot.state.copy()
+    forged_state.balances[BOB] += 100.0
+    return state.Snapshot(snapshot.height, snapshot.block_hash, forged_state)
+
+
+def test_fast_sync_needs_peers_to_agree(monkeypatch):
+    source = mined_chain(monkeypatch, 5)
+    snapshot = source.snapshot
+    assert snapshot.height == 4
+
+    block_chain = blockchain.BlockChain("miner", host="127.0.0.1", peers=[])
+    serve_snapshots(monkeypatch, block_chain, source, {"a:1": forged(snapshot)})
+    assert not block_chain.fast_sync()
+    serve_snapshots(monkeypatch, block_chain, source, {"a:1": snapshot, "b:1": forged(snapshot)})
+    assert not block_chain.fast_sync()
+    assert len(block_chain.chain) == 1
+
+    serve_snapshots(monkeypatch, block_chain, source, {
+        "a:1": snapshot, "b:1": forged(snapshot), "c:1": snapshot,
+    })
+    assert block_chain.fast_sync()
+    assert block_chain.block_hashes == source.block_hashes[:5]
+    assert block_chain.state.to_bytes() == snapshot.state.to_bytes()
+
+
+def test_fast_sync_from_one_peer_with_trusted_snapshot(monkeypatch):
+    source = mined_chain(monkeypatch, 5)
+    snapshot = source.snapshot
+    block_chain = blockchain.BlockChain(
+        "miner", host="127.0.0.1", peers=[], trusted_snapshot=snapshot.hash()
+    )
+    serve_snapshots(monkeypatch, block_chain, source, {"a:1": forged(snapshot)})
+    assert not block_chain.fast_sync()
+    serve_snapshots(monkeypatch, block_chain, source, {"a:1": snapshot})
+    assert block_chain.fast_sync()
+    assert block_chain.snapshot.hash() == snapshot.hash()
+
+
+def test_receive_blocks_verifies_signatures_outside_the_lock(monkeypatch):
+    source = mined_chain(monkeypatch, 1)
+    block_chain = blockchain.BlockChain("miner", host="127.0.0.1", peers=[])
+    assert block_chain.replace_chain(-1, source.chain, source.block_hashes)
+    assert source.mining(allow_empty=True)
+    verify_signatures = blockchain.verify_signatures
+    lock_free = []
+
+    def verify_from_request_thread(transactions, **kwargs):
+        # 別のスレッド（他のリクエスト）からロックを取れるか
+        def try_lock():
+            acquired = block_chain.lock.acquire(blocking=False)
+            if acquired:
+                block_chain.lock.release()
+            lock_free.append(acquired)
+
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+        return verify_signatures(transactions, **kwargs)
+
+    monkeypatch.setattr(blockchain, "verify_signatures", verify_from_request_thread)
+    assert block_chain.receive_blocks([source.chain[-1]]) == [source.block_hashes[-1]]
+    assert lock_free == [True]
+    assert block_chain.block_hashes == source.block_hashes
+
+
+def test_proof_hasher_matches_proof_hash():
+    merkle_root = blockchain.BlockChain.merkle_root([reward(ALICE, 1)])
+    previous_hash = "ab" * 32
+    for difficulty in (1, 2, 3):
+        hasher = blockchain.ProofHasher(merkle_root, previous_hash, difficulty)
+        for nonce in (0, 1, 255, 1 << 40, (1 << 64) - 1):
+            expected = blockchain.BlockChain.proof_hash(
+                merkle_root, previous_hash, nonce, difficulty
+            )
+            assert hasher.hexdigest(nonce) == expected
+            assert hasher.is_valid(nonce) == blockchain.BlockChain.valid_header_proof(
+                merkle_root, previous_hash, nonce, difficulty
+            )
+
+
+def test_proof_hasher_search_finds_the_first_valid_nonce():
+    merkle_root = blockchain.BlockChain.merkle_root([])
+    previous_hash = "cd" * 32
+    hasher = blockchain.ProofHasher(merkle_root, previous_hash, 2)
+    nonce = hasher.search(0, 100000)
+    assert blockchain.BlockChain.valid_header_proof(merkle_root, previous_hash, nonce, 2)
+    assert not any(
+        blockchain.BlockChain.valid_header_proof(merkle_root, previous_hash, n, 2)
+        for n in range(nonce)
+    )
+    assert hasher.search(0, nonce) is None
@@ -0,0 +1,443 @@
+# チェーンのエクスポート・インポート（バックアップからの復旧や、新しいノードにチェーンを入れておく場合に使う）
+#   python chain_tool.py export --db blockchain_5100.db -o chain.bin
+#   python chain_tool.py export --node 127.0.0.1:5100 | python chain_tool.py import --db blockchain_5101.db
+#   python chain_tool.py import -i chain.bin  （--dbを省略すると検証だけを行う）
+#
+# 形式: ヘッダー(EXPORT_HEADER: マジック, バージョン, 圧縮したスナップショットの長さ) 圧縮したスナップショット
+#       チャンク(CHUNK_HEADER: ブロック数, 圧縮した長さ) 圧縮した(4バイト長+ブロックのバイナリ形式)の連続 ...
+#       終端(ブロック数0のチャンク)
+# チャンクごとにzlibで圧縮するので、チャンク単位で読み書き・検証でき、チェーン全体をメモリに載せない
+# （インポートで保持し続けるのは残高の状態だけで、これはノードが持つものと同じ）
+#
+# インポートでは、前のブロックに依存しない検証（Proof of Work、マークルルート、署名）をチャンクごとに
+# ワーカープロセスで並列に行い、前のブロックとのつながり・難易度・タイムスタンプ・状態（報酬、残高、二重使用）の確認と
+# 保存は高さの順に行う
+# プルーニングしたチェーン（ジェネシスブロックがヘッダーだけ）はブロックを先頭から適用できないので、
+# 一緒にエクスポートしたスナップショットの状態から始める（ヘッダーでつながっていることだけを確認し、
+# 状態はエクスポートを選んだ運用者が信用したものとして使う）
+import collections
+import concurrent.futures
+import itertools
+import os
+import struct
+import sys
+import time
+import zlib
+
+import blockchain
+import models
+import state
+import storage
+
+EXPORT_MAGIC = b"PYBC"
+EXPORT_VERSION = 1
+EXPORT_HEADER = struct.Struct(">4sBI")
+CHUNK_HEADER = struct.Struct(">II")
+EXPORT_CHUNK_BLOCKS = 500  # 1チャンクに入れるブロック数（ノードから取得する場合は1リクエストのブロック数）
+EXPORT_COMPRESS_LEVEL = 6
+IMPORT_WORKERS = os.cpu_count() or 1  # 検証のワーカープロセス数
+IMPORT_PENDING_PER_WORKER = 2  # 検証待ちにしておくチャンク数（ワーカーあたり。メモリ使用量の上限になる）
+PROGRESS_INTERVAL_SEC = 1
+NODE_TIMEOUT_SEC = 30
+IMPORT_TEMPORARY_SUFFIX = ".importing"  # インポート中に書き込む一時ファイルの接尾辞
+
+
+class Progress(object):
+    # 処理したブロック数とバイト数を、PROGRESS_INTERVAL_SEC間隔で標準エラー出力に表示する
+    # （標準出力はエクスポートしたデータをパイプで渡すのに使う）
+    def __init__(self, action, quiet=False):
+        self.action = action
+        self.quiet = quiet
+        self.blocks = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self._shown = self.started
+
+    def update(self, blocks, size):
+        self.blocks += blocks
+        self.bytes += size
+        now = time.perf_counter()
+        if not self.quiet and now - self._shown >= PROGRESS_INTERVAL_SEC:
+            self._shown = now
+            print(f"\r{self.line()}", end="", file=sys.stderr, flush=True)
+
+    def elapsed(self):
+        return max(time.perf_counter() - self.started, 1e-9)
+
+    def line(self):
+        return (f"{self.action} {self.blocks:>10,} blocks  "
+                f"{self.blocks / self.elapsed():>10,.0f} blocks/sec  {self.bytes / 1e6:>8,.1f} MB")
+
+    def finish(self):
+        if not self.quiet:
+            print(f"\r{self.line()}  {self.elapsed():.1f} sec", file=sys.stderr)
+        return {
+            "blocks": self.blocks,
+            "bytes": self.bytes,
+            "seconds": self.elapsed(),
+            "blocks_per_sec": self.blocks / self.elapsed(),
+        }
+
+
+def read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("unexpected end of stream")
+    return data
+
+
+def decompress(data):
+    # 壊れた圧縮データはValueErrorにする（コマンドでは"import failed: ..."と表示する）
+    try:
+        return zlib.decompress(data)
+    except zlib.error as ex:
+        raise ValueError(f"invalid compressed data: {ex}") from ex
+
+
+def store_source(path):
+    # 保存先（SQLite）のスナップショットとブロック。WALモードなので、ノードが動いている間も読み出せる
+    # 戻り値: (スナップショットのバイナリ形式（なければb""）, ブロックのバイナリ形式のイテレーター)
+    if not os.path.exists(path):
+        raise ValueError(f"{path} does not exist")
+    store = storage.BlockStore(path)
+    snapshot = store.load_snapshot()
+    return (
+        snapshot.to_bytes() if snapshot else b"",
+        (data for _, data in store.iter_block_bytes()),
+    )
+
+
+def node_source(node, page_size=EXPORT_CHUNK_BLOCKS):
+    # 動いているノード（host:port）の/snapshotと/chain?format=binary
+    # スナップショットを先に取得し、その高さがエクスポートするチェーンに含まれるようにする
+    # （取得中にチェーンが置き換えられた場合は、インポートの検証で失敗する）
+    import requests
+
+    session = requests.Session()
+
+    def get(path, **params):
+        response = session.get(f"http://{node}{path}", params=params, timeout=NODE_TIMEOUT_SEC)
+        if response.status_code == 404 and path == "/snapshot":
+            return None
+        response.raise_for_status()
+        return response
+
+    response = get("/snapshot")
+    snapshot = response.content if response is not None else b""
+    height = get("/chain/tip").json()["height"]
+
+    def blocks():
+        from_height = 0
+        while from_height < height:
+            page = get(
+                "/chain", format="binary", from_height=from_height,
+                limit=min(page_size, height - from_height),
+            ).content
+            frames = [bytes(frame) for frame in models.iter_frames(page)]
+            if not frames:
+                raise ValueError(f"{node} returned no blocks from {from_height}")
+            yield from frames
+            from_height += len(frames)
+
+    return snapshot, blocks()
+
+
+def export_chain(
+    output, snapshot, blocks, chunk_blocks=EXPORT_CHUNK_BLOCKS, level=EXPORT_COMPRESS_LEVEL,
+    progress=None,
+):
+    # snapshot: state.Snapshotのバイナリ形式（なければb""）、blocks: ブロックのバイナリ形式（高さの順）
+    compressed = zlib.compress(snapshot, level) if snapshot else b""
+    output.write(EXPORT_HEADER.pack(EXPORT_MAGIC, EXPORT_VERSION, len(compressed)) + compressed)
+    blocks = iter(blocks)
+    while True:
+        chunk = list(itertools.islice(blocks, chunk_blocks))
+        if not chunk:
+            break
+        data = zlib.compress(models.encode_frames(chunk), level)
+        output.write(CHUNK_HEADER.pack(len(chunk), len(data)) + data)
+        if progress is not None:
+            progress.update(len(chunk), CHUNK_HEADER.size + len(data))
+    output.write(CHUNK_HEADER.pack(0, 0))
+    output.flush()
+
+
+def read_header(stream):
+    # 戻り値: エクスポートに含まれるstate.Snapshot（なければNone）
+    magic, version, size = EXPORT_HEADER.unpack(read_exact(stream, EXPORT_HEADER.size))
+    if magic != EXPORT_MAGIC:
+        raise ValueError("not a chain export")
+    if version != EXPORT_VERSION:
+        raise ValueError(f"unsupported export version {version}")
+    if not size:
+        return None
+    return state.Snapshot.from_bytes(decompress(read_exact(stream, size)))
+
+
+def iter_chunks(stream):
+    # (最初のブロックの高さ, 圧縮したデータ)を1チャンクずつ返す
+    height = 0
+    while True:
+        count, size = CHUNK_HEADER.unpack(read_exact(stream, CHUNK_HEADER.size))
+        if not count:
+            return
+        yield height, read_exact(stream, size)
+        height += count
+
+
+def verify_block(height, block):
+    # 前のブロックに依存しない検証。問題があれば理由を返す
+    # ジェネシスブロックはProof of Workを行っていないので、ChainImporterで内容を確認する
+    if height > 0 and not blockchain.BlockChain.valid_header_proof(
+        block.merkle_root, block.previous_hash, block.nonce, block.difficulty
+    ):
+        return "proof_of_work"
+    if block.pruned:
+        return None
+    if block.merkle_root != blockchain.BlockChain.merkle_root(block.transactions):
+        return "merkle_root"
+    for transaction in block.transactions:
+        if transaction.sender_blockchain_address == blockchain.MINING_SENDER:
+            continue
+        if not blockchain.verify_signature(transaction):
+            return "signature"
+    return None
+
+
+def verify_chunk(first_height, data):
+    # ワーカープロセスで1チャンクを展開して検証する
+    # 戻り値: (最初のブロックの高さ, 展開したフレームの連続, 各ブロックのハッシュ値, エラー)
+    # エラーは(高さ, 理由)で、問題がなければNone（ハッシュ値はエラーのあったブロックの手前まで）
+    frames = decompress(data)
+    block_hashes = []
+    for height, frame in enumerate(models.iter_frames(frames), first_height):
+        block = models.Block.from_bytes(frame)
+        reason = verify_block(height, block)
+        if reason is not None:
+            return first_height, frames, block_hashes, (height, reason)
+        block_hashes.append(block.hash())
+    return first_height, frames, block_hashes, None
+
+
+def verified_chunks(chunks, workers=IMPORT_WORKERS):
+    # chunksをワーカープロセスで並列に検証し、結果を元の順に返す
+    # 検証待ちはworkers * IMPORT_PENDING_PER_WORKERチャンクまでにし、読み込みが検証より先に進みすぎないようにする
+    if workers <= 1:
+        for first_height, data in chunks:
+            yield verify_chunk(first_height, data)
+        return
+    executor = concurrent.futures.ProcessPoolExecutor(workers)
+    try:
+        pending = collections.deque()
+        for first_height, data in chunks:
+            pending.append(executor.submit(verify_chunk, first_height, data))
+            if len(pending) >= workers * IMPORT_PENDING_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+class ChainImporter(object):
+    # ワーカーで検証したブロックを高さの順に受け取り、前のブロックとのつながり・難易度・タイムスタンプ・残高を確認して保存する
+    def __init__(self, snapshot=None, store=None):
+        self.snapshot = snapshot
+        self.store = store
+        self.state = state.State()
+        # 難易度とタイムスタンプの検証に使う直前のブロック
+        self.recent_blocks = collections.deque(maxlen=blockchain.RECENT_BLOCKS)
+        self.started = time.time()
+        self.block_hashes = collections.deque(maxlen=1)
+        self.height = 0
+        # Falseの場合はスナップショットの高さまでのブロックを状態に反映しない（プルーニングしたチェーン）
+        self.replay = True
+
+    def add(self, blocks, block_hashes):
+        for block, block_hash in zip(blocks, block_hashes):
+            reason = self._check(block, block_hash)
+            if reason is not None:
+                raise ValueError(f"block {self.height} is invalid: {reason}")
+            self.recent_blocks.append(block)
+            self.block_hashes.append(block_hash)
+            self.height += 1
+        # 検証が終わったチャンクごとに保存する（import_to_dbでは一時ファイルに書き込むので、途中で失敗しても残らない）
+        if self.store is not None:
+            self.store.extend(self.height - len(blocks), block_hashes, blocks)
+
+    def _check(self, block, block_hash):
+        height = self.height
+        if height == 0:
+            reason = self._check_genesis(block)
+            if reason is not None:
+                return reason
+        else:
+            if block.previous_hash != self.block_hashes[-1]:
+                return "previous_hash"
+            if block.difficulty != blockchain.BlockChain.expected_difficulty(
+                height, list(self.recent_blocks)
+            ):
+                return "difficulty"
+            if not blockchain.BlockChain.valid_timestamp(
+                block.timestamp, list(self.recent_blocks), self.started
+            ):
+                return "timestamp"
+        snapshot = self.snapshot
+        if snapshot is not None and height == snapshot.height and block_hash != snapshot.block_hash:
+            return "snapshot_mismatch"
+        if not self.replay and height <= snapshot.height:
+            return None
+        # ヘッダーだけのブロックはスナップショットより前にしか置けない
+        if block.pruned:
+            return "pruned"
+        if not self.state.apply_block(block, height):
+            return "state"
+        return None
+
+    def _check_genesis(self, block):
+        # ジェネシスブロックはどのノードでも同じ内容になる
+        if (
+            block.previous_hash != blockchain.BlockChain.hash({})
+            or block.merkle_root != blockchain.BlockChain.merkle_root([])
+            or block.transactions
+            or block.difficulty != blockchain.MINING_DIFFICULTY
+        ):
+            return "genesis"
+        if block.pruned:
+            if self.snapshot is None:
+                return "pruned_without_snapshot"
+            self.replay = False
+            self.state = self.snapshot.state.copy()
+        return None
+
+    def finish(self):
+        # 最後のブロックでのスナップショットを保存し、ノードの起動時にブロックを先頭から適用しなくて済むようにする
+        # 戻り値: 保存したstate.Snapshot
+        if not self.height:
+            raise ValueError("the export has no blocks")
+        if self.snapshot is not None and self.snapshot.height >= self.height:
+            raise ValueError(f"snapshot at {self.snapshot.height} is beyond the last block")
+        snapshot = state.Snapshot(self.height - 1, self.block_hashes[-1], self.state)
+        if self.store is not None:
+            self.store.save_snapshot(snapshot)
+        return snapshot
+
+
+def import_chain(stream, store=None, workers=IMPORT_WORKERS, progress=None):
+    # 検証に失敗した場合はValueError
+    # 戻り値: 最後のブロックでのstate.Snapshot
+    importer = ChainImporter(read_header(stream), store)
+    for first_height, frames, block_hashes, error in verified_chunks(iter_chunks(stream), workers):
+        blocks = [
+            models.Block.from_bytes(frame, block_hash)
+            for frame, block_hash in zip(models.iter_frames(frames), block_hashes)
+        ]
+        # エラーのあったブロックより前は、つながりと残高を確認して保存しておく
+        importer.add(blocks, block_hashes)
+        if error is not None:
+            raise ValueError(f"block {error[0]} is invalid: {error[1]}")
+        if progress is not None:
+            progress.update(len(blocks), len(frames))
+    return importer.finish()
+
+
+def remove_db(path):
+    # SQLiteのファイル（WALモードの-wal, -shmも含む）を削除する
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def import_to_db(stream, path, workers=IMPORT_WORKERS, progress=None):
+    # 一時ファイルに書き込み、最後のスナップショットまで保存できた場合だけpathに置き換える
+    # （プルーニングしたチェーンが途中で失敗すると、スナップショットのないヘッダーだけのブロックが残り、ノードが起動できなくなる）
+    store = storage.BlockStore(path)
+    count = len(store)
+    store.close()
+    if count:
+        raise ValueError(f"{path} already has {count} blocks")
+    temporary = path + IMPORT_TEMPORARY_SUFFIX
+    remove_db(temporary)
+    store = storage.BlockStore(temporary)
+    try:
+        snapshot = import_chain(stream, store, workers, progress)
+    except BaseException:
+        store.close()
+        remove_db(temporary)
+        raise
+    store.close()
+    os.replace(temporary, path)
+    return snapshot
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="write the chain as a compressed stream")
+    source = export_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-d", "--db", default=None, help="block store to read")
+    source.add_argument("-n", "--node", default=None, help="host:port of a running node")
+    export_parser.add_argument("-o", "--output", default="-", help="output file ('-' for stdout)")
+    export_parser.add_argument(
+        "--chunk-blocks", default=EXPORT_CHUNK_BLOCKS, type=int, help="blocks per chunk"
+    )
+    export_parser.add_argument(
+        "--level", default=EXPORT_COMPRESS_LEVEL, type=int, help="zlib compression level"
+    )
+    export_parser.add_argument(
+        "--no-snapshot", action="store_true",
+        help="leave out the state snapshot (the chain must not be pruned)"
+    )
+    export_parser.add_argument("-q", "--quiet", action="store_true", help="no progress output")
+
+    import_parser = subparsers.add_parser("import", help="verify an export and store it")
+    import_parser.add_argument("-i", "--input", default="-", help="input file ('-' for stdin)")
+    import_parser.add_argument(
+        "-d", "--db", default=None,
+        help="empty block store to write to (default: verify only)"
+    )
+    import_parser.add_argument(
+        "-w", "--workers", default=IMPORT_WORKERS, type=int, help="verification processes"
+    )
+    import_parser.add_argument("-q", "--quiet", action="store_true", help="no progress output")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "export":
+            snapshot, blocks = (
+                store_source(args.db) if args.db else node_source(args.node, args.chunk_blocks)
+            )
+            if args.no_snapshot:
+                snapshot = b""
+            progress = Progress("export", args.quiet)
+            if args.output == "-":
+                export_chain(sys.stdout.buffer, snapshot, blocks, args.chunk_blocks,
+                             args.level, progress)
+            else:
+                with open(args.output, "wb") as f:
+                    export_chain(f, snapshot, blocks, args.chunk_blocks, args.level, progress)
+            progress.finish()
+        else:
+            progress = Progress("import", args.quiet)
+
+            def run(stream):
+                if args.db:
+                    return import_to_db(stream, args.db, args.workers, progress)
+                return import_chain(stream, None, args.workers, progress)
+
+            if args.input == "-":
+                snapshot = run(sys.stdin.buffer)
+            else:
+                with open(args.input, "rb") as f:
+                    snapshot = run(f)
+            progress.finish()
+            if not args.quiet:
+                print(f"verified {snapshot.height + 1} blocks up to {snapshot.block_hash}",
+                      file=sys.stderr)
+    except ValueError as ex:
+        raise SystemExit(f"{args.command} failed: {ex}")
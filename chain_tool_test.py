@@ -0,0 +1,87 @@
+import io
+
+import pytest
+
+import blockchain
+import chain_tool
+import models
+import storage
+import wallet
+
+
+@pytest.fixture
+def mined(monkeypatch):
+    # 難易度1で、送金を含むブロックを掘ったチェーン
+    monkeypatch.setattr(blockchain, "MINING_DIFFICULTY", 1)
+    monkeypatch.setattr(blockchain, "TARGET_BLOCK_TIME_SEC", 1e-6)
+    sender, recipient = wallet.Wallet(), wallet.Wallet()
+    block_chain = blockchain.BlockChain(sender.blockchain_address, host="127.0.0.1", peers=[])
+    assert block_chain.mining(allow_empty=True)
+    for nonce in range(4):
+        signature = wallet.Transaction(
+            sender.private_key, sender.public_key, sender.blockchain_address,
+            recipient.blockchain_address, 0.1, nonce,
+        ).generate_signature()
+        assert block_chain.add_transaction(
+            sender.blockchain_address, recipient.blockchain_address, 0.1,
+            sender.public_key, signature, nonce,
+        )
+        assert block_chain.mining()
+    return block_chain
+
+
+def export(blocks, chunk_blocks=2):
+    stream = io.BytesIO()
+    chain_tool.export_chain(stream, b"", [b.to_bytes() for b in blocks], chunk_blocks)
+    stream.seek(0)
+    return stream
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_round_trip(mined, tmp_path, workers):
+    path = str(tmp_path / "chain.db")
+    snapshot = chain_tool.import_to_db(export(mined.chain), path, workers)
+    assert snapshot.height == len(mined.chain) - 1
+    assert snapshot.block_hash == mined.block_hashes[-1]
+    assert snapshot.state.to_bytes() == mined.state.to_bytes()
+    imported = blockchain.BlockChain(store=storage.BlockStore(path), host="127.0.0.1", peers=[])
+    assert imported.block_hashes == mined.block_hashes
+
+
+def test_tampered_transaction_is_rejected(mined, tmp_path):
+    blocks = list(mined.chain)
+    tampered = models.Block.from_bytes(blocks[3].to_bytes())
+    signature = bytearray(tampered.transactions[1].signature)
+    signature[5] ^= 1
+    tampered.transactions[1].signature = bytes(signature)
+    blocks[3] = tampered
+    path = str(tmp_path / "chain.db")
+    with pytest.raises(ValueError, match="block 3 is invalid: merkle_root"):
+        chain_tool.import_to_db(export(blocks), path, 1)
+    # 途中まで検証したブロックも保存先には残らない
+    assert len(storage.BlockStore(path)) == 0
+
+
+def test_bad_previous_hash_is_rejected(mined):
+    blocks = list(mined.chain)
+    del blocks[2]
+    with pytest.raises(ValueError, match="block 2 is invalid: previous_hash"):
+        chain_tool.import_chain(export(blocks), None, 1)
+
+
+def test_corrupt_stream_is_rejected(mined):
+    data = export(mined.chain).getvalue()
+    with pytest.raises(ValueError, match="unexpected end of stream"):
+        chain_tool.import_chain(io.BytesIO(data[:-3]), None, 1)
+    corrupt = bytearray(data)
+    corrupt[chain_tool.EXPORT_HEADER.size + chain_tool.CHUNK_HEADER.size] ^= 0xFF
+    with pytest.raises(ValueError, match="invalid compressed data"):
+        chain_tool.import_chain(io.BytesIO(bytes(corrupt)), None, 1)
+
+
+def test_pruned_blocks_without_snapshot_are_not_loaded(mined, tmp_path):
+    # 途中で失敗したインポートなど、スナップショットのないヘッダーだけのブロックでは起動しない
+    store = storage.BlockStore(str(tmp_path / "chain.db"))
+    store.extend(0, mined.block_hashes, [b.header() for b in mined.chain])
+    with pytest.raises(ValueError, match="block 0 is pruned"):
+        blockchain.BlockChain(store=store, host="127.0.0.1", peers=[])
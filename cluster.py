@@ -0,0 +1,434 @@
+# 1台のマシン（localhost）で複数のノードとウォレットサーバーを動かす負荷試験用のクラスター
+# ノードはwsgi.py、ウォレットサーバーはwallet_server.pyをサブプロセスとして起動し（LANの探索はせず--peersでつなぐ）、
+# 署名済みトランザクションを一定のペースで送り続けて次を計測する
+#   TPS: ブロックに取り込まれた送金の数/秒（ウォレットサーバーが受け付けた数/秒も）
+#   ブロックの伝播時間: ブロックが作られてから（タイムスタンプ）各ノードの先端で観測されるまでの時間
+#   フォーク率: いずれかのノードで観測されたブロックのうち、最終的なチェーンに残らなかったものの割合
+#   CPU使用率: ノードごとの/proc/<pid>/statの差分（ワーカープロセスを含むプロセスグループ全体）
+#   python cluster.py --nodes 4 --miners 2 --tps 50 --duration 60 --output cluster.json
+#
+# 送金の資金は、全マイナーの報酬の受け取り先を1つのウォレット（faucet）にして作り、そこから送信者に配る
+# ブロックの観測は各ノードの/chain/hashesをCLUSTER_POLL_SEC間隔で取得して行うので、
+# 伝播時間の精度はその間隔程度で、ポーリング自体もノードの負荷になる
+import collections
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import wallet
+
+CLUSTER_NODES = 3
+CLUSTER_BASE_PORT = 5200  # ノードのポート（5200, 5201, ...）。BLOCKCHAIN_PORT_RANGEの探索と重ならないようにする
+CLUSTER_WALLET_PORT = 8200
+CLUSTER_TPS = 20  # 送信するトランザクション数/秒
+CLUSTER_DURATION_SEC = 60  # 送信を続ける時間
+CLUSTER_SENDERS = 10  # 送信者のウォレット数
+CLUSTER_RECIPIENTS = 100  # 受信者のウォレット数
+CLUSTER_BATCH_SIZE = 10  # ウォレットサーバーの/transactions/batchへ1リクエストで送る数
+CLUSTER_VALUE = 0.001  # 1回の送金額
+CLUSTER_MINING_MAX_WAIT_SEC = 2  # プールが少なくてもマイニングする間隔
+CLUSTER_POLL_SEC = 0.1  # 各ノードのチェーンを観測する間隔
+CLUSTER_SETTLE_SEC = 30  # 送信を止めてから、プールが空になるのを待つ最大時間
+CLUSTER_STARTUP_TIMEOUT_SEC = 30
+CLUSTER_REQUEST_TIMEOUT_SEC = 60
+OBSERVE_REORG_DEPTH = 5  # 先端からこのブロック数だけ遡って観測し直す（短いフォークを取りこぼさない）
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+session = requests.Session()
+
+
+def url(port, path):
+    return f"http://127.0.0.1:{port}{path}"
+
+
+def get_json(port, path, **params):
+    response = session.get(
+        url(port, path), params=params, timeout=CLUSTER_REQUEST_TIMEOUT_SEC
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def wait_ready(port, path, timeout=CLUSTER_STARTUP_TIMEOUT_SEC):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            session.get(url(port, path), timeout=1).raise_for_status()
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"127.0.0.1:{port} did not start within {timeout} seconds")
+
+
+def cpu_seconds(pgid):
+    # プロセスグループpgid（起動したプロセスとその子孫）のCPU時間（user+system、終了した子を含む）
+    # /procがない環境ではNone
+    if not os.path.isdir("/proc"):
+        return None
+    total = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # コマンド名に空白や括弧が入ることがあるので、最後の")"より後ろを分割する
+        fields = stat[stat.rindex(")") + 2:].split()
+        if int(fields[2]) != pgid:
+            continue
+        total += sum(int(v) for v in fields[11:15])
+    return total / CLOCK_TICKS
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.mean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+class Cluster(object):
+    def __init__(self, nodes, miners, base_port, wallet_port, log_dir):
+        self.ports = [base_port + i for i in range(nodes)]
+        self.miner_ports = self.ports[:miners]
+        self.wallet_port = wallet_port
+        self.log_dir = log_dir
+        self.faucet = wallet.Wallet()
+        self.processes = {}
+
+    def start(self):
+        key_path = os.path.join(self.log_dir, "faucet.key")
+        with open(key_path, "w") as f:
+            f.write(self.faucet.private_key + "\n" + self.faucet.blockchain_address + "\n")
+        for port in self.ports:
+            peers = ",".join(f"127.0.0.1:{p}" for p in self.ports if p != port)
+            self._spawn(port, [
+                "wsgi.py", "-p", str(port), "-d", "", "--host", "127.0.0.1",
+                "--peers", peers, "--miner-key", key_path,
+            ])
+        self._spawn(self.wallet_port, [
+            "wallet_server.py", "-p", str(self.wallet_port),
+            "-g", f"http://127.0.0.1:{self.ports[0]}",
+        ])
+        for port in self.ports:
+            wait_ready(port, "/chain/tip")
+        wait_ready(self.wallet_port, "/")
+
+    def _spawn(self, port, args):
+        # 新しいプロセスグループで起動し、ワーカープロセスまでまとめてCPU時間の計測と終了ができるようにする
+        log = open(os.path.join(self.log_dir, f"{port}.log"), "w")
+        self.processes[port] = subprocess.Popen(
+            [sys.executable] + args,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=log, stderr=subprocess.STDOUT,
+            env=dict(os.environ, PYTHONUNBUFFERED="1"),
+            start_new_session=True,
+        )
+
+    def stop(self):
+        for process in self.processes.values():
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+
+    def cpu(self):
+        return {port: cpu_seconds(process.pid) for port, process in self.processes.items()}
+
+    def start_mining(self, max_wait_sec):
+        for port in self.miner_ports:
+            get_json(port, "/mine/start", max_wait=max_wait_sec)
+
+    def stop_mining(self):
+        for port in self.miner_ports:
+            get_json(port, "/mine/stop")
+
+    def balance(self, blockchain_address):
+        return get_json(self.ports[0], f"/address/{blockchain_address}/history", limit=0)[
+            "balance"
+        ]
+
+    def send(self, transactions):
+        # ウォレットサーバーで署名し、ゲートウェイのノード（ports[0]）へ送る
+        response = session.post(
+            url(self.wallet_port, "/transactions/batch"),
+            json={"transactions": transactions}, timeout=CLUSTER_REQUEST_TIMEOUT_SEC,
+        )
+        return response.json()
+
+    def pool_sizes(self):
+        return [get_json(port, "/transactions")["length"] for port in self.ports]
+
+    def tips(self):
+        return [get_json(port, "/chain/tip")["hash"] for port in self.ports]
+
+    def final_chain(self):
+        # ports[0]のチェーン全体と各ブロックのハッシュ値
+        blocks = get_json(self.ports[0], "/chain")["chain"]
+        block_hashes = []
+        while len(block_hashes) < len(blocks):
+            block_hashes.extend(
+                get_json(self.ports[0], "/chain/hashes", from_height=len(block_hashes))["hashes"]
+            )
+        return blocks, block_hashes[:len(blocks)]
+
+
+def transfer(sender, recipient_blockchain_address, value):
+    return {
+        "sender_private_key": sender.private_key,
+        "sender_public_key": sender.public_key,
+        "sender_blockchain_address": sender.blockchain_address,
+        "recipient_blockchain_address": recipient_blockchain_address,
+        "value": value,
+    }
+
+
+def wait_until(predicate, timeout, poll=0.5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(poll)
+    return False
+
+
+class Observer(object):
+    # 各ノードのチェーンの末尾を定期的に取得し、ブロックのハッシュ値ごとに各ノードで最初に観測した時刻を記録する
+    def __init__(self, ports, poll_sec=CLUSTER_POLL_SEC):
+        self.ports = ports
+        self.poll_sec = poll_sec
+        # ブロックのハッシュ値→{ポート: 最初に観測した時刻(time.time())}
+        self.seen = collections.defaultdict(dict)
+        self._heights = {port: 0 for port in ports}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.errors = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.poll_sec):
+            for port in self.ports:
+                from_height = max(self._heights[port] - OBSERVE_REORG_DEPTH, 1)
+                try:
+                    block_hashes = get_json(port, "/chain/hashes", from_height=from_height)[
+                        "hashes"
+                    ]
+                except requests.RequestException:
+                    self.errors += 1
+                    continue
+                now = time.time()
+                for block_hash in block_hashes:
+                    self.seen[block_hash].setdefault(port, now)
+                self._heights[port] = from_height + len(block_hashes)
+
+
+def run(args):
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix="cluster_")
+    cluster = Cluster(args.nodes, args.miners, args.base_port, args.wallet_port, log_dir)
+    print(f"logs: {log_dir}")
+    try:
+        cluster.start()
+        return measure(cluster, args)
+    finally:
+        cluster.stop()
+
+
+def measure(cluster, args):
+    senders = [wallet.Wallet() for _ in range(args.senders)]
+    recipients = [wallet.Wallet().blockchain_address for _ in range(CLUSTER_RECIPIENTS)]
+    # 送信者ごとに必要な額（手数料はないので送金額の合計に余裕を持たせる）
+    budget = args.tps * args.duration / args.senders * args.value * 2
+
+    # 1. マイニングを始め、報酬でfaucetに資金を貯めてから送信者に配る
+    cluster.start_mining(args.mining_max_wait)
+    print(f"funding {args.senders} senders with {budget:.4f} each")
+    if not wait_until(
+        lambda: cluster.balance(cluster.faucet.blockchain_address) >= budget * args.senders,
+        args.settle * 10,
+    ):
+        raise RuntimeError("the faucet was not funded in time")
+    cluster.send([transfer(cluster.faucet, s.blockchain_address, budget) for s in senders])
+    if not wait_until(
+        lambda: all(cluster.balance(s.blockchain_address) >= budget for s in senders),
+        args.settle * 10,
+    ):
+        raise RuntimeError("the senders were not funded in time")
+
+    # 2. 一定のペースで送金を送り続ける
+    observer = Observer(cluster.ports, args.poll)
+    observer.start()
+    cpu_before = cluster.cpu()
+    started = time.time()
+    interval = args.batch_size / args.tps
+    next_at = time.monotonic()
+    accepted = rejected = 0
+    latencies = []
+    i = 0
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        batch = []
+        for _ in range(args.batch_size):
+            batch.append(transfer(senders[i % len(senders)], random.choice(recipients), args.value))
+            i += 1
+        request_started = time.perf_counter()
+        try:
+            result = cluster.send(batch)
+            accepted += result["accepted"]
+            rejected += result["rejected"]
+        except (requests.RequestException, KeyError, ValueError):
+            rejected += len(batch)
+        latencies.append(time.perf_counter() - request_started)
+        next_at += interval
+        time.sleep(max(0.0, next_at - time.monotonic()))
+    sent_seconds = time.time() - started
+
+    # 3. プールが空になり、全ノードの先端がそろうまで待ってから集計する
+    wait_until(lambda: not any(cluster.pool_sizes()), args.settle)
+    cluster.stop_mining()
+    converged = wait_until(lambda: len(set(cluster.tips())) == 1, args.settle)
+    observer.stop()
+    cpu_after = cluster.cpu()
+    elapsed = time.time() - started
+    blocks, block_hashes = cluster.final_chain()
+
+    sender_addresses = {s.blockchain_address for s in senders}
+    confirmed = 0
+    last_confirmed = None
+    propagation, per_node = [], []
+    final = set(block_hashes)
+    for block, block_hash in zip(blocks, block_hashes):
+        count = sum(
+            1 for t in block["transactions"]
+            if t["sender_blockchain_address"] in sender_addresses
+        )
+        if count:
+            confirmed += count
+            last_confirmed = block["timestamp"]
+        if block["timestamp"] < started or block_hash not in observer.seen:
+            continue
+        seen = observer.seen[block_hash]
+        per_node.extend(t - block["timestamp"] for t in seen.values())
+        if len(seen) == len(cluster.ports):
+            propagation.append(max(seen.values()) - block["timestamp"])
+    observed = [h for h, seen in observer.seen.items() if min(seen.values()) >= started]
+    orphaned = [h for h in observed if h not in final]
+
+    return {
+        "settings": {
+            "nodes": args.nodes, "miners": args.miners, "tps": args.tps,
+            "duration": args.duration, "senders": args.senders,
+            "batch_size": args.batch_size, "mining_max_wait": args.mining_max_wait,
+            "poll": args.poll, "cpu_count": os.cpu_count(),
+        },
+        "submitted": {
+            "accepted": accepted,
+            "rejected": rejected,
+            "accepted_per_sec": accepted / sent_seconds,
+            "request": percentiles(latencies),
+        },
+        "confirmed": {
+            "transactions": confirmed,
+            "tps": confirmed / (last_confirmed - started) if last_confirmed else 0.0,
+        },
+        "blocks": {
+            "height": len(blocks),
+            "observed": len(observed),
+            "orphaned": len(orphaned),
+            "fork_rate": len(orphaned) / len(observed) if observed else 0.0,
+            "converged": converged,
+        },
+        "propagation": {"all_nodes": percentiles(propagation), "per_node": percentiles(per_node)},
+        "cpu_percent": {
+            str(port): (
+                None if cpu_before[port] is None
+                else (cpu_after[port] - cpu_before[port]) / elapsed * 100
+            )
+            for port in cpu_before
+        },
+        "observer_errors": observer.errors,
+    }
+
+
+def print_report(report):
+    submitted, confirmed, blocks = report["submitted"], report["confirmed"], report["blocks"]
+    print(f"{'submitted':24}{submitted['accepted']:>8} accepted  {submitted['rejected']:>6} rejected"
+          f"  {submitted['accepted_per_sec']:>8.1f} tx/sec")
+    print(f"{'confirmed':24}{confirmed['transactions']:>8} tx        {confirmed['tps']:>15.1f} tx/sec")
+    print(f"{'blocks':24}{blocks['observed']:>8} observed  {blocks['orphaned']:>6} orphaned"
+          f"  fork rate {blocks['fork_rate']:.1%}  converged {blocks['converged']}")
+    for name, stats in report["propagation"].items():
+        if stats:
+            print(f"{'propagation ' + name:24}p50 {stats['p50_ms']:.0f} ms  p95 {stats['p95_ms']:.0f} ms"
+                  f"  max {stats['max_ms']:.0f} ms  ({stats['count']} samples)")
+    for port, percent in report["cpu_percent"].items():
+        if percent is not None:
+            print(f"{'cpu ' + port:24}{percent:>8.1f} %")
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--nodes", default=CLUSTER_NODES, type=int)
+    parser.add_argument(
+        "--miners", default=None, type=int, help="nodes that mine (default: all)"
+    )
+    parser.add_argument("--base-port", default=CLUSTER_BASE_PORT, type=int)
+    parser.add_argument("--wallet-port", default=CLUSTER_WALLET_PORT, type=int)
+    parser.add_argument(
+        "--tps", default=CLUSTER_TPS, type=float, help="transactions sent per second"
+    )
+    parser.add_argument(
+        "--duration", default=CLUSTER_DURATION_SEC, type=float, help="seconds to keep sending"
+    )
+    parser.add_argument("--senders", default=CLUSTER_SENDERS, type=int)
+    parser.add_argument("--batch-size", default=CLUSTER_BATCH_SIZE, type=int)
+    parser.add_argument("--value", default=CLUSTER_VALUE, type=float)
+    parser.add_argument(
+        "--mining-max-wait", default=CLUSTER_MINING_MAX_WAIT_SEC, type=float,
+        help="mine at least this often even with few transactions"
+    )
+    parser.add_argument(
+        "--poll", default=CLUSTER_POLL_SEC, type=float, help="chain observation interval"
+    )
+    parser.add_argument("--settle", default=CLUSTER_SETTLE_SEC, type=float)
+    parser.add_argument("--log-dir", default=None, help="node logs (default: a temp dir)")
+    parser.add_argument("-o", "--output", default=None, help="write the report as JSON")
+    args = parser.parse_args()
+    if args.miners is None:
+        args.miners = args.nodes
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,151 @@
+import collections
+import logging
+import queue
+import threading
+
+import models
+
+logger = logging.getLogger(__name__)
+
+GOSSIP_QUEUE_SIZE = 10000  # 送信待ちのトランザクション・ブロックの最大数
+GOSSIP_WORKERS = 4  # 送信を行うバックグラウンドスレッド数
+GOSSIP_BATCH_SIZE = 100  # 1リクエストでまとめて送る最大数
+GOSSIP_SEEN_SIZE = 100000  # ノードごとに覚えておく送信済み（受信済み）IDの最大数
+GOSSIP_TIMEOUT_SEC = 3
+
+TRANSACTIONS = "transactions"
+BLOCKS = "blocks"
+# 種類ごとの送信先のエンドポイント
+PATHS = {TRANSACTIONS: "transactions/batch", BLOCKS: "blocks"}
+
+
+class Gossip(object):
+    # 新しいトランザクションとブロックを隣のノードにまとめて送る（push型のゴシップ）
+    # リクエストを処理するスレッドはキューに積むだけで、ネットワークの待ち時間の影響を受けない
+    def __init__(self, get_neighbours, source=None, workers=GOSSIP_WORKERS):
+        # get_neighbours: 送信先のノード（host:port）のリストを返す関数
+        # source: 自分のアドレス（受け取ったノードが送り返してこないように送る）
+        self._get_neighbours = get_neighbours
+        self.source = source
+        self._workers = workers
+        self._queue = queue.Queue(GOSSIP_QUEUE_SIZE)
+        self._threads = []
+        self._lock = threading.Lock()
+        # ノード→requests.Session（keep-aliveでコネクションを使い回す）
+        self._sessions = {}
+        # ノード→送信済み（または相手から受信済み）のIDのLRU
+        self._seen = collections.defaultdict(collections.OrderedDict)
+
+    def broadcast_transaction(self, tx_hash, transaction):
+        # transaction: models.Transaction（JSONで送る）
+        self._put((TRANSACTIONS, tx_hash, transaction))
+
+    def broadcast_block(self, block_hash, block):
+        # block: models.Block（バイナリ形式で送る）
+        self._put((BLOCKS, block_hash, block))
+
+    def pending(self):
+        # 送信待ちの数（キューが詰まっていればゴシップが追いついていない）
+        return self._queue.qsize()
+
+    def mark_seen(self, neighbour, item_ids):
+        # neighbourがすでに知っているID（相手から受け取ったものなど）は送らない
+        with self._lock:
+            seen = self._seen[neighbour]
+            for item_id in item_ids:
+                seen[item_id] = True
+                seen.move_to_end(item_id)
+            while len(seen) > GOSSIP_SEEN_SIZE:
+                seen.popitem(last=False)
+
+    def is_seen(self, neighbour, item_id):
+        with self._lock:
+            return item_id in self._seen.get(neighbour, ())
+
+    def _put(self, item):
+        self._start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            logger.error({"action": "gossip", "error": "queue_full", "kind": item[0]})
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self._workers):
+                thread = threading.Thread(target=self._run, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _session(self, neighbour):
+        # requestsは読み込みに時間がかかるので、最初に送信するときにimportする
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with self._lock:
+            session = self._sessions.get(neighbour)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._workers)
+                session.mount("http://", adapter)
+                self._sessions[neighbour] = session
+            return session
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            # キューにたまっている分をまとめて取り出す
+            batch = [item]
+            while len(batch) < GOSSIP_BATCH_SIZE:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            for kind in (BLOCKS, TRANSACTIONS):
+                items = [(item_id, data) for k, item_id, data in batch if k == kind]
+                if items:
+                    self._send(kind, items)
+
+    def _payload(self, kind, items):
+        if kind == BLOCKS:
+            # ブロックは(4バイト長+バイナリ)の連続で送り、送信元はクエリパラメータで渡す
+            return {
+                "data": models.encode_frames([block.to_bytes() for block in items]),
+                "headers": {"Content-Type": "application/octet-stream"},
+                "params": {"source": self.source} if self.source else None,
+            }
+        return {"json": {kind: [t.to_dict() for t in items], "source": self.source}}
+
+    def _send(self, kind, items):
+        import requests
+
+        for neighbour in self._get_neighbours() or []:
+            unseen = [(i, data) for i, data in items if not self.is_seen(neighbour, i)]
+            if not unseen:
+                continue
+            try:
+                response = self._session(neighbour).post(
+                    f"http://{neighbour}/{PATHS[kind]}",
+                    timeout=GOSSIP_TIMEOUT_SEC,
+                    **self._payload(kind, [data for _, data in unseen]),
+                )
+                response.raise_for_status()
+            except requests.RequestException as ex:
+                logger.error({"action": "gossip", "neighbour": neighbour, "ex": ex})
+                continue
+            self.mark_seen(neighbour, [i for i, _ in unseen])
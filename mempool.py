@@ -0,0 +1,119 @@
+import collections
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+MEMPOOL_MAX_SIZE = 10000  # プールに保持するトランザクションの最大数
+MEMPOOL_MAX_PER_SENDER = 1000  # 1つの送信者アドレスがプールに置けるトランザクションの最大数
+
+
+class TransactionPool(object):
+    # トランザクションプール（mempool）
+    # ハッシュ値と送信者アドレス（送信者ごとにナンス）でインデックスし、優先度の高い順にブロックへ取り出す
+    def __init__(self, max_size=MEMPOOL_MAX_SIZE, max_per_sender=MEMPOOL_MAX_PER_SENDER):
+        self.max_size = max_size
+        self.max_per_sender = max_per_sender
+        # ハッシュ値→(優先度, 到着順, トランザクション)。dictなので到着順も保持される
+        self._entries = {}
+        # 送信者アドレス→{ナンス: ハッシュ値}
+        self._by_sender = collections.defaultdict(dict)
+        # 送信者アドレス→プールにある送金額の合計（残高の確認で、まだブロックに入っていない分を差し引く）
+        self._spending = collections.defaultdict(float)
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        # 到着順にトランザクションを返す
+        for _, _, transaction in self._entries.values():
+            yield transaction
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self._entries
+
+    def add(self, transaction, priority=None):
+        # 追加できればハッシュ値を、重複や上限超過の場合はNoneを返す
+        # 手数料のフィールドがないので、優先度を指定しない場合は送金額を優先度とする
+        # マイニング報酬はプールを通さないので、どのトランザクションも上限を超えては入らない
+        # transaction: models.Transaction
+        # 内容（署名を含む）のハッシュ値を重複検知のキーにする
+        # ecdsaの署名は毎回異なるので、同じ内容の送金を改めて署名したものは別のトランザクションとして扱われ、
+        # 同じ署名済みトランザクションの再送だけが重複になる
+        tx_hash = transaction.hash()
+        if tx_hash in self._entries:
+            logger.info({"action": "add", "error": "duplicate", "tx_hash": tx_hash})
+            return None
+        sender = transaction.sender_blockchain_address
+        if transaction.nonce in self._by_sender.get(sender, ()):
+            # 同じナンスのトランザクションは1つのブロックにしか入れられない
+            logger.error({"action": "add", "error": "nonce_used", "sender": sender})
+            return None
+        if len(self._entries) >= self.max_size:
+            logger.error({"action": "add", "error": "pool_full"})
+            return None
+        if len(self._by_sender.get(sender, ())) >= self.max_per_sender:
+            logger.error({"action": "add", "error": "sender_limit", "sender": sender})
+            return None
+        if priority is None:
+            priority = transaction.value
+        self._entries[tx_hash] = (priority, next(self._sequence), transaction)
+        self._by_sender[sender][transaction.nonce] = tx_hash
+        self._spending[sender] += transaction.value
+        return tx_hash
+
+    def get(self, tx_hash):
+        entry = self._entries.get(tx_hash)
+        return entry[2] if entry else None
+
+    def by_sender(self, sender_blockchain_address):
+        # ナンス順に返す
+        sender_hashes = self._by_sender.get(sender_blockchain_address, {})
+        return [self._entries[sender_hashes[n]][2] for n in sorted(sender_hashes)]
+
+    def next_nonce(self, sender_blockchain_address, nonce):
+        # nonce（確定済みの次のナンス）から、プールに続けて入っている分だけ進めたナンス
+        sender_hashes = self._by_sender.get(sender_blockchain_address, {})
+        while nonce in sender_hashes:
+            nonce += 1
+        return nonce
+
+    def spending(self, sender_blockchain_address):
+        return self._spending.get(sender_blockchain_address, 0.0)
+
+    def select(self, limit):
+        # 優先度の高い順（同じ優先度なら到着順）に最大limit件のハッシュ値を返す
+        # heapq.nsmallestはプール全体をコピー・ソートせず、limit件分のヒープだけを使う
+        # 同じ送信者のものは、その送信者の分の位置を使ってナンス順に並べ替える（ナンス順にしか取り込めないため）
+        selected = heapq.nsmallest(
+            limit, self._entries.items(), key=lambda item: (-item[1][0], item[1][1])
+        )
+        by_sender = collections.defaultdict(list)
+        for _, (_, _, transaction) in selected:
+            by_sender[transaction.sender_blockchain_address].append(transaction)
+        for transactions in by_sender.values():
+            transactions.sort(key=lambda t: t.nonce, reverse=True)
+        return [
+            by_sender[transaction.sender_blockchain_address].pop().hash()
+            for _, (_, _, transaction) in selected
+        ]
+
+    def remove(self, tx_hashes):
+        for tx_hash in tx_hashes:
+            entry = self._entries.pop(tx_hash, None)
+            if entry is None:
+                continue
+            sender = entry[2].sender_blockchain_address
+            sender_hashes = self._by_sender[sender]
+            del sender_hashes[entry[2].nonce]
+            self._spending[sender] -= entry[2].value
+            if not sender_hashes:
+                del self._by_sender[sender]
+                del self._spending[sender]
+
+    def clear(self):
+        self._entries.clear()
+        self._by_sender.clear()
+        self._spending.clear()
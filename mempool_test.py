@@ -0,0 +1,56 @@
+import mempool
+import models
+
+
+def transaction(sender, nonce, value=1.0, recipient="recipient"):
+    return models.Transaction(sender, recipient, value, nonce=nonce)
+
+
+def test_duplicate_and_reused_nonce_are_rejected():
+    pool = mempool.TransactionPool()
+    first = transaction("a", 0)
+    assert pool.add(first) == first.hash()
+    assert pool.add(first) is None
+    # 同じナンスで内容の違うもの
+    assert pool.add(transaction("a", 0, value=2.0)) is None
+    assert len(pool) == 1
+    assert pool.spending("a") == 1.0
+
+
+def test_size_caps():
+    pool = mempool.TransactionPool(max_size=3, max_per_sender=2)
+    assert pool.add(transaction("a", 0))
+    assert pool.add(transaction("a", 1))
+    assert pool.add(transaction("a", 2)) is None
+    assert pool.add(transaction("b", 0))
+    assert pool.add(transaction("c", 0)) is None
+    assert len(pool) == 3
+    # 取り除けば空いた分だけ入る
+    pool.remove([transaction("a", 0).hash()])
+    assert pool.add(transaction("c", 0))
+
+
+def test_select_orders_by_priority_and_keeps_nonce_order():
+    pool = mempool.TransactionPool()
+    # 送信者aはナンスの大きい方が送金額（優先度）が大きい
+    a0, a1 = transaction("a", 0, 1.0), transaction("a", 1, 5.0)
+    b0 = transaction("b", 0, 3.0)
+    c0 = transaction("c", 0, 0.5)
+    for t in (a1, b0, a0, c0):
+        pool.add(t)
+    selected = pool.select(3)
+    assert selected == [a0.hash(), b0.hash(), a1.hash()]
+    assert pool.select(10)[-1] == c0.hash()
+
+
+def test_next_nonce_and_remove():
+    pool = mempool.TransactionPool()
+    for nonce in (0, 1, 3):
+        pool.add(transaction("a", nonce))
+    assert pool.next_nonce("a", 0) == 2
+    assert pool.next_nonce("a", 2) == 2
+    assert [t.nonce for t in pool.by_sender("a")] == [0, 1, 3]
+    pool.remove([t.hash() for t in pool.by_sender("a")])
+    assert len(pool) == 0
+    assert pool.spending("a") == 0.0
+    assert pool.by_sender("a") == []
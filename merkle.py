@@ -0,0 +1,52 @@
+import hashlib
+
+# トランザクションのハッシュ値（16進数）を葉とするマークルツリー
+# 各段で隣り合う2つを連結してSHA-256を取り、奇数個の場合は最後の要素を複製する（ビットコインと同じ）
+
+
+def _parent(left, right):
+    return hashlib.sha256(left + right).digest()
+
+
+def merkle_root(tx_hashes):
+    # トランザクションがない場合は空のバイト列のハッシュ値をルートとする
+    if not tx_hashes:
+        return hashlib.sha256(b"").hexdigest()
+    level = [bytes().fromhex(h) for h in tx_hashes]
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [_parent(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+
+def merkle_proof(tx_hashes, index):
+    # index番目のトランザクションがルートに含まれることを示す証明（兄弟ノードのリスト）を返す
+    # position: 兄弟ノードが左右どちらにあるか
+    level = [bytes().fromhex(h) for h in tx_hashes]
+    proof = []
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        sibling = index ^ 1
+        proof.append(
+            {
+                "hash": level[sibling].hex(),
+                "position": "left" if sibling < index else "right",
+            }
+        )
+        level = [_parent(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(tx_hash, proof, root):
+    # ブロック全体をダウンロードしなくても、証明とルートだけで検証できる
+    current = bytes().fromhex(tx_hash)
+    for node in proof:
+        sibling = bytes().fromhex(node["hash"])
+        if node["position"] == "left":
+            current = _parent(sibling, current)
+        else:
+            current = _parent(current, sibling)
+    return current.hex() == root
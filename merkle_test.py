@@ -0,0 +1,35 @@
+import hashlib
+
+import pytest
+
+import merkle
+
+
+def tx_hashes(count):
+    return [hashlib.sha256(str(i).encode()).hexdigest() for i in range(count)]
+
+
+@pytest.mark.parametrize("count", range(1, 10))
+def test_every_proof_verifies(count):
+    hashes = tx_hashes(count)
+    root = merkle.merkle_root(hashes)
+    for index, tx_hash in enumerate(hashes):
+        assert merkle.verify_merkle_proof(tx_hash, merkle.merkle_proof(hashes, index), root)
+
+
+def test_proof_rejects_other_transaction_and_root():
+    hashes = tx_hashes(5)
+    root = merkle.merkle_root(hashes)
+    proof = merkle.merkle_proof(hashes, 2)
+    assert not merkle.verify_merkle_proof(hashes[3], proof, root)
+    assert not merkle.verify_merkle_proof(hashes[2], proof, merkle.merkle_root(hashes[:4]))
+
+
+def test_single_transaction_root_is_its_hash():
+    hashes = tx_hashes(1)
+    assert merkle.merkle_root(hashes) == hashes[0]
+    assert merkle.merkle_proof(hashes, 0) == []
+
+
+def test_empty_root():
+    assert merkle.merkle_root([]) == hashlib.sha256(b"").hexdigest()
@@ -0,0 +1,154 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+# Prometheusのテキスト形式で出力できる簡易メトリクス（prometheus_clientを使わずに標準ライブラリだけで実装）
+# 計測する側はロック1回と数値の加算だけなので、ホットパスに置いてもほとんど遅くならない
+#   PROOF_OF_WORK_SECONDS = metrics.Histogram("blockchain_proof_of_work_seconds", "...")
+#   with PROOF_OF_WORK_SECONDS.time():
+#       ...
+#   metrics.render()  # /metricsで返す文字列
+
+# 秒単位のヒストグラムのバケット（上限値）
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+# 作成されたメトリクス（render()で出力する順）
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, register=True):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        # ラベルのタプル→値
+        self._values = {}
+        if register:
+            REGISTRY.append(self)
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        # (サンプル名, ラベルのタプル, 値)のリスト
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS, register=True):
+        super().__init__(name, documentation, register)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        # バケットごとの件数（累積ではない）、合計、件数を持ち、出力時に累積にする
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (key, list(counts), total, count)
+                for key, (counts, total, count) in sorted(self._values.items())
+            ]
+        samples = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append(
+                    (f"{self.name}_bucket", key + (("le", _format_value(float(bound))),), cumulative)
+                )
+            samples.append((f"{self.name}_sum", key, total))
+            samples.append((f"{self.name}_count", key, count))
+        return samples
+
+
+def timed(histogram, **labels):
+    # 関数の実行時間をhistogramに記録するデコレーター
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render(registry=None):
+    # Prometheusのテキスト形式（text/plain; version=0.0.4）
+    lines = []
+    for metric in REGISTRY if registry is None else registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
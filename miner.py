@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MINING_POOL_THRESHOLD = 100  # プールのトランザクションがこの数に達したらすぐにマイニングする
+MINING_MAX_WAIT_SEC = 20  # 前回のマイニングからこの時間が経ったらトランザクションが少なくてもマイニングする
+MINING_POLL_SEC = 0.5  # プールの大きさを確認する間隔
+
+
+class MiningScheduler(object):
+    # バックグラウンドでマイニングを続けるスケジューラー
+    # 一定間隔（MINING_TIMER_SEC）ごとではなく、プールが一定数に達したか、最大待ち時間が過ぎたら次のラウンドを始める
+    def __init__(
+        self, block_chain, pool_threshold=MINING_POOL_THRESHOLD,
+        max_wait_sec=MINING_MAX_WAIT_SEC, poll_sec=MINING_POLL_SEC,
+        parallel=False, mine_empty=True,
+    ):
+        self.block_chain = block_chain
+        self.pool_threshold = pool_threshold
+        self.max_wait_sec = max_wait_sec
+        self.poll_sec = poll_sec
+        self.parallel = parallel
+        # 最大待ち時間が過ぎた時にプールが空でも報酬だけのブロックを作るか
+        self.mine_empty = mine_empty
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.is_running:
+                return False
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        logger.info({"action": "mining_scheduler", "status": "started"})
+        return True
+
+    def stop(self, timeout=None):
+        # 実行中のProof of Workもキャンセルする
+        with self._lock:
+            if not self.is_running:
+                return False
+            self._stop_event.set()
+            thread = self._thread
+        thread.join(timeout)
+        logger.info({"action": "mining_scheduler", "status": "stopped"})
+        return True
+
+    def should_mine(self, waited_sec):
+        pool_size = len(self.block_chain.transaction_pool)
+        if pool_size >= self.pool_threshold:
+            return True
+        if waited_sec >= self.max_wait_sec:
+            return pool_size > 0 or self.mine_empty
+        return False
+
+    def _run(self):
+        last_mined = time.monotonic()
+        while not self._stop_event.wait(self.poll_sec):
+            if not self.should_mine(time.monotonic() - last_mined):
+                continue
+            try:
+                self.block_chain.mining(
+                    parallel=self.parallel, allow_empty=True,
+                    cancel_event=self._stop_event,
+                )
+            except Exception as ex:
+                logger.error({"action": "mining_scheduler", "ex": ex})
+            last_mined = time.monotonic()
+
+    def metrics(self):
+        # ハッシュレートとブロックあたりの時間（ハードウェアの見積もり用）
+        history = list(self.block_chain.mining_history)
+        chain = self.block_chain.chain
+        attempts = sum(h["attempts"] for h in history)
+        seconds = sum(h["seconds"] for h in history)
+        recent = chain[-(len(history) + 1):] if history else []
+        block_interval = (
+            (recent[-1].timestamp - recent[0].timestamp) / (len(recent) - 1)
+            if len(recent) > 1 else None
+        )
+        return {
+            "running": self.is_running,
+            "height": len(chain),
+            "difficulty": self.block_chain.next_difficulty(),
+            "blocks_mined": len(history),
+            "hashrate": attempts / seconds if seconds else None,
+            "average_proof_of_work_sec": seconds / len(history) if history else None,
+            "average_block_interval_sec": block_interval,
+            "pool_size": len(self.block_chain.transaction_pool),
+        }
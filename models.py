@@ -0,0 +1,337 @@
+import hashlib
+import struct
+
+import utils
+
+# ブロック・トランザクションのバイナリ形式
+# ハッシュ値の計算、署名、保存、ノード間の同期はすべてこの形式を使い、JSONはAPIで見せるためだけに使う
+#
+# Transaction:
+#   送信者アドレス(2バイト長+UTF-8) 受信者アドレス(2バイト長+UTF-8) 送金額(float64) ナンス(8)
+#   公開鍵(2バイト長+バイト列) 署名(2バイト長+バイト列)
+#   ※ 署名の対象はナンスまでの部分（signing_bytes）
+#   ※ ナンスは送信者ごとの通し番号（0から）。マイニング報酬はブロックの高さ
+# Block:
+#   前ブロックのハッシュ値(32) マークルルート(32) 難易度(1) ナンス(8) タイムスタンプ(float64)
+#   トランザクション数(4) トランザクション...
+#   ※ Proof of Workの対象はナンスまでの部分、ブロックのハッシュ値はタイムスタンプまでの部分（ヘッダー）
+#   ※ トランザクションを削除した（プルーニングした）ブロックはトランザクション数をPRUNEDにし、ヘッダーだけを持つ
+# ブロックとトランザクションは作成後に書き換えないので、ハッシュ値は最初に計算したものを保持して使い回す
+# （保存・受信したデータが改ざんされていないかを確かめる場合はcompute_hash()で計算し直す）
+LENGTH = struct.Struct(">H")
+COUNT = struct.Struct(">I")
+VALUE = struct.Struct(">d")
+PROOF_PREFIX = struct.Struct(">32s32sB")
+NONCE = struct.Struct(">Q")
+TIMESTAMP = struct.Struct(">d")
+HEADER_SIZE = PROOF_PREFIX.size + NONCE.size + TIMESTAMP.size
+PRUNED = 0xFFFFFFFF  # ヘッダーだけのブロックのトランザクション数
+
+
+def _pack_bytes(data):
+    return LENGTH.pack(len(data)) + data
+
+
+def _unpack_bytes(buffer, offset):
+    (length,) = LENGTH.unpack_from(buffer, offset)
+    offset += LENGTH.size
+    return bytes(buffer[offset:offset + length]), offset + length
+
+
+def _decode(cls, data):
+    # 途中で切れている・余分なバイトがあるなど、壊れたデータはValueErrorにする
+    try:
+        item, offset = cls.read(data)
+    except struct.error as ex:
+        raise ValueError(f"invalid {cls.__name__}: {ex}") from ex
+    if offset != len(data):
+        raise ValueError(f"invalid {cls.__name__}: {len(data) - offset} trailing bytes")
+    return item
+
+
+class Transaction(object):
+    __slots__ = (
+        "sender_blockchain_address",
+        "recipient_blockchain_address",
+        "value",
+        "nonce",
+        "sender_public_key",
+        "signature",
+        "_hash",
+    )
+
+    def __init__(
+        self, sender_blockchain_address, recipient_blockchain_address, value,
+        sender_public_key=None, signature=None, nonce=0,
+    ):
+        # sender_public_key, signature: bytes（マイニング報酬の場合はNone）
+        # nonce: 送信者がこれまでに送ったトランザクションの数（マイニング報酬の場合はブロックの高さ）
+        self.sender_blockchain_address = sender_blockchain_address
+        self.recipient_blockchain_address = recipient_blockchain_address
+        self.value = float(value)
+        self.nonce = int(nonce)
+        self.sender_public_key = sender_public_key
+        self.signature = signature
+        self._hash = None
+
+    def __eq__(self, other):
+        return isinstance(other, Transaction) and self.to_bytes() == other.to_bytes()
+
+    def __repr__(self):
+        return f"Transaction({dict(self.to_dict())})"
+
+    def signing_bytes(self):
+        # 署名の対象（公開鍵と署名を除いた部分）
+        return (
+            _pack_bytes(self.sender_blockchain_address.encode("utf-8"))
+            + _pack_bytes(self.recipient_blockchain_address.encode("utf-8"))
+            + VALUE.pack(self.value)
+            + NONCE.pack(self.nonce)
+        )
+
+    def to_bytes(self):
+        return (
+            self.signing_bytes()
+            + _pack_bytes(self.sender_public_key or b"")
+            + _pack_bytes(self.signature or b"")
+        )
+
+    @classmethod
+    def read(cls, buffer, offset=0):
+        # bufferのoffsetから1つ読み出し、(トランザクション, 次のoffset)を返す
+        sender, offset = _unpack_bytes(buffer, offset)
+        recipient, offset = _unpack_bytes(buffer, offset)
+        (value,) = VALUE.unpack_from(buffer, offset)
+        offset += VALUE.size
+        (nonce,) = NONCE.unpack_from(buffer, offset)
+        offset += NONCE.size
+        sender_public_key, offset = _unpack_bytes(buffer, offset)
+        signature, offset = _unpack_bytes(buffer, offset)
+        transaction = cls(
+            sender.decode("utf-8"), recipient.decode("utf-8"), value,
+            sender_public_key or None, signature or None, nonce,
+        )
+        return transaction, offset
+
+    @classmethod
+    def from_bytes(cls, data):
+        return _decode(cls, data)
+
+    def hash(self):
+        if self._hash is None:
+            self._hash = self.compute_hash()
+        return self._hash
+
+    def compute_hash(self):
+        return hashlib.sha256(self.to_bytes()).hexdigest()
+
+    def with_signature(self, sender_public_key, signature):
+        return Transaction(
+            self.sender_blockchain_address, self.recipient_blockchain_address, self.value,
+            sender_public_key, signature, self.nonce,
+        )
+
+    def to_dict(self):
+        # APIで返すJSONの形（公開鍵と署名は16進数）
+        transaction = {
+            "sender_blockchain_address": self.sender_blockchain_address,
+            "recipient_blockchain_address": self.recipient_blockchain_address,
+            "value": self.value,
+            "nonce": self.nonce,
+        }
+        if self.signature is not None:
+            transaction["sender_public_key"] = self.sender_public_key.hex()
+            transaction["signature"] = self.signature.hex()
+        return utils.sorted_dict_by_key(transaction)
+
+    @staticmethod
+    def valid_nonce(nonce):
+        # JSONで受け取ったナンスがNONCE（8バイト）に収まる整数か
+        return isinstance(nonce, int) and not isinstance(nonce, bool) and 0 <= nonce < 1 << 64
+
+    @staticmethod
+    def valid_fields(sender_blockchain_address, recipient_blockchain_address, value):
+        # JSONで受け取ったアドレスが文字列で、送金額がVALUE（float64）に変換できる数値か
+        # （額が正かどうかはstate.State.check_transactionで確認する）
+        if not (
+            isinstance(sender_blockchain_address, str)
+            and isinstance(recipient_blockchain_address, str)
+            and isinstance(value, (int, float))
+            and not isinstance(value, bool)
+        ):
+            return False
+        try:
+            float(value)
+        except OverflowError:
+            return False
+        return True
+
+    @classmethod
+    def from_dict(cls, transaction):
+        # 型や16進数が不正な場合はValueErrorになる（nonceなどがない場合はKeyError）
+        sender_public_key = transaction.get("sender_public_key")
+        signature = transaction.get("signature")
+        nonce = transaction["nonce"]
+        if not cls.valid_nonce(nonce):
+            raise ValueError(f"invalid nonce: {nonce}")
+        if not cls.valid_fields(
+            transaction["sender_blockchain_address"],
+            transaction["recipient_blockchain_address"],
+            transaction["value"],
+        ):
+            raise ValueError("invalid address or value")
+        return cls(
+            transaction["sender_blockchain_address"],
+            transaction["recipient_blockchain_address"],
+            transaction["value"],
+            bytes().fromhex(sender_public_key) if sender_public_key else None,
+            bytes().fromhex(signature) if signature else None,
+            nonce,
+        )
+
+
+class Block(object):
+    __slots__ = (
+        "previous_hash",
+        "merkle_root",
+        "difficulty",
+        "nonce",
+        "timestamp",
+        "transactions",
+        "_hash",
+    )
+
+    def __init__(
+        self, previous_hash, merkle_root, difficulty, nonce, timestamp, transactions,
+        block_hash=None,
+    ):
+        # previous_hash, merkle_root: 16進数の文字列
+        # transactions: Transactionのリスト（ヘッダーだけのブロックの場合はNone）
+        # block_hash: ハッシュ値が分かっている場合（保存済みのブロックなど）は指定すると計算しない
+        self.previous_hash = previous_hash
+        self.merkle_root = merkle_root
+        self.difficulty = difficulty
+        self.nonce = nonce
+        self.timestamp = timestamp
+        self.transactions = transactions
+        self._hash = block_hash
+
+    def __eq__(self, other):
+        return isinstance(other, Block) and self.to_bytes() == other.to_bytes()
+
+    def __repr__(self):
+        count = "pruned" if self.pruned else len(self.transactions)
+        return f"Block(hash={self.hash()}, transactions={count})"
+
+    @property
+    def pruned(self):
+        return self.transactions is None
+
+    def header(self):
+        # トランザクションを除いた、ヘッダーだけのブロック（ハッシュ値は変わらない）
+        return Block(
+            self.previous_hash, self.merkle_root, self.difficulty, self.nonce, self.timestamp, None,
+            self._hash,
+        )
+
+    @staticmethod
+    def proof_prefix(previous_hash, merkle_root, difficulty):
+        # Proof of Workの対象のうち、ナンスより前の固定長の部分
+        return PROOF_PREFIX.pack(
+            bytes().fromhex(previous_hash), bytes().fromhex(merkle_root), difficulty
+        )
+
+    def header_bytes(self):
+        return (
+            self.proof_prefix(self.previous_hash, self.merkle_root, self.difficulty)
+            + NONCE.pack(self.nonce)
+            + TIMESTAMP.pack(self.timestamp)
+        )
+
+    def hash(self):
+        if self._hash is None:
+            self._hash = self.compute_hash()
+        return self._hash
+
+    def compute_hash(self):
+        # ブロックのハッシュ値はヘッダー（固定長）だけから計算する
+        return hashlib.sha256(self.header_bytes()).hexdigest()
+
+    def to_bytes(self):
+        if self.pruned:
+            return self.header_bytes() + COUNT.pack(PRUNED)
+        return b"".join(
+            [self.header_bytes(), COUNT.pack(len(self.transactions))]
+            + [t.to_bytes() for t in self.transactions]
+        )
+
+    @classmethod
+    def read(cls, buffer, offset=0):
+        previous_hash, merkle_root, difficulty = PROOF_PREFIX.unpack_from(buffer, offset)
+        offset += PROOF_PREFIX.size
+        (nonce,) = NONCE.unpack_from(buffer, offset)
+        offset += NONCE.size
+        (timestamp,) = TIMESTAMP.unpack_from(buffer, offset)
+        offset += TIMESTAMP.size
+        (count,) = COUNT.unpack_from(buffer, offset)
+        offset += COUNT.size
+        transactions = None if count == PRUNED else []
+        for _ in range(0 if count == PRUNED else count):
+            transaction, offset = Transaction.read(buffer, offset)
+            transactions.append(transaction)
+        block = cls(
+            previous_hash.hex(), merkle_root.hex(), difficulty, nonce, timestamp, transactions
+        )
+        return block, offset
+
+    @classmethod
+    def from_bytes(cls, data, block_hash=None):
+        # block_hash: 保存済みのハッシュ値（指定するとhash()で計算し直さない）
+        block = _decode(cls, data)
+        block._hash = block_hash
+        return block
+
+    def to_dict(self):
+        return utils.sorted_dict_by_key(
+            {
+                "timestamp": self.timestamp,
+                "transactions": None if self.pruned else [t.to_dict() for t in self.transactions],
+                "merkle_root": self.merkle_root,
+                "difficulty": self.difficulty,
+                "nonce": self.nonce,
+                "previous_hash": self.previous_hash,
+            }
+        )
+
+    @classmethod
+    def from_dict(cls, block):
+        return cls(
+            block["previous_hash"],
+            block["merkle_root"],
+            block["difficulty"],
+            block["nonce"],
+            block["timestamp"],
+            None if block["transactions"] is None
+            else [Transaction.from_dict(t) for t in block["transactions"]],
+        )
+
+
+def encode_frames(items):
+    # バイト列のリストを(4バイト長+バイト列)の連続にする（ブロックをまとめて送る場合に使う）
+    return b"".join(COUNT.pack(len(item)) + item for item in items)
+
+
+def iter_frames(data):
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        if offset + COUNT.size > len(view):
+            raise ValueError("invalid frame")
+        (length,) = COUNT.unpack_from(view, offset)
+        offset += COUNT.size
+        yield view[offset:offset + length]
+        offset += length
+
+
+def decode_blocks(data):
+    return [Block.from_bytes(frame) for frame in iter_frames(data)]
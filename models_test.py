@@ -0,0 +1,94 @@
+import pytest
+
+import merkle
+import models
+import state
+import wallet
+
+
+def signed_transaction(value=0.5, nonce=3):
+    sender, recipient = wallet.Wallet(), wallet.Wallet()
+    signature = wallet.Transaction(
+        sender.private_key, sender.public_key, sender.blockchain_address,
+        recipient.blockchain_address, value, nonce,
+    ).generate_signature()
+    return models.Transaction(
+        sender.blockchain_address, recipient.blockchain_address, value,
+        bytes().fromhex(sender.public_key), bytes().fromhex(signature), nonce,
+    )
+
+
+def sample_block():
+    transactions = [
+        models.Transaction(state.MINING_SENDER, "miner", state.MINING_REWARD, nonce=7),
+        signed_transaction(),
+    ]
+    root = merkle.merkle_root([t.hash() for t in transactions])
+    return models.Block("ab" * 32, root, 2, 12345, 1700000000.25, transactions)
+
+
+def test_transaction_bytes_round_trip():
+    transaction = signed_transaction()
+    restored = models.Transaction.from_bytes(transaction.to_bytes())
+    assert restored == transaction
+    assert restored.nonce == 3
+    assert restored.hash() == transaction.hash()
+    # ナンスは署名の対象に含まれる
+    assert restored.signing_bytes() != models.Transaction(
+        restored.sender_blockchain_address, restored.recipient_blockchain_address,
+        restored.value, nonce=4,
+    ).signing_bytes()
+
+
+def test_transaction_dict_round_trip():
+    transaction = signed_transaction()
+    assert models.Transaction.from_dict(transaction.to_dict()) == transaction
+
+
+@pytest.mark.parametrize("nonce", [-1, 1 << 64, 1.0, True, "1"])
+def test_transaction_from_dict_rejects_invalid_nonce(nonce):
+    transaction = dict(signed_transaction().to_dict(), nonce=nonce)
+    with pytest.raises(ValueError):
+        models.Transaction.from_dict(transaction)
+
+
+@pytest.mark.parametrize("field, value", [
+    ("sender_blockchain_address", 1),
+    ("recipient_blockchain_address", None),
+    ("value", "1"),
+    ("value", True),
+    ("value", 10 ** 400),
+])
+def test_transaction_from_dict_rejects_invalid_fields(field, value):
+    transaction = dict(signed_transaction().to_dict(), **{field: value})
+    with pytest.raises(ValueError):
+        models.Transaction.from_dict(transaction)
+
+
+def test_block_bytes_round_trip():
+    block = sample_block()
+    restored = models.Block.from_bytes(block.to_bytes())
+    assert restored == block
+    assert restored.hash() == block.hash()
+    assert restored.transactions == block.transactions
+    assert models.Block.from_dict(block.to_dict()) == block
+
+
+def test_pruned_block_keeps_hash():
+    block = sample_block()
+    header = models.Block.from_bytes(block.header().to_bytes())
+    assert header.pruned
+    assert header.compute_hash() == block.compute_hash()
+
+
+def test_frames_round_trip():
+    blocks = [sample_block(), sample_block().header()]
+    assert models.decode_blocks(models.encode_frames([b.to_bytes() for b in blocks])) == blocks
+
+
+def test_corrupt_bytes_raise_value_error():
+    data = sample_block().to_bytes()
+    with pytest.raises(ValueError):
+        models.Block.from_bytes(data[:-1])
+    with pytest.raises(ValueError):
+        models.Block.from_bytes(data + b"\0")
@@ -0,0 +1,188 @@
+import collections
+import hashlib
+import math
+import struct
+
+import models
+
+# 残高の状態（アカウントモデル）
+# アドレス→残高と、アドレス→次に使うナンス（送ったトランザクションの数）をブロック単位で更新する
+# どちらもアカウントごとの値なので、状態の大きさはトランザクション数ではなくアカウント数に比例する
+# トランザクションは送信者ごとに0, 1, 2, ...の順にしか取り込めないので、
+# 確定済みのトランザクションの再送（二重使用）はナンスを比べるだけで分かる
+# ブロックの適用は「すべて検証してから反映」なので途中で失敗しても状態は変わらず、
+# 取り消し（ロールバック）はブロックの内容を逆に反映するだけなので、チェーンの付け替えは付け替えるブロック数に比例する
+
+# マイニング報酬の送信元。残高を持たないので、報酬は残高とナンスの確認の対象外とし、
+# 代わりに「1ブロックに1つまで、額はMINING_REWARD、ナンスはブロックの高さ」をapply_blockで確認する
+# （ナンスが高さなので、同じマイナーへの報酬でも毎回別のIDになる）
+# 報酬はマイニングでブロックを作るときにだけ入れるもので、プールには受け付けない
+MINING_SENDER = "THE BLOCKCHAIN"
+MINING_REWARD = 1.0  # マイニング報酬
+
+# スナップショット（ある高さでの状態）のバイナリ形式
+#   高さ(4) その高さのブロックのハッシュ値(32)
+#   アドレス数(4) [アドレス(2バイト長+UTF-8) 残高(float64) ナンス(8)]...
+SNAPSHOT_HEADER = struct.Struct(">I32s")
+
+
+class State(object):
+    def __init__(self):
+        self.balances = collections.defaultdict(float)
+        # アドレス→次に使うナンス（0のアドレスは持たない）
+        self.nonces = {}
+
+    def balance(self, blockchain_address):
+        return self.balances.get(blockchain_address, 0.0)
+
+    def nonce(self, blockchain_address):
+        return self.nonces.get(blockchain_address, 0)
+
+    def is_confirmed(self, transaction):
+        # 送信者のナンスがすでに先に進んでいれば、このトランザクション（または同じナンスの別のもの）は確定済み
+        return transaction.nonce < self.nonce(transaction.sender_blockchain_address)
+
+    def check_transaction(self, transaction, pending=0.0):
+        # トランザクションを受け付けられるか確認し、問題があればその理由を返す（問題なければNone）
+        # pending: 同じ送信者の、まだブロックに入っていない送金の合計
+        # ナンスは確定済みのものより前でなければよく、間が空いていてもプールには受け付ける
+        if not math.isfinite(transaction.value) or transaction.value <= 0:
+            return "invalid_value"
+        if transaction.sender_blockchain_address == MINING_SENDER:
+            return "reward"
+        if self.is_confirmed(transaction):
+            return "double_spend"
+        if self.balance(transaction.sender_blockchain_address) - pending < transaction.value:
+            return "no_value"
+        return None
+
+    def select(self, transactions):
+        # 次のブロックに入れられるトランザクションだけを、順序を保って選ぶ
+        # 送信者ごとにナンスが続いているものだけを選び、間が空いているもの（前のナンスがまだないもの）は
+        # どちらにも含めない（プールに残して、前のナンスが届くのを待つ）
+        # 戻り値: (入れられるもの, 入れられないもの)
+        spent = collections.defaultdict(float)
+        nonces = {}
+        valid, invalid = [], []
+        for transaction in transactions:
+            sender = transaction.sender_blockchain_address
+            nonce = nonces.get(sender, self.nonce(sender))
+            if transaction.nonce > nonce:
+                continue
+            if transaction.nonce < nonce or self.check_transaction(transaction, spent[sender]):
+                invalid.append(transaction)
+                continue
+            nonces[sender] = nonce + 1
+            spent[sender] += transaction.value
+            valid.append(transaction)
+        return valid, invalid
+
+    def apply_block(self, block, height):
+        # height番目のブロックを検証してから状態に反映する（検証に失敗した場合は何も変えずにFalse）
+        # ローカルのマイニング、保存済みチェーンの読み込み、チェーンの置き換え、インポートのどれもここを通る
+        rewards = [
+            t for t in block.transactions if t.sender_blockchain_address == MINING_SENDER
+        ]
+        if len(rewards) > 1 or any(
+            t.value != MINING_REWARD or t.nonce != height for t in rewards
+        ):
+            return False
+        transactions = [
+            t for t in block.transactions if t.sender_blockchain_address != MINING_SENDER
+        ]
+        valid, _ = self.select(transactions)
+        if len(valid) != len(transactions):
+            return False
+        self._apply(block, 1)
+        return True
+
+    def rollback_block(self, block):
+        # apply_blockで反映したブロックを取り消す（新しいブロックから順に取り消すこと）
+        self._apply(block, -1)
+
+    def copy(self):
+        state = State()
+        state.balances.update(self.balances)
+        state.nonces.update(self.nonces)
+        return state
+
+    def to_bytes(self):
+        # 残高もナンスも0のアドレスは含めない。同じ状態からは常に同じバイト列になるようにソートする
+        addresses = sorted(
+            {a for a, v in self.balances.items() if v} | self.nonces.keys()
+        )
+        parts = [models.COUNT.pack(len(addresses))]
+        for address in addresses:
+            parts.append(models._pack_bytes(address.encode("utf-8")))
+            parts.append(models.VALUE.pack(self.balance(address)))
+            parts.append(models.NONCE.pack(self.nonce(address)))
+        return b"".join(parts)
+
+    @classmethod
+    def read(cls, buffer, offset=0):
+        state = cls()
+        (count,) = models.COUNT.unpack_from(buffer, offset)
+        offset += models.COUNT.size
+        for _ in range(count):
+            address, offset = models._unpack_bytes(buffer, offset)
+            address = address.decode("utf-8")
+            (value,) = models.VALUE.unpack_from(buffer, offset)
+            offset += models.VALUE.size
+            (nonce,) = models.NONCE.unpack_from(buffer, offset)
+            offset += models.NONCE.size
+            if value:
+                state.balances[address] = value
+            if nonce:
+                state.nonces[address] = nonce
+        return state, offset
+
+    def _apply(self, block, sign):
+        for transaction in block.transactions:
+            value = transaction.value * sign
+            self.balances[transaction.recipient_blockchain_address] += value
+            sender = transaction.sender_blockchain_address
+            if sender == MINING_SENDER:
+                continue
+            self.balances[sender] -= value
+            nonce = self.nonce(sender) + sign
+            if nonce:
+                self.nonces[sender] = nonce
+            else:
+                del self.nonces[sender]
+
+
+class Snapshot(object):
+    # height番目のブロック（ハッシュ値block_hash）までを適用した状態
+    # 新しいノードはスナップショットとそこまでのヘッダーだけを取得し、それより後のブロックだけを検証して同期する
+    # stateはこのスナップショット専用のコピーで書き換えないので、バイナリ形式は最初に作ったものを使い回す
+    __slots__ = ("height", "block_hash", "state", "_bytes")
+
+    def __init__(self, height, block_hash, state):
+        self.height = height
+        self.block_hash = block_hash
+        self.state = state
+        self._bytes = None
+
+    def __repr__(self):
+        return f"Snapshot(height={self.height}, block_hash={self.block_hash})"
+
+    def to_bytes(self):
+        if self._bytes is None:
+            self._bytes = (
+                SNAPSHOT_HEADER.pack(self.height, bytes().fromhex(self.block_hash))
+                + self.state.to_bytes()
+            )
+        return self._bytes
+
+    @classmethod
+    def read(cls, buffer, offset=0):
+        height, block_hash = SNAPSHOT_HEADER.unpack_from(buffer, offset)
+        state, offset = State.read(buffer, offset + SNAPSHOT_HEADER.size)
+        return cls(height, block_hash.hex(), state), offset
+
+    @classmethod
+    def from_bytes(cls, data):
+        return models._decode(cls, data)
+
+    def hash(self):
+        return hashlib.sha256(self.to_bytes()).hexdigest()
@@ -0,0 +1,97 @@
+import models
+import state
+
+ALICE = "alice"
+BOB = "bob"
+
+
+def reward(recipient, height):
+    return models.Transaction(state.MINING_SENDER, recipient, state.MINING_REWARD, nonce=height)
+
+
+def block(transactions):
+    return models.Block("0" * 64, "0" * 64, 1, 0, 0.0, transactions)
+
+
+def funded():
+    # 高さ1のブロックでALICEに報酬を入れた状態
+    s = state.State()
+    assert s.apply_block(block([reward(ALICE, 1)]), 1)
+    return s
+
+
+def test_apply_and_rollback_round_trip():
+    s = funded()
+    before = s.to_bytes()
+    b = block([
+        reward(BOB, 2),
+        models.Transaction(ALICE, BOB, 0.25, nonce=0),
+        models.Transaction(ALICE, BOB, 0.5, nonce=1),
+    ])
+    assert s.apply_block(b, 2)
+    assert s.balance(ALICE) == 0.25
+    assert s.balance(BOB) == 1.75
+    assert s.nonce(ALICE) == 2
+    s.rollback_block(b)
+    assert s.to_bytes() == before
+    assert s.nonce(ALICE) == 0
+    assert BOB not in s.nonces
+
+
+def test_failed_apply_leaves_state_unchanged():
+    s = funded()
+    before = s.to_bytes()
+    # 2つ目で残高が足りない
+    b = block([
+        models.Transaction(ALICE, BOB, 0.75, nonce=0),
+        models.Transaction(ALICE, BOB, 0.5, nonce=1),
+    ])
+    assert not s.apply_block(b, 2)
+    assert s.to_bytes() == before
+
+
+def test_replay_and_nonce_gap_are_rejected():
+    s = funded()
+    sent = models.Transaction(ALICE, BOB, 0.25, nonce=0)
+    assert s.apply_block(block([sent]), 2)
+    assert s.check_transaction(sent) == "double_spend"
+    assert not s.apply_block(block([sent]), 3)
+    assert not s.apply_block(block([models.Transaction(ALICE, BOB, 0.25, nonce=2)]), 3)
+
+
+def test_select_keeps_gaps_out_of_both_lists():
+    s = funded()
+    first = models.Transaction(ALICE, BOB, 0.25, nonce=0)
+    gap = models.Transaction(ALICE, BOB, 0.25, nonce=2)
+    replay = models.Transaction(ALICE, BOB, 0.25, nonce=0)
+    valid, invalid = s.select([first, gap, replay])
+    assert valid == [first]
+    assert invalid == [replay]
+
+
+def test_reward_rule():
+    s = state.State()
+    assert s.check_transaction(reward(ALICE, 1)) == "reward"
+    # 1ブロックに1つまで
+    assert not s.apply_block(block([reward(ALICE, 1), reward(BOB, 1)]), 1)
+    # 額はMINING_REWARD
+    too_much = models.Transaction(state.MINING_SENDER, ALICE, state.MINING_REWARD * 2, nonce=1)
+    assert not s.apply_block(block([too_much]), 1)
+    # ナンスはブロックの高さ
+    assert not s.apply_block(block([reward(ALICE, 2)]), 1)
+    assert s.to_bytes() == state.State().to_bytes()
+    assert s.apply_block(block([reward(ALICE, 1)]), 1)
+    assert s.balance(ALICE) == state.MINING_REWARD
+    # 報酬の送信元はナンスを持たない
+    assert s.nonce(state.MINING_SENDER) == 0
+
+
+def test_snapshot_round_trip():
+    s = funded()
+    assert s.apply_block(block([models.Transaction(ALICE, BOB, 0.25, nonce=0)]), 2)
+    snapshot = state.Snapshot(2, "ab" * 32, s)
+    restored = state.Snapshot.from_bytes(snapshot.to_bytes())
+    assert (restored.height, restored.block_hash) == (2, "ab" * 32)
+    assert dict(restored.state.balances) == dict(s.balances)
+    assert restored.state.nonces == s.nonces
+    assert restored.hash() == snapshot.hash()
@@ -0,0 +1,137 @@
+import logging
+import sqlite3
+import threading
+
+import models
+import state
+
+logger = logging.getLogger(__name__)
+
+# ブロックを1行ずつ追記していくテーブル
+# 高さ(height)を主キー、ブロックのハッシュ値(hash)にもインデックスを張る
+# ブロックはmodels.Blockのバイナリ形式（BLOB）で保存する
+CREATE_BLOCKS_TABLE = """
+CREATE TABLE IF NOT EXISTS blocks (
+    height INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    block BLOB NOT NULL
+)
+"""
+
+# 最新のスナップショット（state.Snapshotのバイナリ形式）を1行だけ保存するテーブル
+CREATE_SNAPSHOTS_TABLE = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    height INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL,
+    snapshot BLOB NOT NULL
+)
+"""
+
+
+def _loads(data, block_hash=None):
+    return models.Block.from_bytes(data, block_hash)
+
+
+class BlockStore(object):
+    # SQLite（標準ライブラリ）を使った追記型のブロック保存先
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # WALモードにすると追記のたびにファイル全体を書き直さずに済む
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(CREATE_BLOCKS_TABLE)
+        self._connection.execute(CREATE_SNAPSHOTS_TABLE)
+        self._connection.commit()
+
+    def __len__(self):
+        # 主キーの最大値だけを見るので、ブロック数に比例したコストはかからない
+        with self._lock:
+            row = self._connection.execute("SELECT MAX(height) FROM blocks").fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def append(self, height, block_hash, block):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO blocks (height, hash, block) VALUES (?, ?, ?)",
+                (height, block_hash, block.to_bytes()),
+            )
+
+    def extend(self, from_height, block_hashes, blocks):
+        # from_heightから連続するブロックを1つのトランザクションでまとめて追記する
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO blocks (height, hash, block) VALUES (?, ?, ?)",
+                [
+                    (height, block_hash, block.to_bytes())
+                    for height, (block_hash, block) in enumerate(
+                        zip(block_hashes, blocks), from_height
+                    )
+                ],
+            )
+
+    def iter_blocks(self, from_height=0):
+        # (ハッシュ値, ブロック)を1つずつ読み出す（チェーン全体を一度に読み込まない）
+        for block_hash, data in self.iter_block_bytes(from_height):
+            yield block_hash, _loads(data, block_hash)
+
+    def iter_block_bytes(self, from_height=0):
+        # (ハッシュ値, バイナリ形式)を1つずつ読み出す（エクスポートなど、ブロックに復元しなくてよい場合）
+        cursor = self._connection.cursor()
+        cursor.execute(
+            "SELECT hash, block FROM blocks WHERE height >= ? ORDER BY height",
+            (from_height,),
+        )
+        yield from cursor
+
+    def get_by_height(self, height):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT block, hash FROM blocks WHERE height = ?", (height,)
+            ).fetchone()
+        return _loads(*row) if row else None
+
+    def get_by_hash(self, block_hash):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT block FROM blocks WHERE hash = ?", (block_hash,)
+            ).fetchone()
+        return _loads(row[0], block_hash) if row else None
+
+    def truncate(self, height):
+        # height以上のブロックを削除する（チェーンを置き換える場合に使う）
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM blocks WHERE height >= ?", (height,))
+
+    def prune(self, blocks):
+        # blocks: (高さ, ヘッダーだけのブロック)のリスト。保存済みのブロックをヘッダーだけに置き換える
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "UPDATE blocks SET block = ? WHERE height = ?",
+                [(block.to_bytes(), height) for height, block in blocks],
+            )
+
+    def save_snapshot(self, snapshot):
+        # 古いスナップショットは残さない（チェーンの置き換えで高さが下がった場合も置き換える）
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM snapshots")
+            self._connection.execute(
+                "INSERT INTO snapshots (height, hash, snapshot) VALUES (?, ?, ?)",
+                (snapshot.height, snapshot.block_hash, snapshot.to_bytes()),
+            )
+
+    def delete_snapshot(self):
+        # チェーンをジェネシスブロックから置き換えた場合など、どの高さの状態も使えなくなった場合に使う
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM snapshots")
+
+    def load_snapshot(self):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT snapshot FROM snapshots ORDER BY height DESC LIMIT 1"
+            ).fetchone()
+        return state.Snapshot.from_bytes(row[0]) if row else None
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,61 @@
+import models
+import state
+import storage
+
+
+def blocks(count):
+    chain = []
+    previous_hash = "0" * 64
+    for height in range(count):
+        reward = models.Transaction(
+            state.MINING_SENDER, "miner", state.MINING_REWARD, nonce=height
+        )
+        block = models.Block(previous_hash, "1" * 64, 1, height, float(height), [reward])
+        chain.append(block)
+        previous_hash = block.hash()
+    return chain
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "chain.db")
+    store = storage.BlockStore(path)
+    chain = blocks(5)
+    store.append(0, chain[0].hash(), chain[0])
+    store.extend(1, [b.hash() for b in chain[1:]], chain[1:])
+    store.close()
+
+    store = storage.BlockStore(path)
+    assert len(store) == 5
+    assert [(h, b) for h, b in store.iter_blocks()] == [(b.hash(), b) for b in chain]
+    assert [h for h, _ in store.iter_blocks(3)] == [b.hash() for b in chain[3:]]
+    assert store.get_by_height(2) == chain[2]
+    assert store.get_by_hash(chain[4].hash()) == chain[4]
+    assert store.get_by_height(5) is None
+    assert store.get_by_hash("f" * 64) is None
+
+
+def test_truncate_and_prune(tmp_path):
+    store = storage.BlockStore(str(tmp_path / "chain.db"))
+    chain = blocks(5)
+    store.extend(0, [b.hash() for b in chain], chain)
+    store.truncate(3)
+    assert len(store) == 3
+    assert store.get_by_hash(chain[3].hash()) is None
+    store.prune([(0, chain[0].header()), (1, chain[1].header())])
+    stored = [b for _, b in store.iter_blocks()]
+    assert [b.pruned for b in stored] == [True, True, False]
+    assert [b.compute_hash() for b in stored] == [b.hash() for b in chain[:3]]
+
+
+def test_snapshot(tmp_path):
+    store = storage.BlockStore(str(tmp_path / "chain.db"))
+    assert store.load_snapshot() is None
+    balances = state.State()
+    balances.balances["miner"] = 2.0
+    store.save_snapshot(state.Snapshot(4, "ab" * 32, balances))
+    store.save_snapshot(state.Snapshot(2, "cd" * 32, balances))
+    snapshot = store.load_snapshot()
+    assert (snapshot.height, snapshot.block_hash) == (2, "cd" * 32)
+    assert snapshot.state.balance("miner") == 2.0
+    store.delete_snapshot()
+    assert store.load_snapshot() is None
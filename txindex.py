@@ -0,0 +1,82 @@
+import bisect
+import collections
+
+import state
+
+# トランザクションの検索用インデックス
+#   トランザクションID（ハッシュ値）→ 取り込まれた場所(高さ, ブロック内の位置)
+#   アドレス → そのアドレスが送信者・受信者のトランザクションの場所のリスト
+# どちらもブロックを追加・取り消すたびに差分で更新するので、検索のたびにチェーンを走査しない
+# IDには送信者のナンス（報酬の場合はブロックの高さ）が含まれ、同じナンスは1つのチェーンに1度しか入らないので、
+# 1つのIDの場所は1つだけになる
+# アドレスの場所のリストは常に(高さ, 位置)の昇順
+
+
+class TransactionIndex(object):
+    def __init__(self):
+        self._locations = {}
+        self._by_address = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self._locations)
+
+    def clear(self):
+        self._locations.clear()
+        self._by_address.clear()
+
+    @staticmethod
+    def _addresses(transaction):
+        addresses = {
+            transaction.sender_blockchain_address,
+            transaction.recipient_blockchain_address,
+        }
+        # 報酬の送信元は全ブロックに現れるので、アドレスのインデックスには入れない
+        addresses.discard(state.MINING_SENDER)
+        return addresses
+
+    def add_block(self, height, block):
+        # チェーンの末尾に追加されたブロック（高さの昇順に追加するので、末尾に足すだけでソート済みになる）
+        if block.pruned:
+            return
+        for position, transaction in enumerate(block.transactions):
+            location = (height, position)
+            self._locations[transaction.hash()] = location
+            for address in self._addresses(transaction):
+                self._by_address[address].append(location)
+
+    def remove_block(self, height, block):
+        # チェーンの置き換えで取り消したブロックや、プルーニングでトランザクションを削除したブロック
+        if block.pruned:
+            return
+        for position, transaction in enumerate(block.transactions):
+            location = (height, position)
+            tx_hash = transaction.hash()
+            if self._locations.get(tx_hash) == location:
+                del self._locations[tx_hash]
+            for address in self._addresses(transaction):
+                self._discard(self._by_address, address, location)
+
+    @staticmethod
+    def _discard(index, key, location):
+        locations = index.get(key)
+        if not locations:
+            return
+        i = bisect.bisect_left(locations, location)
+        if i < len(locations) and locations[i] == location:
+            del locations[i]
+        if not locations:
+            del index[key]
+
+    def location(self, tx_hash):
+        # (高さ, 位置)。チェーンに取り込まれていなければNone
+        return self._locations.get(tx_hash)
+
+    def history(self, blockchain_address, offset=0, limit=None):
+        # 新しい順に、offset件目から最大limit件の場所と、全件数を返す
+        locations = self._by_address.get(blockchain_address, ())
+        total = len(locations)
+        stop = total - offset
+        start = 0 if limit is None else max(stop - limit, 0)
+        if stop <= 0:
+            return [], total
+        return locations[start:stop][::-1], total
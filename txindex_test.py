@@ -0,0 +1,57 @@
+import models
+import state
+import txindex
+
+
+def reward(recipient, height):
+    return models.Transaction(state.MINING_SENDER, recipient, state.MINING_REWARD, nonce=height)
+
+
+def block(transactions):
+    return models.Block("0" * 64, "0" * 64, 1, 0, 0.0, transactions)
+
+
+def indexed_chain():
+    # 高さ1から4まで、各ブロックで報酬と"a"→"b"の送金を1つずつ取り込む
+    index = txindex.TransactionIndex()
+    blocks = [
+        block([reward("miner", height), models.Transaction("a", "b", 0.1, nonce=height - 1)])
+        for height in range(1, 5)
+    ]
+    for height, b in enumerate(blocks, 1):
+        index.add_block(height, b)
+    return index, blocks
+
+
+def test_location():
+    index, blocks = indexed_chain()
+    assert len(index) == 8
+    assert index.location(blocks[2].transactions[1].hash()) == (3, 1)
+    assert index.location("0" * 64) is None
+
+
+def test_history_is_newest_first_and_paginated():
+    index, _ = indexed_chain()
+    assert index.history("a") == ([(4, 1), (3, 1), (2, 1), (1, 1)], 4)
+    assert index.history("a", offset=1, limit=2) == ([(3, 1), (2, 1)], 4)
+    assert index.history("a", offset=3, limit=2) == ([(1, 1)], 4)
+    assert index.history("a", offset=4) == ([], 4)
+    assert index.history("a", limit=0) == ([], 4)
+    # 報酬の送信元はアドレスのインデックスに入れない
+    assert index.history(state.MINING_SENDER) == ([], 0)
+    assert index.history("miner", limit=1) == ([(4, 0)], 4)
+
+
+def test_remove_block():
+    index, blocks = indexed_chain()
+    index.remove_block(4, blocks[3])
+    index.remove_block(3, blocks[2])
+    assert index.location(blocks[3].transactions[1].hash()) is None
+    assert index.history("b") == ([(2, 1), (1, 1)], 2)
+    # ヘッダーだけのブロックは何もしない
+    index.remove_block(2, blocks[1].header())
+    assert len(index) == 4
+    index.remove_block(2, blocks[1])
+    index.remove_block(1, blocks[0])
+    assert len(index) == 0
+    assert index.history("a") == ([], 0)
@@ -1,10 +1,22 @@
 import collections
 import logging
+import os
 import re
 import socket
+import time
 
 logger = logging.getLogger(__name__)
 
+NEIGHBOURS_PROBE_TIMEOUT_SEC = 1  # 1つのhost:portへの接続を待つ時間
+NEIGHBOURS_MAX_CONCURRENCY = 256  # 同時に接続を試みる最大数
+NEIGHBOURS_CACHE_TTL_SEC = 60  # 見つかったノードを再確認せずに信頼する時間
+
+# 最近見つかったノードのアドレス→最後に見つかった時刻
+_seen_neighbours = {}
+
+# /proc/self/statがない環境で、起動からの時間の代わりに使う基準（このモジュールを読み込んだ時刻）
+_imported_at = time.monotonic()
+
 # 192.168.0.24とすると、(?P<prefix_host>^\\d{1,3}\\.\\d{1,3}\\.\\d{1,3}\\.)が192.168.0に相当
 # d{1,3}は1-3桁分という意味
 RE_IP = re.compile('(?P<prefix_host>^\\d{1,3}\\.\\d{1,3}\\.\\d{1,3}\\.)(?P<last_ip>\\d{1,3}$)')
@@ -19,6 +31,9 @@ def sorted_dict_by_key(unsorted_dict):
 def pprint(chains):
     for i, chain in enumerate(chains):
         print(f'{"="*25} Chain {i} {"="*25}')
+        # models.Blockの場合はAPIと同じ辞書の形にして表示する
+        if hasattr(chain, 'to_dict'):
+            chain = chain.to_dict()
         for k, v in chain.items():
             if k == "transactions":
                 print(k)
@@ -65,6 +80,82 @@ def find_neighbours(my_host, my_port, start_ip_range, end_ip_range, start_port,
                 neighbours.append(guess_address)
     return neighbours
 
+def _guess_addresses(my_host, my_port, start_ip_range, end_ip_range, start_port, end_port):
+    # 探索対象の(host, port)を列挙する（自分自身は除く）
+    m = RE_IP.search(my_host)
+    if not m:
+        return None
+    prefix_host = m.group('prefix_host')
+    last_ip = m.group('last_ip')
+
+    address = f'{my_host}:{my_port}'
+    candidates = []
+    for guess_port in range(start_port, end_port):
+        for ip_range in range(start_ip_range, end_ip_range):
+            guess_host = f'{prefix_host}{int(last_ip)+int(ip_range)}'
+            if f'{guess_host}:{guess_port}' != address:
+                candidates.append((guess_host, guess_port))
+    return candidates
+
+
+async def _probe_host(target, port, semaphore, timeout):
+    import asyncio
+
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(target, port), timeout
+            )
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+
+async def _probe_hosts(candidates, max_concurrency, timeout):
+    import asyncio
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    return await asyncio.gather(
+        *(_probe_host(host, port, semaphore, timeout) for host, port in candidates)
+    )
+
+
+def find_neighbours_concurrent(
+    my_host, my_port, start_ip_range, end_ip_range, start_port, end_port,
+    max_concurrency=NEIGHBOURS_MAX_CONCURRENCY, cache_ttl=NEIGHBOURS_CACHE_TTL_SEC,
+    timeout=NEIGHBOURS_PROBE_TIMEOUT_SEC,
+):
+    # find_neighboursと同じ範囲を、asyncioで同時に（最大max_concurrency個ずつ）探索する
+    # cache_ttl秒以内に見つかったノードは再確認せず、それ以外だけを探索し直す
+    # asyncioは読み込みに時間がかかるので、探索するときにimportする（--peersを指定した場合は使わない）
+    import asyncio
+
+    candidates = _guess_addresses(
+        my_host, my_port, start_ip_range, end_ip_range, start_port, end_port
+    )
+    if candidates is None:
+        return None
+
+    now = time.monotonic()
+    stale = [
+        (host, port) for host, port in candidates
+        if now - _seen_neighbours.get(f'{host}:{port}', float('-inf')) >= cache_ttl
+    ]
+    if stale:
+        results = asyncio.run(_probe_hosts(stale, max_concurrency, timeout))
+        for (host, port), is_found in zip(stale, results):
+            if is_found:
+                _seen_neighbours[f'{host}:{port}'] = now
+            else:
+                _seen_neighbours.pop(f'{host}:{port}', None)
+
+    return [
+        f'{host}:{port}' for host, port in candidates
+        if f'{host}:{port}' in _seen_neighbours
+    ]
+
+
 # 自分のホスト名/IPアドレスを取得する
 def get_host():
     try:
@@ -73,6 +164,19 @@ def get_host():
         logger.debug({'action': 'get_host', 'ex': ex})
     return '127.0.0.1'
 
+
+# プロセスが起動してから（インタープリターの起動を含む）の秒数
+# Linuxでは/proc/self/statの起動時刻（OSの起動からのクロック数なので0.01秒程度の精度）から求め、それ以外ではこのモジュールを読み込んでからの秒数
+def process_uptime():
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        # コマンド名に空白や括弧が入ることがあるので、最後の")"より後ろを分割する
+        started = int(stat[stat.rindex(')') + 2:].split()[19]) / os.sysconf('SC_CLK_TCK')
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+    except (OSError, ValueError, AttributeError):
+        return time.monotonic() - _imported_at
+
 if __name__ == '__main__':
     # print(is_found_host('127.0.0.1', 5100))
     # print(find_neighbours('192.168.1.3', 5100, 0, 3, 5100, 5103))
@@ -1,17 +1,43 @@
+import atexit
 import base58
 import codecs
+import concurrent.futures
+import functools
 import hashlib
 import binascii
+import multiprocessing
+import os
+import time
 
 from ecdsa import NIST256p
 from ecdsa import SigningKey
+from ecdsa.util import sigencode_string_canonize
 
+import models
 import utils
 
+WALLET_WORKERS = os.cpu_count() or 1  # ウォレットをまとめて生成するワーカープロセス数
+WALLET_CHUNK_SIZE = 64  # 1ワーカーが一度に生成するウォレット数
+VANITY_POLL_SEC = 0.1  # バニティアドレスの探索中にタイムアウトを確認する間隔
+SIGNING_KEY_CACHE_SIZE = 1024  # パース済みの秘密鍵を保持する最大数
+SIGN_WORKERS = os.cpu_count() or 1  # 署名をまとめて作成するワーカープロセス数
+SIGN_CHUNK_SIZE = 16  # ワーカーに一度に渡すトランザクション数（これ未満はその場で署名）
+# アドレスはネットワークバイト(00)から始まるので、Base58にすると必ず"1"から始まる
+ADDRESS_PREFIX = "1"
+
+# バニティアドレスの探索でワーカープロセス間で共有する「発見済み」フラグ
+_found_event = None
+
 
 class Wallet(object):
-    def __init__(self):
-        self._private_key = SigningKey.generate(curve=NIST256p)
+    def __init__(self, private_key=None):
+        # private_key: 既存の秘密鍵（16進数）から復元する場合に指定する
+        if private_key is None:
+            self._private_key = SigningKey.generate(curve=NIST256p)
+        else:
+            self._private_key = SigningKey.from_string(
+                bytes().fromhex(private_key), curve=NIST256p
+            )
         # 1. Creating a public key with ECDSA
         self._public_key = self._private_key.get_verifying_key()
         self._blockchain_address = self.generate_blockchain_address()
@@ -28,6 +54,13 @@ class Wallet(object):
     def blockchain_address(self):
         return self._blockchain_address
 
+    def to_dict(self):
+        return {
+            "private_key": self.private_key,
+            "public_key": self.public_key,
+            "blockchain_address": self.blockchain_address,
+        }
+
     def generate_blockchain_address(self):
         # 2. SHA-256 for the public key
         public_key_bytes = self._public_key.to_string()
@@ -67,6 +100,122 @@ class Wallet(object):
         return blockchain_address
 
 
+@functools.lru_cache(maxsize=SIGNING_KEY_CACHE_SIZE)
+def get_signing_key(sender_private_key):
+    # 同じ送信者の秘密鍵（16進数）を毎回パースしないようにキャッシュする
+    return SigningKey.from_string(bytes().fromhex(sender_private_key), curve=NIST256p)
+
+
+def load_or_create_wallet(path):
+    # path（1行目に秘密鍵の16進数、2行目にアドレスを書いたファイル）からウォレットを復元し、なければ生成して保存する
+    # 再起動しても同じアドレスで報酬を受け取れ、起動のたびに鍵を生成しなくて済む
+    # アドレスも書いておくのは、ノードが起動時に秘密鍵から計算し直さずに読めるようにするため
+    # （blockchain_server.read_miner_address。ecdsaを読み込まずに済む）
+    # 戻り値: (ウォレット, 新しく生成したか)
+    try:
+        with open(path) as f:
+            lines = f.read().split()
+    except FileNotFoundError:
+        lines = None
+    if lines is not None:
+        private_key, *address = lines or [""]
+        loaded = Wallet(private_key)
+        if not address:
+            # アドレスのない（秘密鍵だけの）ファイルは、アドレスを書き足したものに置き換える
+            temp_path = _write_wallet(path, loaded)
+            os.replace(temp_path, path)
+        return loaded, False
+    new_wallet = Wallet()
+    # 一時ファイルに書き終えてからリンクするので、同時に起動した別のプロセスが書きかけのファイルを読むことはなく、
+    # 先に作られていた場合はそちらを使う
+    temp_path = _write_wallet(path, new_wallet)
+    try:
+        os.link(temp_path, path)
+    except FileExistsError:
+        return load_or_create_wallet(path)
+    finally:
+        os.remove(temp_path)
+    return new_wallet, True
+
+
+def _write_wallet(path, wallet):
+    # 秘密鍵とアドレスを一時ファイルに書き、そのパスを返す
+    # 秘密鍵なので所有者だけが読めるようにする
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(wallet.private_key + "\n" + wallet.blockchain_address + "\n")
+    return temp_path
+
+
+def _generate_wallets(count):
+    return [Wallet().to_dict() for _ in range(count)]
+
+
+def generate_wallets(count, workers=WALLET_WORKERS, chunk_size=WALLET_CHUNK_SIZE):
+    # count個のウォレットをワーカープロセスで並列に生成し、できたものから辞書で返す（ジェネレーター）
+    # 鍵の生成（楕円曲線のスカラー倍）はpure PythonでGILを握るため、スレッドではなくプロセスで分ける
+    chunks = [min(chunk_size, count - i) for i in range(0, count, chunk_size)]
+    if workers <= 1 or len(chunks) <= 1:
+        for size in chunks:
+            yield from _generate_wallets(size)
+        return
+    with multiprocessing.Pool(min(workers, len(chunks))) as pool:
+        for wallets in pool.imap_unordered(_generate_wallets, chunks):
+            yield from wallets
+
+
+def valid_vanity_prefix(prefix):
+    # Base58で使える文字だけで、"1"から始まるか
+    alphabet = base58.alphabet.decode()
+    return prefix.startswith(ADDRESS_PREFIX) and all(c in alphabet for c in prefix)
+
+
+def _init_vanity_worker(found_event):
+    global _found_event
+    _found_event = found_event
+
+
+def _search_vanity(prefix):
+    # 他のワーカーが見つけるまでウォレットを生成し続ける
+    # 戻り値: (見つかったウォレットの辞書またはNone, 試行回数)
+    attempts = 0
+    while not _found_event.is_set():
+        candidate = Wallet()
+        attempts += 1
+        if candidate.blockchain_address.startswith(prefix):
+            _found_event.set()
+            return candidate.to_dict(), attempts
+    return None, attempts
+
+
+def find_vanity_address(prefix, workers=WALLET_WORKERS, timeout=None):
+    # アドレスがprefixから始まるウォレットを全コアで探す
+    # 1文字増えるごとに約58倍の試行が必要になる
+    # 戻り値: ウォレットの辞書（attempts, secondsを含む）。timeout秒以内に見つからなければNone
+    if not valid_vanity_prefix(prefix):
+        raise ValueError(f"invalid prefix: {prefix}")
+    started = time.monotonic()
+    found_event = multiprocessing.Event()
+    with multiprocessing.Pool(
+        workers, initializer=_init_vanity_worker, initargs=(found_event,)
+    ) as pool:
+        results = pool.imap_unordered(_search_vanity, [prefix] * workers)
+        while True:
+            if timeout is not None and time.monotonic() - started > timeout:
+                return None
+            try:
+                found, attempts = results.next(timeout=VANITY_POLL_SEC)
+            except multiprocessing.TimeoutError:
+                continue
+            if found is not None:
+                # withを抜けるとterminate()され、残りのワーカーも停止する
+                # 試行回数は最初に見つけたワーカーの分だけ（他のワーカーの分は含まない）
+                found["attempts"] = attempts
+                found["seconds"] = time.monotonic() - started
+                return found
+
+
 class Transaction(object):
     def __init__(
         self,
@@ -75,38 +224,79 @@ class Transaction(object):
         sender_blockchain_address,
         recipient_blockchain_address,
         value,
+        nonce=0,
     ):
+        # nonce: 送信者の次のナンス（ノードの/address/<address>/historyのnext_nonce）
         self.sender_private_key = sender_private_key
         self.sender_public_key = sender_public_key
         self.sender_blockchain_address = sender_blockchain_address
         self.recipient_blockchain_address = recipient_blockchain_address
         self.value = value
+        self.nonce = nonce
 
     def generate_signature(self):
         # トランザクションを生成
         sha256 = hashlib.sha256()
-        transaction = utils.sorted_dict_by_key(
-            {
-                "sender_blockchain_address": self.sender_blockchain_address,
-                "recipient_blockchain_address": self.recipient_blockchain_address,
-                "value": float(self.value),
-            }
+        transaction = models.Transaction(
+            self.sender_blockchain_address,
+            self.recipient_blockchain_address,
+            self.value,
+            nonce=self.nonce,
         )
-        # トランザクションをUTF-8に変換
-        sha256.update(str(transaction).encode("utf-8"))
+        # トランザクションをバイナリ形式に変換（公開鍵と署名を除いた部分）
+        sha256.update(transaction.signing_bytes())
         # メッセージを生成
         message = sha256.digest()
         # 公開鍵に適合する秘密鍵を取り出す
-        private_key = SigningKey.from_string(
-            bytes().fromhex(self.sender_private_key), curve=NIST256p
-        )
-        # 秘密鍵に署名する
-        private_key_sign = private_key.sign(message)
+        private_key = get_signing_key(self.sender_private_key)
+        # 秘密鍵に署名する（sを位数の半分以下にそろえる。ノードはそれ以外の署名を受け付けない）
+        private_key_sign = private_key.sign(message, sigencode=sigencode_string_canonize)
         # 署名を16進数に変換
         signature = private_key_sign.hex()
         return signature
 
 
+def _sign_transaction(transaction):
+    return Transaction(
+        transaction["sender_private_key"],
+        transaction["sender_public_key"],
+        transaction["sender_blockchain_address"],
+        transaction["recipient_blockchain_address"],
+        float(transaction["value"]),
+        transaction["nonce"],
+    ).generate_signature()
+
+
+_sign_executor = None
+
+
+def sign_transactions(transactions, workers=SIGN_WORKERS):
+    # transactions: Transactionの引数名をキーに持つ辞書のリスト（nonceも必要）
+    # 件数が多い場合はプロセスプールに分散して署名し、
+    # ノードの/transactions/batchにそのまま送れる辞書（秘密鍵を除き署名を加えたもの）のリストを返す
+    global _sign_executor
+    if workers <= 1 or len(transactions) < SIGN_CHUNK_SIZE:
+        signatures = [_sign_transaction(t) for t in transactions]
+    else:
+        if _sign_executor is None:
+            _sign_executor = concurrent.futures.ProcessPoolExecutor(workers)
+            atexit.register(_sign_executor.shutdown)
+        signatures = list(
+            _sign_executor.map(_sign_transaction, transactions, chunksize=SIGN_CHUNK_SIZE)
+        )
+    return [
+        {
+            "sender_blockchain_address": t["sender_blockchain_address"],
+            "recipient_blockchain_address": t["recipient_blockchain_address"],
+            "sender_public_key": t["sender_public_key"],
+            "value": float(t["value"]),
+            "nonce": t["nonce"],
+            "signature": signature,
+        }
+        for t, signature in zip(transactions, signatures)
+    ]
+
+
 if __name__ == "__main__":
     wallet_Miner = Wallet()
     wallet_A = Wallet()
@@ -118,6 +308,7 @@ if __name__ == "__main__":
         wallet_A.blockchain_address,
         wallet_B.blockchain_address,
         1.0,
+        0,
     )
 
     ############ Blockchain Node #############
@@ -132,6 +323,7 @@ if __name__ == "__main__":
         1.0,
         wallet_A.public_key,
         t.generate_signature(),
+        t.nonce,
     )
     print("Added?", is_added)
     block_chain.mining()
@@ -1,15 +1,54 @@
+import json
 import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
 
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import render_template
 from flask import request
+from ecdsa.errors import MalformedPointError
 
+import models
 import wallet
 
+WALLETS_MAX_COUNT = 100000  # /walletsで一度に生成できる最大数
+VANITY_MAX_TIMEOUT_SEC = 600  # /wallet/vanityの探索時間の上限
+GATEWAY_TIMEOUT_SEC = 3
+GATEWAY_BATCH_TIMEOUT_SEC = 60  # まとめて送る場合はノードでの署名の検証に時間がかかる
+GATEWAY_BATCH_SIZE = 1000  # ノードの/transactions/batchへ1リクエストで送る最大数
+GATEWAY_POOL_SIZE = 16  # ノードへのkeep-aliveコネクションの最大数
+
 app = Flask(__name__, template_folder="./templates")
 
+# ノードへのリクエストはコネクションを使い回す（トランザクションごとに接続しない）
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=GATEWAY_POOL_SIZE))
+
+REQUIRED_TRANSACTION_KEYS = (
+    "sender_private_key",
+    "sender_blockchain_address",
+    "recipient_blockchain_address",
+    "sender_public_key",
+    "value",
+)
+# "nonce"は省略でき、その場合はノードに問い合わせた送信者の次のナンスを使う
+
+
+def next_nonces(addresses):
+    # 送信者ごとの次のナンス（確定済みの分とノードのプールに入っている分の次）をノードに問い合わせる
+    nonces = {}
+    for address in set(addresses):
+        response = session.get(
+            urllib.parse.urljoin(app.config["gw"], f"address/{address}/history"),
+            params={"limit": 0},
+            timeout=GATEWAY_TIMEOUT_SEC,
+        )
+        response.raise_for_status()
+        nonces[address] = response.json()["next_nonce"]
+    return nonces
+
 
 @app.route("/")  # このパスに来たら
 def index():  # この関数を実行する
@@ -19,25 +58,45 @@ def index():  # この関数を実行する
 @app.route("/wallet", methods=["POST"])
 def create_wallet():
     my_wallet = wallet.Wallet()  # ウォレットを生成する
-    response = {
-        "private_key": my_wallet.private_key,
-        "public_key": my_wallet.public_key,
-        "blockchain_address": my_wallet.blockchain_address,
-    }
-    return jsonify(response), 200
+    return jsonify(my_wallet.to_dict()), 200
+
+
+@app.route("/wallets", methods=["POST"])
+def create_wallets():
+    # {"count": N} のウォレットを全コアで生成し、できたものから1行1ウォレットのNDJSONで返す
+    request_json = request.get_json(silent=True) or {}
+    count = request_json.get("count", request.args.get("count", type=int))
+    if not isinstance(count, int) or not 0 < count <= WALLETS_MAX_COUNT:
+        return jsonify({"message": f"count must be 1-{WALLETS_MAX_COUNT}"}), 400
+
+    def generate():
+        for created in wallet.generate_wallets(count):
+            yield json.dumps(created) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@app.route("/wallet/vanity", methods=["POST"])
+def create_vanity_wallet():
+    # {"prefix": "1abc", "timeout": 60} アドレスがprefixから始まるウォレットを全コアで探す
+    request_json = request.get_json(silent=True) or {}
+    prefix = request_json.get("prefix")
+    timeout = request_json.get("timeout", VANITY_MAX_TIMEOUT_SEC)
+    if not isinstance(prefix, str) or not wallet.valid_vanity_prefix(prefix):
+        return jsonify({"message": "prefix must start with 1 and use base58 characters"}), 400
+    if not isinstance(timeout, (int, float)) or timeout <= 0:
+        return jsonify({"message": "invalid timeout"}), 400
+
+    found = wallet.find_vanity_address(prefix, timeout=min(timeout, VANITY_MAX_TIMEOUT_SEC))
+    if found is None:
+        return jsonify({"message": "not found"}), 404
+    return jsonify(found), 200
 
 
 @app.route("/transaction", methods=["POST"])  # transactionパス宛にPOSTリクエストが来たら
 def create_transaction():  # 本関数を実行する（transactionを作成する）
     request_json = request.json
-    required = (
-        "sender_private_key",
-        "sender_blockchain_address",
-        "recipient_blockchain_address",
-        "sender_public_key",
-        "value",
-    )
-    if not all(k in request_json for k in required):
+    if not all(k in request_json for k in REQUIRED_TRANSACTION_KEYS):
         return "missing values", 400
 
     sender_private_key = request_json["sender_private_key"]
@@ -45,6 +104,15 @@ def create_transaction():  # 本関数を実行する（transactionを作成す
     recipient_blockchain_address = request_json["recipient_blockchain_address"]
     sender_public_key = request_json["sender_public_key"]
     value = float(request_json["value"])
+    nonce = request_json.get("nonce")
+    if nonce is None:
+        try:
+            nonce = next_nonces([sender_blockchain_address])[sender_blockchain_address]
+        except (requests.RequestException, KeyError, ValueError) as ex:
+            app.logger.error({"action": "transaction", "ex": ex})
+            return jsonify({"message": "gateway error"}), 502
+    if not models.Transaction.valid_nonce(nonce):
+        return "invalid nonce", 400
 
     transaction = wallet.Transaction(
         sender_private_key,
@@ -52,6 +120,7 @@ def create_transaction():  # 本関数を実行する（transactionを作成す
         sender_blockchain_address,
         recipient_blockchain_address,
         value,
+        nonce,
     )
 
     json_data = {
@@ -59,6 +128,7 @@ def create_transaction():  # 本関数を実行する（transactionを作成す
         "recipient_blockchain_address": recipient_blockchain_address,
         "sender_public_key": sender_public_key,
         "value": value,
+        "nonce": nonce,
         "signature": transaction.generate_signature(),
     }
 
@@ -67,10 +137,10 @@ def create_transaction():  # 本関数を実行する（transactionを作成す
     print("*********")
     print("json_data", json_data)
     print("*********")
-    response = requests.post(
+    response = session.post(
         urllib.parse.urljoin(app.config["gw"], "transactions"),
         json=json_data,
-        timeout=3,
+        timeout=GATEWAY_TIMEOUT_SEC,
     )
 
     if response.status_code == 201:
@@ -78,6 +148,79 @@ def create_transaction():  # 本関数を実行する（transactionを作成す
     return jsonify({"message": "fail", "response": response}), 400
 
 
+@app.route("/transactions/batch", methods=["POST"])
+def create_transactions_batch():
+    # {"transactions": [{/transactionと同じキー}, ...]} をワーカープロセスでまとめて署名し、
+    # ノードの/transactions/batchへGATEWAY_BATCH_SIZE件ずつ送る
+    request_json = request.get_json(silent=True)
+    if not request_json or not isinstance(request_json.get("transactions"), list):
+        return jsonify({"message": "missing values"}), 400
+    transactions = request_json["transactions"]
+
+    results = ["missing values"] * len(transactions)
+    complete = []
+    for i, t in enumerate(transactions):
+        if not isinstance(t, dict) or not all(k in t for k in REQUIRED_TRANSACTION_KEYS):
+            continue
+        try:
+            float(t["value"])
+            wallet.get_signing_key(t["sender_private_key"])
+            if "nonce" in t and not models.Transaction.valid_nonce(t["nonce"]):
+                raise ValueError(f"invalid nonce: {t['nonce']}")
+        except (TypeError, ValueError, MalformedPointError):
+            # 送金額や秘密鍵の形式が不正なものは署名しない
+            results[i] = "invalid values"
+            continue
+        complete.append(i)
+
+    # ナンスを省略したものには、送信者ごとにノードの次のナンスから順に振る
+    try:
+        nonces = next_nonces(
+            transactions[i]["sender_blockchain_address"]
+            for i in complete
+            if "nonce" not in transactions[i]
+        )
+    except (requests.RequestException, KeyError, ValueError) as ex:
+        app.logger.error({"action": "transactions_batch", "ex": ex})
+        nonces = None
+    for i in list(complete):
+        t = transactions[i]
+        if "nonce" in t:
+            continue
+        if nonces is None:
+            results[i] = "gateway error"
+            complete.remove(i)
+            continue
+        transactions[i] = dict(t, nonce=nonces[t["sender_blockchain_address"]])
+        nonces[t["sender_blockchain_address"]] += 1
+
+    signed = wallet.sign_transactions([transactions[i] for i in complete])
+    for start in range(0, len(complete), GATEWAY_BATCH_SIZE):
+        indexes = complete[start:start + GATEWAY_BATCH_SIZE]
+        try:
+            response = session.post(
+                urllib.parse.urljoin(app.config["gw"], "transactions/batch"),
+                json={"transactions": signed[start:start + GATEWAY_BATCH_SIZE]},
+                timeout=GATEWAY_BATCH_TIMEOUT_SEC,
+            )
+            node_results = response.json()["results"]
+        except (requests.RequestException, KeyError, ValueError) as ex:
+            app.logger.error({"action": "transactions_batch", "ex": ex})
+            for i in indexes:
+                results[i] = "gateway error"
+            continue
+        for i, node_result in zip(indexes, node_results):
+            results[i] = node_result["message"]
+
+    accepted = results.count("success")
+    response = {
+        "results": [{"index": i, "message": m} for i, m in enumerate(results)],
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+    }
+    return jsonify(response), 201 if accepted == len(results) else 200
+
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
 
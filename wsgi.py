@@ -0,0 +1,150 @@
+# 本番用のWSGIエントリーポイント（blockchain_server.pyの__main__はFlaskの開発サーバー）
+# ブロックチェーンの状態はプロセスのメモリ上にあるので、ワーカープロセスは必ず1つにしてスレッドで並行処理する
+# 本番モードでは
+#   - 署名の検証とProof of Workはワーカープロセスで行い、リクエストを処理するスレッドのGILを使わない
+#   - /mineはマイニングをバックグラウンドで始めて202を返す
+#   - チェーンとトランザクションプールの書き換えはBlockChain.lockで排他する
+#
+#   python wsgi.py -p 5100 --threads 16 --mine
+#   gunicorn -w 1 --threads 16 -b 0.0.0.0:5100 'wsgi:create_app(5100)'
+# waitressがインストールされていればwaitressで、なければwerkzeugのスレッドサーバーで動かす
+#
+# 起動を速くするため（オートスケールで増やしたノードがすぐにリクエストを受け付けられるように）
+#   - requests・ecdsaなどの読み込みに時間がかかるライブラリは使うときにimportする
+#   - 報酬を受け取る鍵はファイル（既定はminer_<port>.key）から読み込み、なければ生成して保存する
+#     ファイルにはアドレスも保存しておき、起動時に秘密鍵からアドレスを計算しない（ecdsaを読み込まない）
+#   - 隣のノードの探索と同期は、ポートで待ち受けを始めてからバックグラウンドで行う
+# 起動の各段階にかかった時間は{"action": "startup"}のログとblockchain_startup_secondsのメトリクスで確認できる
+import functools
+
+import blockchain_server
+
+WSGI_THREADS = 16  # リクエストを処理するスレッド数
+
+
+def create_app(
+    port, db=None, mine=False, sync=True, prune=False, verify=False,
+    peers=None, host=None, miner_key=None, trusted_snapshot=None, start_on_listen=False,
+):
+    # db: ブロックの保存先（省略時はblockchain_<port>.db、''の場合はメモリ上のみ）
+    # prune: 最新のスナップショットより十分古いブロックはヘッダーだけを残す
+    # verify: 読み込んだブロックのハッシュ値をすべて計算し直し、一致しなければ起動しない
+    # peers: 隣のノード（host:port）のリスト（省略時はLANを探索する）
+    # host: 隣のノードに知らせる自分のホスト
+    # miner_key: 報酬を受け取る秘密鍵（16進数）のファイル（省略時はminer_<port>.key、''の場合は保存しない）
+    # trusted_snapshot: 1つのノードからでも高速同期に使うスナップショットのハッシュ値
+    # start_on_listen: 同期とマイニングをすぐに始めず、serve()がポートで待ち受けを始めてから始める
+    app = blockchain_server.app
+    app.config["port"] = port
+    app.config["db"] = f"blockchain_{port}.db" if db is None else db
+    app.config["production"] = True
+    app.config["prune"] = prune
+    app.config["peers"] = peers
+    app.config["host"] = host
+    app.config["trusted_snapshot"] = trusted_snapshot
+    app.config["miner_key"] = f"miner_{port}.key" if miner_key is None else miner_key
+    # 最初のリクエストを待たずにブロックチェーンを読み込んでおく
+    block_chain = blockchain_server.get_blockchain()
+    if verify:
+        tampered_height = block_chain.verify_chain()
+        if tampered_height is not None:
+            raise ValueError(f"block {tampered_height} does not match its stored hash")
+    blockchain_server.record_startup("loaded")
+    start = functools.partial(start_node, block_chain, sync=sync, mine=mine)
+    if start_on_listen:
+        app.config["on_listen"] = start
+    else:
+        start()
+    return app
+
+
+def start_node(block_chain, sync=True, mine=False):
+    # 隣のノードとの同期はバックグラウンドで行い、終わってからマイニングを始める
+    # （同期する前のチェーンに積んだブロックは、同期で置き換えられて無駄になるため）
+    def synced():
+        blockchain_server.record_startup("synced", report=True)
+        if mine:
+            block_chain.start_mining(parallel=True)
+
+    if sync:
+        block_chain.sync_neighbours_in_background(then=synced)
+    elif mine:
+        block_chain.start_mining(parallel=True)
+
+
+def serve(app, port, threads=WSGI_THREADS):
+    try:
+        import waitress
+    except ImportError:
+        waitress = None
+    if waitress is not None:
+        server = waitress.create_server(app, host="0.0.0.0", port=port, threads=threads)
+        run = server.run
+    else:
+        from werkzeug.serving import make_server
+
+        app.logger.warning(
+            {"action": "serve", "message": "waitress is not installed, using werkzeug"}
+        )
+        server = make_server("0.0.0.0", port, app, threaded=True)
+        run = server.serve_forever
+    # どちらもサーバーを作った時点でポートを開いているので、ここからの接続はリクエストを処理するまで待たされる
+    blockchain_server.record_startup("listening", report=True)
+    on_listen = app.config.pop("on_listen", None)
+    if on_listen is not None:
+        on_listen()
+    run()
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-p", "--port", default=5100, type=int, help="port to listen on"
+    )
+    parser.add_argument(
+        "-d", "--db", default=None, type=str,
+        help="block store path (default: blockchain_<port>.db, '' for memory only)"
+    )
+    parser.add_argument(
+        "--threads", default=WSGI_THREADS, type=int, help="request handler threads"
+    )
+    parser.add_argument(
+        "--mine", action="store_true", help="start the mining scheduler"
+    )
+    parser.add_argument(
+        "--prune", action="store_true",
+        help="drop transactions of blocks behind the latest snapshot, keeping headers"
+    )
+    parser.add_argument(
+        "--verify", action="store_true",
+        help="recompute all block hashes after loading and refuse to start if any differ"
+    )
+    parser.add_argument(
+        "--peers", default=None, type=str,
+        help="comma-separated host:port list of neighbours (skips the LAN scan)"
+    )
+    parser.add_argument(
+        "--host", default=None, type=str, help="host advertised to neighbours"
+    )
+    parser.add_argument(
+        "--miner-key", default=None, type=str,
+        help="file holding the hex private key and address that receive mining rewards, "
+             "created if missing (default: miner_<port>.key, '' to use a new key every start)"
+    )
+    parser.add_argument(
+        "--trusted-snapshot", default=None, type=str,
+        help="snapshot hash (X-Snapshot-Hash of /snapshot) to fast sync from a single peer"
+    )
+    args = parser.parse_args()
+
+    serve(
+        create_app(
+            args.port, args.db, mine=args.mine, prune=args.prune, verify=args.verify,
+            peers=args.peers.split(",") if args.peers else None,
+            host=args.host, miner_key=args.miner_key, trusted_snapshot=args.trusted_snapshot,
+            start_on_listen=True,
+        ),
+        args.port, args.threads,
+    )